@@ -0,0 +1,162 @@
+"""Benchmark of `disconnect_node_graph` on synthetic 500-node graphs.
+
+Compares the current implementation with the previous one, that scanned the whole graph for each removed node,
+and checks that both produce the same graph.
+
+Usage: python tests/benchmark_disconnect_node_graph.py
+"""
+
+import copy
+import random
+import time
+
+from visionatrix import flows
+from visionatrix.flows_templates import NodesConsumers
+
+NODES_COUNT = 500
+REPEATS = 20
+
+
+class FakeNode:
+    RETURN_TYPES = ("IMAGE",)
+
+    @classmethod
+    def INPUT_TYPES(cls):  # noqa
+        return {
+            "required": {"image": ("IMAGE",), "strength": ("FLOAT",)},
+            "optional": {"mask": ("IMAGE",), "extra": ("IMAGE",)},
+        }
+
+
+class FakeLoader:
+    RETURN_TYPES = ("IMAGE",)
+
+    @classmethod
+    def INPUT_TYPES(cls):  # noqa
+        return {"required": {"image": (["a.png", "b.png"],)}}
+
+
+NODES_CLASS_MAPPINGS = {"FakeNode": FakeNode, "FakeLoader": FakeLoader}
+
+
+def old_disconnect_node_graph(node_id: str, flow_comfy: dict[str, dict]) -> None:
+    node_to_remove = flow_comfy.get(node_id)
+    if not node_to_remove:
+        return
+    nodes_class_mappings = NODES_CLASS_MAPPINGS
+
+    surviving_inputs = [details for details in node_to_remove.get("inputs", {}).values() if isinstance(details, list)]
+    replacement_connection = surviving_inputs[0] if len(surviving_inputs) == 1 else None
+    replacement_node_return_type = None
+    if replacement_connection:
+        replacement_node_id = flow_comfy.get(surviving_inputs[0][0])
+        if replacement_node_id:
+            replacement_node_class_mapping = nodes_class_mappings.get(replacement_node_id.get("class_type"))
+            if replacement_node_class_mapping and hasattr(replacement_node_class_mapping, "RETURN_TYPES"):
+                replacement_node_return_type = replacement_node_class_mapping.RETURN_TYPES[surviving_inputs[0][1]]
+            else:
+                replacement_connection = None
+        else:
+            replacement_connection = None
+
+    next_nodes_to_disconnect = []
+    for next_node_id, next_node_details in flow_comfy.items():
+        if next_node_id == node_id:
+            continue
+        node_class_input_types = None
+        if class_type := next_node_details.get("class_type"):
+            node_class_mapping = nodes_class_mappings.get(class_type)
+            if node_class_mapping and hasattr(node_class_mapping, "INPUT_TYPES"):
+                node_class_input_types = node_class_mapping.INPUT_TYPES()
+
+        inputs_to_pop = []
+        for input_name, input_details in next_node_details.get("inputs", {}).items():
+            if isinstance(input_details, list) and input_details[0] == node_id:
+                param_input_type = (
+                    flows.get_node_parameter_input_type(node_class_input_types, input_name)
+                    if node_class_input_types
+                    else ""
+                )
+                if replacement_connection and param_input_type in ("*", replacement_node_return_type):
+                    next_node_details["inputs"][input_name] = replacement_connection
+                else:
+                    inputs_to_pop.append(input_name)
+
+        if inputs_to_pop:
+            for i in inputs_to_pop:
+                is_required = False
+                if node_class_input_types and i in node_class_input_types.get("required", []):
+                    is_required = True
+                next_node_details["inputs"].pop(i)
+                if is_required and next_node_id not in next_nodes_to_disconnect:
+                    next_nodes_to_disconnect.append(next_node_id)
+
+    flow_comfy.pop(node_id)
+    for i in next_nodes_to_disconnect:
+        old_disconnect_node_graph(i, flow_comfy)
+
+
+def make_graph(seed: int, mode: str) -> dict[str, dict]:
+    """Node "1" is the node of the optional file input, other nodes consume outputs of random earlier nodes.
+
+    Modes: "chain" - each node consumes the previous one, "dag" - random graph, "mask" - node "1" is connected only
+    to optional inputs, "bypass" - node "1" has one input, so its consumers are re-wired to its source.
+    """
+    rnd = random.Random(seed)
+    graph = {
+        "0": {"class_type": "FakeLoader", "inputs": {"image": "a.png"}},
+        "1": {"class_type": "FakeLoader", "inputs": {"image": "b.png"}},
+    }
+    if mode == "bypass":
+        graph["1"] = {"class_type": "FakeNode", "inputs": {"image": ["0", 0], "strength": 0.5}}
+    for i in range(2, NODES_COUNT):
+        if mode == "chain":
+            source = str(i - 1)
+        elif mode == "mask":
+            source = "0" if i == 2 else str(rnd.randint(2, i - 1))
+        else:
+            source = str(rnd.randint(0, i - 1))
+        inputs = {"image": [source, 0], "strength": 0.5}
+        if rnd.random() < 0.3:
+            inputs["mask"] = [str(rnd.randint(1, i - 1)), 0]
+        graph[str(i)] = {"class_type": "FakeNode", "inputs": inputs}
+    return graph
+
+
+def benchmark(title: str, graph: dict[str, dict]) -> None:
+    old_graph = copy.deepcopy(graph)
+    old_disconnect_node_graph("1", old_graph)
+    new_graph = copy.deepcopy(graph)
+    flows.disconnect_node_graph("1", new_graph)
+    assert old_graph == new_graph, "results of the implementations differ"
+
+    graphs = [copy.deepcopy(graph) for _ in range(REPEATS)]
+    start = time.perf_counter()
+    for i in graphs:
+        old_disconnect_node_graph("1", i)
+    old_time = (time.perf_counter() - start) / REPEATS
+
+    graphs = [copy.deepcopy(graph) for _ in range(REPEATS)]
+    start = time.perf_counter()
+    for i in graphs:
+        flows.disconnect_node_graph("1", i)
+    new_time = (time.perf_counter() - start) / REPEATS
+
+    consumers = NodesConsumers(graph)  # task creation uses the index built once for the compiled flow
+    graphs = [copy.deepcopy(graph) for _ in range(REPEATS)]
+    start = time.perf_counter()
+    for i in graphs:
+        flows.disconnect_node_graph("1", i, consumers.copy())
+    template_time = (time.perf_counter() - start) / REPEATS
+    print(
+        f"{title}: removed {len(graph) - len(new_graph)} of {len(graph)} nodes, old {old_time * 1000:.2f} ms, "
+        f"new {new_time * 1000:.2f} ms ({old_time / new_time:.1f}x), "
+        f"with prebuilt index {template_time * 1000:.2f} ms ({old_time / template_time:.1f}x)"
+    )
+
+
+if __name__ == "__main__":
+    flows.get_node_class_mappings = lambda: NODES_CLASS_MAPPINGS
+    for graph_mode in ("chain", "dag", "mask", "bypass"):
+        for graph_seed in range(2):
+            benchmark(f"{graph_mode} #{graph_seed}", make_graph(graph_seed, graph_mode))
@@ -0,0 +1,134 @@
+"""Benchmark of `fetch_child_tasks_async` on deep and wide trees of child tasks.
+
+Compares the current implementation, that fetches all descendants with one recursive query, with the previous one,
+that issued one query per level of the tree, and checks that both return the same trees.
+
+Usage: python tests/benchmark_fetch_child_tasks.py [DATABASE_URI]
+
+Without arguments a temporary SQLite database is used.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+if len(sys.argv) > 1:
+    os.environ["DATABASE_URI"] = sys.argv[1]
+else:
+    os.environ["DATABASE_URI"] = f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/benchmark.db"
+
+from sqlalchemy import delete, insert, select  # noqa: E402
+
+from visionatrix import database  # noqa: E402
+from visionatrix.tasks_engine_async import fetch_child_tasks_async  # noqa: E402
+from visionatrix.tasks_engine_etc import (  # noqa: E402
+    TASK_DETAILS_COLUMNS_SHORT,
+    task_details_short_to_dict,
+)
+
+REPEATS = 20
+USER_ID = "benchmark"
+
+
+async def old_fetch_child_tasks_async(session, parent_task_ids: list[int]) -> dict[int, list]:
+    if not parent_task_ids:
+        return {}
+
+    query = (
+        select(*TASK_DETAILS_COLUMNS_SHORT)
+        .outerjoin(database.TaskLock, database.TaskLock.task_id == database.TaskDetails.task_id)
+        .filter(database.TaskDetails.parent_task_id.in_(parent_task_ids))
+    )
+    child_tasks = (await session.execute(query)).all()
+
+    parent_to_children = {}
+    for task in child_tasks:
+        task_details = task_details_short_to_dict(task)
+        parent_to_children.setdefault(task.parent_task_id, []).append(task_details)
+
+    next_level_parent_ids = [task.task_id for task in child_tasks]
+    next_level_children = await old_fetch_child_tasks_async(session, next_level_parent_ids)
+    for children in parent_to_children.values():
+        for child in children:
+            child["child_tasks"] = next_level_children.get(child["task_id"], [])
+    return parent_to_children
+
+
+def make_tree(first_id: int, roots: int, depth: int, fanout: int) -> list[tuple[int, int | None]]:
+    """Returns `(task_id, parent_task_id)` of `roots` trees, each node up to `depth` has `fanout` children."""
+    r = []
+    next_id = first_id
+    for _ in range(roots):
+        level = [next_id]
+        r.append((next_id, None))
+        next_id += 1
+        for _ in range(depth):
+            next_level = []
+            for parent_id in level:
+                for _ in range(fanout):
+                    r.append((next_id, parent_id))
+                    next_level.append(next_id)
+                    next_id += 1
+            level = next_level
+    return r
+
+
+def sort_trees(trees: dict[int, list]) -> dict[int, list]:
+    def sort_children(children: list[dict]) -> list[dict]:
+        return sorted(
+            [{**i, "child_tasks": sort_children(i["child_tasks"])} for i in children], key=lambda x: x["task_id"]
+        )
+
+    return {k: sort_children(v) for k, v in trees.items()}
+
+
+async def benchmark(title: str, tasks: list[tuple[int, int | None]], parent_task_ids: list[int] | None = None) -> None:
+    """Fetches the trees of `parent_task_ids`, of the root tasks by default."""
+    async with database.SESSION() as session:
+        await session.execute(delete(database.TaskDetails))
+        await session.execute(delete(database.TaskQueue))
+        await session.execute(insert(database.TaskQueue), [{"id": i} for i, _ in tasks])
+        await session.execute(
+            insert(database.TaskDetails),
+            [
+                {"task_id": i, "parent_task_id": parent_id, "user_id": USER_ID, "name": "benchmark", "flow_comfy": {}}
+                for i, parent_id in tasks
+            ],
+        )
+        await session.commit()
+    roots = parent_task_ids or [i for i, parent_id in tasks if parent_id is None]
+
+    async with database.SESSION() as session:
+        old_result = await old_fetch_child_tasks_async(session, roots)
+        new_result = await fetch_child_tasks_async(session, roots)
+        assert sort_trees(old_result) == sort_trees(new_result), "results of the implementations differ"
+
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            await old_fetch_child_tasks_async(session, roots)
+        old_time = (time.perf_counter() - start) / REPEATS
+
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            await fetch_child_tasks_async(session, roots)
+        new_time = (time.perf_counter() - start) / REPEATS
+    print(
+        f"{title}: {len(tasks)} tasks, old {old_time * 1000:.2f} ms, "
+        f"new {new_time * 1000:.2f} ms ({old_time / new_time:.1f}x)"
+    )
+
+
+async def main():
+    await database.init_database_engine()
+    await benchmark("chain of 4 (upscale, refine, video, interpolate)", make_tree(1, 1, 3, 1))
+    await benchmark("chain of 4, all tasks of it requested", make_tree(1, 1, 3, 1), [1, 2, 3, 4])
+    await benchmark("deep chain of 50", make_tree(1, 1, 49, 1))
+    await benchmark("50 chains of 4, progress poll of a group", make_tree(1, 50, 3, 1))
+    await benchmark("wide tree, 4 levels of 6 children", make_tree(1, 1, 4, 6))
+    await benchmark("200 parents with 5 children each", make_tree(1, 200, 1, 5))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
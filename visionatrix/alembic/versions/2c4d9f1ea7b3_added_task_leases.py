@@ -0,0 +1,32 @@
+"""Added expires_at to task_locks and lease_expirations to tasks_details
+
+Revision ID: 2c4d9f1ea7b3
+Revises: 8ea3dfda9f00
+Create Date: 2026-10-17 20:40:12.518304
+
+"""
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "2c4d9f1ea7b3"
+down_revision: str | None = "8ea3dfda9f00"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.add_column("task_locks", sa.Column("expires_at", sa.DateTime(), nullable=True))
+    op.create_index(op.f("ix_task_locks_expires_at"), "task_locks", ["expires_at"], unique=False)
+    op.add_column(
+        "tasks_details", sa.Column("lease_expirations", sa.Integer(), nullable=False, server_default=sa.text("0"))
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("tasks_details", "lease_expirations")
+    op.drop_index(op.f("ix_task_locks_expires_at"), table_name="task_locks")
+    op.drop_column("task_locks", "expires_at")
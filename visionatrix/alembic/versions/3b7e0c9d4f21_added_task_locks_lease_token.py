@@ -0,0 +1,34 @@
+"""Added lease_token to task_locks, filled missing expires_at of task_locks
+
+Revision ID: 3b7e0c9d4f21
+Revises: 8d2f4a6c1e53
+Create Date: 2026-10-17 23:12:46.105938
+
+"""
+
+from collections.abc import Sequence
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+from alembic import op
+
+from visionatrix import options
+
+# revision identifiers, used by Alembic.
+revision: str = "3b7e0c9d4f21"
+down_revision: str | None = "8d2f4a6c1e53"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.add_column("task_locks", sa.Column("lease_token", sa.String(), nullable=True))
+    # locks created before the leases were introduced never expire otherwise, so their tasks would stay locked
+    op.get_bind().execute(
+        sa.text("UPDATE task_locks SET expires_at = :expires_at WHERE expires_at IS NULL"),
+        {"expires_at": datetime.utcnow() + timedelta(seconds=options.TASK_LEASE_TTL)},
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("task_locks", "lease_token")
@@ -0,0 +1,33 @@
+"""Added partial index of not finished tasks to tasks_details
+
+Revision ID: 5e1a7c3b9d20
+Revises: 2c4d9f1ea7b3
+Create Date: 2026-10-17 21:02:41.174512
+
+"""
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5e1a7c3b9d20"
+down_revision: str | None = "2c4d9f1ea7b3"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_tasks_details_queue",
+        "tasks_details",
+        ["priority", "created_at"],
+        unique=False,
+        sqlite_where=sa.text("progress != 100.0 AND error = ''"),
+        postgresql_where=sa.text("progress != 100.0 AND error = ''"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_tasks_details_queue", table_name="tasks_details")
@@ -0,0 +1,36 @@
+"""Added indexes for the keyset pagination of tasks by updated_at, filled missing updated_at of tasks
+
+Revision ID: 8d2f4a6c1e53
+Revises: 5e1a7c3b9d20
+Create Date: 2026-10-17 21:58:09.402817
+
+"""
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "8d2f4a6c1e53"
+down_revision: str | None = "5e1a7c3b9d20"
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.execute(sa.text("UPDATE tasks_details SET updated_at = created_at WHERE updated_at IS NULL"))
+    op.create_index(
+        "ix_tasks_details_user_updated", "tasks_details", ["user_id", "updated_at", "task_id"], unique=False
+    )
+    op.create_index(
+        "ix_tasks_details_user_group_updated",
+        "tasks_details",
+        ["user_id", "group_scope", "updated_at", "task_id"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_tasks_details_user_group_updated", table_name="tasks_details")
+    op.drop_index("ix_tasks_details_user_updated", table_name="tasks_details")
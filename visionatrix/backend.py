@@ -5,6 +5,7 @@ import logging
 import os
 import re
 import shutil
+import sys
 from contextlib import asynccontextmanager
 from pathlib import Path
 from urllib.parse import urlencode
@@ -28,6 +29,8 @@ from .etc import setup_logging
 from .pydantic_models import UserInfo
 from .tasks_engine import remove_active_task_lock, task_progress_callback
 from .tasks_engine_async import start_tasks_engine
+from .tasks_files import migrate_tasks_files_layout
+from .tasks_notify import is_postgresql, tasks_notifications_listener
 from .user_backends import perform_auth_http, perform_auth_ws
 
 setup_logging(log_level_name=os.environ.get("LOG_LEVEL", "INFO").upper())
@@ -160,6 +163,7 @@ async def lifespan(app: FastAPI):
             models_dir=(await get_global_setting("comfyui_models_folder", True)),
         )
 
+    await migrate_tasks_files_layout()
     routes.tasks_internal.VALIDATE_PROMPT, prompt_server_args, start_all_func = await comfyui_wrapper.load(
         task_progress_callback
     )
@@ -177,10 +181,17 @@ async def lifespan(app: FastAPI):
     lifespan_bg_tasks.add(
         asyncio.create_task(start_all_func()),
     )
+    if options.VIX_MODE == "SERVER" and is_postgresql():
+        # in other modes the listener is started together with the tasks engine
+        lifespan_bg_tasks.add(
+            asyncio.create_task(tasks_notifications_listener(events.EXIT_EVENT)),
+        )
     yield
     events.EXIT_EVENT.set()
     events.EXIT_EVENT_ASYNC.set()
     comfyui_wrapper.interrupt_processing()
+    if options.VIX_MODE != "SERVER":
+        await remove_active_task_lock()
 
 
 def custom_generate_unique_id(route: APIRoute):
@@ -279,11 +290,39 @@ async def run_vix(*args, **kwargs) -> None:
         )
         server = uvicorn.Server(config)
         await server.serve()
+    elif options.VIX_WORKER_DEVICES:
+        await run_worker_per_device([i.strip() for i in options.VIX_WORKER_DEVICES.split(",") if i.strip()])
     else:
         register_heif_opener()
         await run_in_worker_mode()
 
 
+async def run_worker_per_device(devices: list[str]) -> None:
+    async def supervise_worker(device: str) -> None:
+        env = os.environ.copy()
+        env.update({"VIX_WORKER_DEVICES": "", "CUDA_VISIBLE_DEVICES": device, "VIX_MODE": "WORKER"})
+        while True:
+            LOGGER.info("Starting worker for device %s.", device)
+            process = await asyncio.create_subprocess_exec(*sys.orig_argv, env=env)
+            try:
+                return_code = await process.wait()
+            except asyncio.CancelledError:
+                process.terminate()
+                await process.wait()
+                raise
+            LOGGER.error("Worker for device %s exited with code %s, restarting in 5 seconds.", device, return_code)
+            await asyncio.sleep(5)
+
+    supervisors = [asyncio.create_task(supervise_worker(device)) for device in devices]
+    try:
+        await asyncio.gather(*supervisors)
+    except asyncio.exceptions.CancelledError:
+        print("Got signal to stop execution.")
+        for supervisor in supervisors:
+            supervisor.cancel()
+        await asyncio.gather(*supervisors, return_exceptions=True)
+
+
 async def run_in_worker_mode() -> None:
     _, prompt_server_args, _ = await comfyui_wrapper.load(task_progress_callback)
     await start_tasks_engine(prompt_server_args, events.EXIT_EVENT)
@@ -3,4 +3,5 @@
 from . import (
     federation,
     post_update,
+    task_leases,
 )
@@ -9,7 +9,6 @@ from pathlib import Path
 
 import httpx
 
-from .. import options
 from ..db_queries import (
     get_enabled_federated_instances,
     update_installed_flows_for_federated_instance,
@@ -25,10 +24,11 @@ from ..pydantic_models import (
 from ..tasks_engine import (
     get_task_files,
     get_task_for_federated_worker,
-    remove_task_lock,
     update_task_progress_database,
 )
 from ..tasks_engine_async import update_task_outputs_async
+from ..tasks_engine_locks import remove_task_lock
+from ..tasks_files import get_task_dir
 from ..webhooks import webhook_task_progress
 from .background_tasks import register_background_job
 
@@ -116,8 +116,7 @@ async def federation_engine_bg_job(exit_event: asyncio.Event):
                         and instance_flows[task] == local_installed_flows[task]
                     ]
                     if filtered_tasks:
-                        federated_task = await get_task_for_federated_worker(filtered_tasks)
-                        if federated_task:
+                        for federated_task in await get_task_for_federated_worker(filtered_tasks):
                             instances_dict[instance]["tasks"].append((worker, federated_task))
 
             for instance_data in instances_dict.values():
@@ -178,7 +177,7 @@ async def send_task_to_federated_instance(
             except httpx.RequestError:
                 LOGGER.exception("Failed to send task for execution.")
             finally:
-                await remove_task_lock(task_details["task_id"])
+                await remove_task_lock(task_details["task_id"], task_details["lease_token"])
 
 
 async def track_task_execution(
@@ -207,6 +206,7 @@ async def track_task_execution(
                     execution_time,
                     worker.worker_id,
                     None,
+                    task_details["lease_token"],
                     ExecutionDetails.model_validate(execution_details) if execution_details else None,
                 ):
                     await federation_remove_task(client, remote_task_id)
@@ -282,7 +282,8 @@ async def retrieve_task_results(client: httpx.AsyncClient, task_id: int, remote_
                 msg = Message()
                 msg["content-disposition"] = result_response.headers["content-disposition"]
                 filename = str(task_id) + "_" + msg.get_filename().removeprefix(f"{remote_task_id}_")
-                file_path = Path(options.OUTPUT_DIR).joinpath("visionatrix").joinpath(filename)
+                file_path = Path(get_task_dir(task_id, "output")).joinpath(filename)
+                file_path.parent.mkdir(parents=True, exist_ok=True)
                 with builtins.open(file_path, mode="wb") as out_file:
                     out_file.write(result_response.content)
             await update_task_outputs_async(task_id, task_details["outputs"])
@@ -0,0 +1,13 @@
+import asyncio
+import logging
+from datetime import timedelta
+
+from ..tasks_engine_locks import reclaim_expired_task_leases
+from .background_tasks import register_background_job
+
+LOGGER = logging.getLogger("visionatrix")
+
+
+@register_background_job("reclaim_expired_task_leases", interval=timedelta(seconds=30))
+async def reclaim_expired_task_leases_bg_job(_exit_event: asyncio.Event):
+    await reclaim_expired_task_leases()
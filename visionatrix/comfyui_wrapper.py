@@ -7,6 +7,7 @@ https://github.com/comfyanonymous/ComfyUI
 # pylint: skip-file
 
 import asyncio
+import collections
 import contextlib
 import enum
 import gc
@@ -39,6 +40,9 @@ SYSTEM_DETAILS = {
 TORCH_VERSION: str | None = None
 PROMPT_EXECUTOR: typing.Any
 DEVICE_CUSTOM_INDEX: int | None = None
+RESIDENT_MODELS: collections.OrderedDict[str, None] = collections.OrderedDict()
+"""Names of the models used by the recently executed tasks, the most recently used are at the end."""
+RESIDENT_MODELS_LIMIT = 32
 
 
 async def load(
@@ -251,6 +255,15 @@ def unload_all_models() -> None:
     import comfy  # noqa
 
     comfy.model_management.unload_all_models()
+    RESIDENT_MODELS.clear()
+
+
+def add_resident_models(models_names: list[str]) -> None:
+    for model_name in models_names:
+        RESIDENT_MODELS[model_name] = None
+        RESIDENT_MODELS.move_to_end(model_name)
+    while len(RESIDENT_MODELS) > RESIDENT_MODELS_LIMIT:
+        RESIDENT_MODELS.popitem(last=False)
 
 
 def soft_empty_cache() -> None:
@@ -330,6 +343,7 @@ def get_worker_details() -> dict:
         "ram_free": virtual_memory().available,
         "devices": [torch_device_info()],
         "engine_details": get_engine_details(),
+        "resident_models": list(RESIDENT_MODELS),
     }
 
 
@@ -395,7 +409,7 @@ def background_prompt_executor_comfy(
             item, item_id = queue_item
 
             if item[3].get("unload_models"):
-                comfy.model_management.unload_all_models()
+                unload_all_models()
                 gc.collect()
                 comfy.model_management.soft_empty_cache()
                 last_gc_collect = time.perf_counter()
@@ -426,7 +440,7 @@ def background_prompt_executor_comfy(
         free_memory = flags.get("free_memory", False)
 
         if flags.get("unload_models", free_memory):
-            comfy.model_management.unload_all_models()
+            unload_all_models()
             need_gc = True
             last_gc_collect = 0
 
@@ -597,7 +611,7 @@ def set_comfy_internal_flags(
 
     disable_smart_memory = not smart_memory
     if comfy.cli_args.args.disable_smart_memory != disable_smart_memory:
-        comfy.model_management.unload_all_models()
+        unload_all_models()
         models_were_unloaded = True
 
         comfy.cli_args.args.disable_smart_memory = disable_smart_memory
@@ -617,11 +631,11 @@ def set_comfy_internal_flags(
 
     if comfy.cli_args.args.cpu_vae != vae_cpu:
         if not models_were_unloaded:
-            comfy.model_management.unload_all_models()
+            unload_all_models()
             models_were_unloaded = True
         comfy.cli_args.args.cpu_vae = vae_cpu
 
     if comfy.model_management.EXTRA_RESERVED_VRAM != reserve_vram * 1024 * 1024 * 1024:  # noqa
         if not models_were_unloaded:
-            comfy.model_management.unload_all_models()
+            unload_all_models()
         comfy.model_management.EXTRA_RESERVED_VRAM = reserve_vram * 1024 * 1024 * 1024
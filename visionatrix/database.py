@@ -18,6 +18,7 @@ from sqlalchemy import (
     Integer,
     String,
     UniqueConstraint,
+    and_,
     text,
 )
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
@@ -59,8 +60,8 @@ class TaskDetails(Base):
     input_files = Column(JSON, default=[])
     flow_comfy = Column(JSON, default={}, nullable=False)
     task_queue = relationship("TaskQueue")
-    created_at = Column(DateTime, default=datetime.now(timezone.utc), nullable=False)
-    updated_at = Column(DateTime, nullable=True, default=None, index=True)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
+    updated_at = Column(DateTime, nullable=True, default=lambda: datetime.now(timezone.utc), index=True)
     finished_at = Column(DateTime, nullable=True, default=None)
     execution_time = Column(Float, default=0.0)
     group_scope = Column(Integer, default=1, index=True)
@@ -73,8 +74,22 @@ class TaskDetails(Base):
     extra_flags = Column(JSON, default=None, nullable=True)
     custom_worker = Column(String, default=None, index=True)
     hidden = Column(Boolean, nullable=True)
-
-    __table_args__ = (Index("ix_parent_task", "parent_task_id", "parent_task_node_id"),)
+    lease_expirations = Column(Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        Index("ix_parent_task", "parent_task_id", "parent_task_node_id"),
+        # partial index of not finished tasks, keeps the claim query independent of the number of finished tasks
+        Index(
+            "ix_tasks_details_queue",
+            "priority",
+            "created_at",
+            sqlite_where=and_(progress != 100.0, error == ""),
+            postgresql_where=and_(progress != 100.0, error == ""),
+        ),
+        # keyset pagination of the user tasks in the order of their updates
+        Index("ix_tasks_details_user_updated", "user_id", "updated_at", "task_id"),
+        Index("ix_tasks_details_user_group_updated", "user_id", "group_scope", "updated_at", "task_id"),
+    )
 
 
 class TaskLock(Base):
@@ -82,6 +97,8 @@ class TaskLock(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     task_id = Column(Integer, ForeignKey("tasks_queue.id"), nullable=False, unique=True)
     locked_at = Column(DateTime, default=datetime.now(timezone.utc), nullable=False)
+    expires_at = Column(DateTime, nullable=True, index=True)
+    lease_token = Column(String, nullable=True)
     task_queue = relationship("TaskQueue", backref="lock")
 
 
@@ -5,12 +5,10 @@ import json
 import logging
 import os
 import random
-import shutil
 import threading
 import time
 import typing
 import zipfile
-from base64 import b64decode
 from copy import deepcopy
 from pathlib import Path
 from urllib.parse import urlparse
@@ -37,10 +35,13 @@ from .flows_loras import (
     insert_lora_in_comfy_flow,
     remove_all_consecutive_loras_for_node,
 )
+from .flows_templates import FlowTemplate, NodesConsumers, get_node_input_types
+from .inputs_store import link_input_file, store_input_bytes, store_input_upload
 from .models import fill_flows_model_installed_field, install_model
 from .models_map import process_flow_models
 from .nodes_helpers import get_node_value, set_node_value
 from .pydantic_models import Flow, FlowCloneRequest, LoraConnectionPoint, WorkerDetails
+from .tasks_files import get_task_dir, get_task_files, get_task_subdir
 
 LOGGER = logging.getLogger("visionatrix")
 
@@ -59,7 +60,10 @@ LAST_GOOD_INSTALLED_FLOWS = {
     "update_time": 0.0,
     "flows": {},
     "flows_comfy": {},
+    "flows_models": {},  # flow name => set of model names, used by the tasks scheduler
 }
+FLOWS_TEMPLATES: dict[str, FlowTemplate] = {}
+"""Compiled installed flows, rebuilt when the installed ComfyUI graph of the flow changes."""
 LOCK_INSTALLED_FLOWS = threading.Lock()
 LOCK_INSTALLED_FLOWS_UPDATING = threading.Lock()
 
@@ -217,6 +221,11 @@ async def get_not_installed_flows(flows_comfy: dict[str, dict] | None = None) ->
 
 
 async def get_installed_flows(flows_comfy: dict[str, dict] | None = None) -> dict[str, Flow]:
+    return deepcopy(await __get_installed_flows_cached(flows_comfy))
+
+
+async def __get_installed_flows_cached(flows_comfy: dict[str, dict] | None) -> dict[str, Flow]:
+    """Returns the cached flows themselves, they should not be modified."""
     if flows_comfy is None:
         flows_comfy = {}
     else:
@@ -229,7 +238,7 @@ async def get_installed_flows(flows_comfy: dict[str, dict] | None = None) -> dic
             and LAST_GOOD_INSTALLED_FLOWS["flows"]
         ):
             flows_comfy.update(LAST_GOOD_INSTALLED_FLOWS["flows_comfy"])
-            return deepcopy(LAST_GOOD_INSTALLED_FLOWS["flows"])
+            return LAST_GOOD_INSTALLED_FLOWS["flows"]
 
     if LOCK_INSTALLED_FLOWS_UPDATING.acquire(blocking=False):  # pylint: disable=consider-using-with
         try:
@@ -238,8 +247,11 @@ async def get_installed_flows(flows_comfy: dict[str, dict] | None = None) -> dic
                 LAST_GOOD_INSTALLED_FLOWS["update_time"] = time.time()
                 LAST_GOOD_INSTALLED_FLOWS["flows"] = updated_flows
                 LAST_GOOD_INSTALLED_FLOWS["flows_comfy"] = updated_flows_comfy
+                LAST_GOOD_INSTALLED_FLOWS["flows_models"] = {
+                    k: frozenset(i.name for i in v.models) for k, v in updated_flows.items()
+                }
             flows_comfy.update(updated_flows_comfy)
-            return deepcopy(updated_flows)
+            return updated_flows
         finally:
             LOCK_INSTALLED_FLOWS_UPDATING.release()
 
@@ -247,7 +259,7 @@ async def get_installed_flows(flows_comfy: dict[str, dict] | None = None) -> dic
     with LOCK_INSTALLED_FLOWS:
         if LAST_GOOD_INSTALLED_FLOWS["flows"]:  # cache is non-empty -> return immediately
             flows_comfy.update(LAST_GOOD_INSTALLED_FLOWS["flows_comfy"])
-            return deepcopy(LAST_GOOD_INSTALLED_FLOWS["flows"])
+            return LAST_GOOD_INSTALLED_FLOWS["flows"]
 
     # cache empty - let's wait a bit
     waited = 0.0
@@ -257,12 +269,32 @@ async def get_installed_flows(flows_comfy: dict[str, dict] | None = None) -> dic
         with LOCK_INSTALLED_FLOWS:
             if LAST_GOOD_INSTALLED_FLOWS["flows"]:
                 flows_comfy.update(LAST_GOOD_INSTALLED_FLOWS["flows_comfy"])
-                return deepcopy(LAST_GOOD_INSTALLED_FLOWS["flows"])
+                return LAST_GOOD_INSTALLED_FLOWS["flows"]
 
     LOGGER.warning("Installed-flows cache still empty after %.1f s, returning empty list", 2.0)
     return {}
 
 
+async def get_flows_models_affinity(flows_names: list[str], resident_models: list[str]) -> dict[str, int]:
+    """Returns the number of models shared with `resident_models` for each flow that has such models."""
+    if not resident_models:
+        return {}
+    with LOCK_INSTALLED_FLOWS:
+        flows_models = LAST_GOOD_INSTALLED_FLOWS["flows_models"]
+        if time.time() >= LAST_GOOD_INSTALLED_FLOWS["update_time"] + SECONDS_TO_CACHE_INSTALLED_FLOWS:
+            flows_models = None
+    if not flows_models:
+        await get_installed_flows()
+        with LOCK_INSTALLED_FLOWS:
+            flows_models = LAST_GOOD_INSTALLED_FLOWS["flows_models"]
+    resident_models = set(resident_models)
+    r = {}
+    for flow_name in flows_names:
+        if shared_models := len(flows_models.get(flow_name, frozenset()) & resident_models):
+            r[flow_name] = shared_models
+    return r
+
+
 async def __get_installed_flows() -> [dict[str, Flow], dict[str, dict]]:
     available_flows = await get_available_flows({})
     public_flows_names = list(available_flows)
@@ -282,9 +314,14 @@ async def __get_installed_flows() -> [dict[str, Flow], dict[str, dict]]:
 
 
 async def get_installed_flow(flow_name: str, flow_comfy: dict[str, dict]) -> Flow | None:
+    """Fills `flow_comfy` with the installed ComfyUI graph of the flow, its nodes are shared and should not be modified.
+
+    Only the requested flow is copied, use `prepare_flow_comfy` to get the graph for a new task.
+    """
     flows_comfy = {}
-    flow = (await get_installed_flows(flows_comfy)).get(flow_name)
+    flow = (await __get_installed_flows_cached(flows_comfy)).get(flow_name)
     if flow:
+        flow = flow.model_copy(deep=True)
         flow_comfy.clear()
         flow_comfy.update(flows_comfy[flow_name])
     return flow
@@ -373,6 +410,7 @@ async def uninstall_flow(flow_name: str) -> None:
         if await db_queries.delete_flow_progress_install(flow_name):
             LAST_GOOD_INSTALLED_FLOWS["flows"].pop(flow_name, None)
             LAST_GOOD_INSTALLED_FLOWS["flows_comfy"].pop(flow_name, None)
+            FLOWS_TEMPLATES.pop(flow_name, None)
 
 
 def prepare_flow_comfy(
@@ -381,22 +419,36 @@ def prepare_flow_comfy(
     in_texts_params: dict,
     in_files_params: dict[str, StarletteUploadFile | dict],
     task_details: dict,
+    stored_files: dict[str, tuple[str, str]] | None = None,
 ) -> dict:
-    r = deepcopy(flow_comfy)
-    for i in [i for i in flow.input_params if i["type"] in SUPPORTED_TEXT_TYPES_INPUTS]:
+    template = get_flow_template(flow, flow_comfy)
+    r = template.materialize(in_files_params)
+    for i, patches in template.inputs_patches:
         v = prepare_flow_comfy_get_input_value(in_texts_params, i)
         if v is None:
             continue
-        for k, input_path in i["comfy_node_id"].items():
+        for k, input_path in patches:
             node = r.get(k, {})
             if not node:
                 raise RuntimeError(f"Bad workflow, node with id=`{k}` can not be found.")
             set_node_value(node, input_path, v)
-    process_seed_value(flow, in_texts_params, r)
-    prepare_flow_comfy_files_params(flow, in_files_params, task_details["task_id"], task_details, r)
+    process_seed_value(flow, in_texts_params, r, template.seed_paths)
+    prepare_flow_comfy_files_params(
+        flow, in_files_params, task_details["task_id"], task_details, r, template.consumers.copy(), stored_files
+    )
     return r
 
 
+def get_flow_template(flow: Flow, flow_comfy: dict[str, dict]) -> FlowTemplate:
+    template = FLOWS_TEMPLATES.get(flow.name)
+    if template is None or not template.is_compiled_from(flow_comfy):
+        template = FlowTemplate(
+            flow, flow_comfy, SUPPORTED_TEXT_TYPES_INPUTS, SUPPORTED_FILE_TYPES_INPUTS, SUPPORTED_OUTPUTS.keys()
+        )
+        FLOWS_TEMPLATES[flow.name] = template
+    return template
+
+
 def prepare_flow_comfy_get_input_value(in_texts_params: dict, i: dict) -> typing.Any:
     v = in_texts_params.get(i["name"], None)
     if v is None:
@@ -423,9 +475,25 @@ def prepare_flow_comfy_get_input_value(in_texts_params: dict, i: dict) -> typing
 
 
 def prepare_flow_comfy_files_params(
-    flow: Flow, in_files_params: dict[str, StarletteUploadFile | dict], task_id: int, task_details: dict, r: dict
+    flow: Flow,
+    in_files_params: dict[str, StarletteUploadFile | dict],
+    task_id: int,
+    task_details: dict,
+    r: dict,
+    consumers: NodesConsumers | None = None,
+    stored_files: dict[str, tuple[str, str]] | None = None,
 ) -> None:
+    """Creates input files of the task, files with the same content are stored only once.
+
+    `stored_files` should be shared between tasks of one request, uploaded files are read only for the first of them.
+    `input_files` of the task keep the names of the files in the inputs store to release them when the task is removed.
+    """
+    if stored_files is None:
+        stored_files = {}
     files_params = [i for i in flow.input_params if i["type"] in SUPPORTED_FILE_TYPES_INPUTS]
+    task_subdir = get_task_subdir(task_id)
+    if in_files_params:
+        os.makedirs(get_task_dir(task_id, "input"), exist_ok=True)
     flow_input_file_params = {}
     for file_param in files_params:
         file_param_name = file_param["name"]
@@ -433,77 +501,84 @@ def prepare_flow_comfy_files_params(
         if file_param_name not in in_files_params and not file_param.get("optional", False):
             raise RuntimeError(f"The parameter '{file_param_name}' is required, but missing.")
     for param_name, v in in_files_params.items():
+        stored_name = ""
         if isinstance(v, dict):
             if "input_index" in v:
-                input_file = str(
-                    os.path.join(options.INPUT_DIR, v["task_info"]["input_files"][v["input_index"]]["file_name"])
-                )
+                source_input_file = v["task_info"]["input_files"][v["input_index"]]
+                input_file = str(os.path.join(options.INPUT_DIR, source_input_file["file_name"]))
                 if not os.path.exists(input_file):
                     raise RuntimeError(
                         f"Bad flow, file from task_id=`{v['task_id']}`, index=`{v['input_index']}` not found."
                     )
-                file_name = f"{task_id}_{param_name}" + Path(input_file).suffix
+                file_name = f"{task_subdir}/{task_id}_{param_name}" + Path(input_file).suffix
                 result_path = os.path.join(options.INPUT_DIR, file_name)
-                shutil.copy(input_file, result_path)
+                link_input_file(input_file, result_path)
+                stored_name = source_input_file.get("stored_name", "")
             elif "node_id" in v:
                 input_file = ""
                 result_prefix = f"{v['task_id']}_{v['node_id']}_"
-                visionatrix_output_dir = os.path.join(options.OUTPUT_DIR, "visionatrix")
-                for filename in os.listdir(visionatrix_output_dir):
+                for filename, file_path in get_task_files(v["task_id"], "output"):
                     if filename.startswith(result_prefix):
-                        input_file = os.path.join(visionatrix_output_dir, filename)
+                        input_file = file_path
                         break
                 if not input_file or not os.path.exists(input_file):
                     raise RuntimeError(
                         f"Bad flow, file from task_id=`{v['task_id']}`, node_id={v['node_id']} not found."
                     )
-                file_name = f"{task_id}_{param_name}" + Path(input_file).suffix
+                file_name = f"{task_subdir}/{task_id}_{param_name}" + Path(input_file).suffix
                 result_path = os.path.join(options.INPUT_DIR, file_name)
-                shutil.copy(input_file, result_path)
+                link_input_file(input_file, result_path)
             elif "file_content" in v:
-                file_name = f"{task_id}_{param_name}" + Path(v["remote_url"]).suffix
+                file_name = f"{task_subdir}/{task_id}_{param_name}" + Path(v["remote_url"]).suffix
                 result_path = os.path.join(options.INPUT_DIR, file_name)
-                with builtins.open(result_path, mode="wb") as fp:
-                    fp.write(v["file_content"])
+                if param_name in stored_files:
+                    stored_path, stored_name = stored_files[param_name]
+                    link_input_file(stored_path, result_path)
+                else:
+                    stored_name = store_input_bytes(v["file_content"], Path(file_name).suffix, result_path)
+                    stored_files[param_name] = (result_path, stored_name)
             else:
                 raise RuntimeError(
                     f"Bad flow, `input_index`, `node_id` or `file_content` "
                     f"should be present for '{param_name}' parameter."
                 )
         else:
-            file_name = f"{task_id}_{param_name}" + Path(v.filename).suffix
+            file_name = f"{task_subdir}/{task_id}_{param_name}" + Path(v.filename).suffix
             result_path = os.path.join(options.INPUT_DIR, file_name)
-            with builtins.open(result_path, mode="wb") as fp:
-                v.file.seek(0)
-                start_of_file = v.file.read(30)
-                base64_index = start_of_file.find(b"base64,")
-                if base64_index != -1:
-                    v.file.seek(base64_index + len(b"base64,"))
-                    fp.write(b64decode(v.file.read()))
-                else:
-                    v.file.seek(0)
-                    shutil.copyfileobj(v.file, fp)
+            if param_name in stored_files:
+                stored_path, stored_name = stored_files[param_name]
+                link_input_file(stored_path, result_path)
+            else:
+                stored_name = store_input_upload(v, Path(file_name).suffix, result_path)
+                stored_files[param_name] = (result_path, stored_name)
         for k, input_path in flow_input_file_params[param_name]["comfy_node_id"].items():
             node = r.get(k, {})
             if not node:
                 raise RuntimeError(f"Bad workflow, node with id=`{k}` can not be found.")
             set_node_value(node, input_path, file_name)
-        task_details["input_files"].append({"file_name": file_name, "file_size": os.path.getsize(result_path)})
+        input_file_details = {"file_name": file_name, "file_size": os.path.getsize(result_path)}
+        if stored_name:
+            input_file_details["stored_name"] = stored_name
+        task_details["input_files"].append(input_file_details)
 
     for node_to_disconnect in flow_input_file_params.values():
         if node_to_disconnect["name"] not in in_files_params:
             for node_id_to_disconnect in node_to_disconnect["comfy_node_id"]:
-                disconnect_node_graph(node_id_to_disconnect, r)
+                disconnect_node_graph(node_id_to_disconnect, r, consumers)
 
 
-def disconnect_node_graph(node_id: str, flow_comfy: dict[str, dict]) -> None:
+def disconnect_node_graph(node_id: str, flow_comfy: dict[str, dict], consumers: NodesConsumers | None = None) -> None:
     """Disconnects a node from the graph.
     If the node has exactly one surviving input, it attempts to re-wire graph to bypass the removed node.
     Otherwise, it disconnects the node and recursively removes dependent nodes that have required inputs.
+
+    `consumers` is the index of the graph edges, it is updated together with the graph and can be reused.
     """
     node_to_remove = flow_comfy.get(node_id)
     if not node_to_remove:
         return
+    if consumers is None:
+        consumers = NodesConsumers(flow_comfy)
     nodes_class_mappings = get_node_class_mappings()
 
     surviving_inputs = [details for details in node_to_remove.get("inputs", {}).values() if isinstance(details, list)]
@@ -521,14 +596,11 @@ def disconnect_node_graph(node_id: str, flow_comfy: dict[str, dict]) -> None:
             replacement_connection = None
 
     next_nodes_to_disconnect = []
-    for next_node_id, next_node_details in flow_comfy.items():
-        if next_node_id == node_id:
+    for next_node_id in consumers.get(node_id):
+        next_node_details = flow_comfy.get(next_node_id)
+        if next_node_id == node_id or next_node_details is None:
             continue
-        node_class_input_types = None
-        if class_type := next_node_details.get("class_type"):
-            node_class_mapping = nodes_class_mappings.get(class_type)
-            if node_class_mapping and hasattr(node_class_mapping, "INPUT_TYPES"):
-                node_class_input_types = node_class_mapping.INPUT_TYPES()
+        node_class_input_types = get_node_input_types(nodes_class_mappings, next_node_details.get("class_type"))
 
         inputs_to_pop = []
         for input_name, input_details in next_node_details.get("inputs", {}).items():
@@ -538,6 +610,7 @@ def disconnect_node_graph(node_id: str, flow_comfy: dict[str, dict]) -> None:
                 )
                 if replacement_connection and param_input_type in ("*", replacement_node_return_type):
                     next_node_details["inputs"][input_name] = replacement_connection
+                    consumers.add(str(replacement_connection[0]), next_node_id)
                 else:
                     inputs_to_pop.append(input_name)
 
@@ -552,7 +625,7 @@ def disconnect_node_graph(node_id: str, flow_comfy: dict[str, dict]) -> None:
 
     flow_comfy.pop(node_id)
     for i in next_nodes_to_disconnect:
-        disconnect_node_graph(i, flow_comfy)
+        disconnect_node_graph(i, flow_comfy, consumers)
 
 
 def get_node_parameter_input_type(input_types: dict[str, typing.Any], parameter_name: str) -> str:
@@ -584,9 +657,9 @@ def flow_prepare_output_params(
                 f"class_type={r_node['class_type']}: only {supported_outputs} nodes are supported currently as outputs"
             )
         if r_node["class_type"] == "SaveText|pysssss":
-            r_node["inputs"]["file"] = f"visionatrix/{task_id}_{param}_.txt"
+            r_node["inputs"]["file"] = f"visionatrix/{get_task_subdir(task_id)}/{task_id}_{param}_.txt"
         else:
-            r_node["inputs"]["filename_prefix"] = f"visionatrix/{task_id}_{param}"
+            r_node["inputs"]["filename_prefix"] = f"visionatrix/{get_task_subdir(task_id)}/{task_id}_{param}"
         task_details["outputs"].append(
             {
                 "comfy_node_id": int(param),
@@ -597,19 +670,14 @@ def flow_prepare_output_params(
         )
 
 
-def process_seed_value(flow: Flow, in_texts_params: dict, flow_comfy: dict[str, dict]) -> None:
+def process_seed_value(
+    flow: Flow, in_texts_params: dict, flow_comfy: dict[str, dict], seed_paths: list[tuple[str, str]]
+) -> None:
     if "seed" in [i["name"] for i in flow.input_params]:
         return  # skip automatic processing of "seed" if it was manually defined in "flow.json"
     random_seed = in_texts_params.get("seed", random.randint(1, 2147483647))
-    for node_details in flow_comfy.values():
-        if "inputs" in node_details:
-            if "seed" in node_details["inputs"]:
-                node_details["inputs"]["seed"] = random_seed
-            elif (
-                node_details["class_type"] in ("SamplerCustom", "RandomNoise", "KSamplerAdvanced")
-                and "noise_seed" in node_details["inputs"]
-            ):
-                node_details["inputs"]["noise_seed"] = random_seed
+    for node_id, input_name in seed_paths:
+        flow_comfy[node_id]["inputs"][input_name] = random_seed
     in_texts_params["seed"] = random_seed
 
 
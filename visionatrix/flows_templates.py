@@ -0,0 +1,136 @@
+import typing
+from collections.abc import Iterable
+from copy import deepcopy
+
+from .pydantic_models import Flow
+
+SEED_NOISE_CLASSES = ("SamplerCustom", "RandomNoise", "KSamplerAdvanced")
+"""Classes of nodes that have the `noise_seed` input which should be set to the task seed."""
+
+NODES_INPUT_TYPES: dict[str, dict[str, dict[str, tuple[str]]]] = {}
+"""Names and types of the inputs of nodes classes, from `INPUT_TYPES()` of the classes."""
+
+
+class NodesConsumers:
+    """Reverse edges of the ComfyUI graph: for each node, the nodes that have inputs connected to its outputs.
+
+    The index can only have extra edges, so users of it should check that the consumer is still connected.
+    """
+
+    def __init__(self, flow_comfy: dict[str, dict]):
+        self.positions = {k: i for i, k in enumerate(flow_comfy)}
+        consumers: dict[str, set[str]] = {}
+        for node_id, node_details in flow_comfy.items():
+            for input_details in node_details.get("inputs", {}).values():
+                if isinstance(input_details, list) and input_details:
+                    consumers.setdefault(str(input_details[0]), set()).add(node_id)
+        self.consumers = {k: frozenset(v) for k, v in consumers.items()}
+
+    def copy(self) -> "NodesConsumers":
+        r = NodesConsumers({})
+        r.positions = self.positions
+        r.consumers = self.consumers.copy()
+        return r
+
+    def get(self, node_id: str) -> list[str]:
+        """Returns consumers of the node in the order of nodes in the graph."""
+        return sorted(self.consumers.get(node_id, ()), key=lambda x: self.positions.get(x, len(self.positions)))
+
+    def add(self, node_id: str, consumer_id: str) -> None:
+        self.consumers[node_id] = self.consumers.get(node_id, frozenset()) | {consumer_id}
+
+
+class FlowTemplate:
+    """Installed ComfyUI flow compiled once for task creation.
+
+    The base graph is shared between tasks and is not modified by the task creation. Each task gets a new top-level
+    dict where only the nodes that can be changed during the task creation are deep copies, others are taken as is.
+    """
+
+    def __init__(
+        self,
+        flow: Flow,
+        flow_comfy: dict[str, dict],
+        text_types: list[str],
+        file_types: list[str],
+        outputs_classes: Iterable[str],
+    ):
+        self.base = flow_comfy
+        self.inputs_patches: list[tuple[dict, list[tuple[str, list]]]] = [
+            (i, list(i["comfy_node_id"].items())) for i in flow.input_params if i["type"] in text_types
+        ]
+        self.seed_paths: list[tuple[str, str]] = get_seed_paths(flow, flow_comfy)
+        self.consumers = NodesConsumers(flow_comfy)
+        files_params = [i for i in flow.input_params if i["type"] in file_types]
+        self.disconnect_nodes: dict[str, frozenset[str]] = {
+            i["name"]: get_dependent_nodes(list(i["comfy_node_id"]), self.consumers) for i in files_params
+        }
+        self.patched_nodes = frozenset(
+            [k for _, patches in self.inputs_patches for k, _ in patches]
+            + [k for k, _ in self.seed_paths]
+            + [k for i in files_params for k in i["comfy_node_id"]]
+            + [k for k, v in flow_comfy.items() if v.get("class_type") in outputs_classes]
+        )
+
+    def is_compiled_from(self, flow_comfy: dict[str, dict]) -> bool:
+        return len(self.base) == len(flow_comfy) and all(self.base.get(k) is v for k, v in flow_comfy.items())
+
+    def materialize(self, files_params_names: Iterable[str]) -> dict[str, dict]:
+        """Returns the graph for a new task: copies of the patched and output nodes, and of the nodes that are
+        changed when the nodes of the missing file parameters are disconnected."""
+        nodes_to_copy = set(self.patched_nodes)
+        files_params_names = set(files_params_names)
+        for param_name, dependent_nodes in self.disconnect_nodes.items():
+            if param_name not in files_params_names:
+                nodes_to_copy.update(dependent_nodes)
+        return {k: deepcopy(v) if k in nodes_to_copy else v for k, v in self.base.items()}
+
+
+def get_seed_paths(flow: Flow, flow_comfy: dict[str, dict]) -> list[tuple[str, str]]:
+    """Returns `(node_id, input_name)` of inputs that get a random seed when the flow does not define `seed` itself."""
+    if "seed" in [i["name"] for i in flow.input_params]:
+        return []
+    r = []
+    for node_id, node_details in flow_comfy.items():
+        if "inputs" in node_details:
+            if "seed" in node_details["inputs"]:
+                r.append((node_id, "seed"))
+            elif node_details["class_type"] in SEED_NOISE_CLASSES and "noise_seed" in node_details["inputs"]:
+                r.append((node_id, "noise_seed"))
+    return r
+
+
+def get_dependent_nodes(nodes_ids: list[str], consumers: NodesConsumers) -> frozenset[str]:
+    """Returns the nodes and all the nodes that are connected to their outputs directly or through other nodes."""
+    r = set()
+    nodes_to_visit = list(nodes_ids)
+    while nodes_to_visit:
+        node_id = nodes_to_visit.pop()
+        if node_id not in r:
+            r.add(node_id)
+            nodes_to_visit.extend(consumers.consumers.get(node_id, ()))
+    return frozenset(r)
+
+
+def get_node_input_types(
+    nodes_class_mappings: dict[str, typing.Any], class_type: str | None
+) -> dict[str, dict[str, tuple[str]]] | None:
+    """Returns `INPUT_TYPES()` of the node class with only the type names kept, the result is cached per class.
+
+    Lists of values of the combo inputs can change, so for them the type is an empty string.
+    Sections that are subclasses of `dict` (e.g. flexible inputs accepting any name) are kept as they are,
+    as their lookups can not be reproduced by a plain dictionary.
+    """
+    if class_type in NODES_INPUT_TYPES:
+        return NODES_INPUT_TYPES[class_type]
+    node_class_mapping = nodes_class_mappings.get(class_type)
+    if not node_class_mapping or not hasattr(node_class_mapping, "INPUT_TYPES"):
+        return None
+    r = {}
+    for section, inputs in node_class_mapping.INPUT_TYPES().items():
+        if type(inputs) is dict:  # pylint: disable=unidiomatic-typecheck
+            r[section] = {k: (v[0] if v and isinstance(v[0], str) else "",) for k, v in inputs.items()}
+        elif isinstance(inputs, dict):
+            r[section] = inputs
+    NODES_INPUT_TYPES[class_type] = r
+    return r
@@ -0,0 +1,124 @@
+import builtins
+import contextlib
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from base64 import b64decode
+
+from starlette.datastructures import UploadFile as StarletteUploadFile
+
+from . import options
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LOGGER = logging.getLogger("visionatrix")
+
+INPUTS_STORE_DIR_NAME = ".vix_store"
+"""Directory inside `INPUT_DIR` with the input files named by the SHA-256 of their content."""
+INPUTS_STORE_LOCK = threading.Lock()
+INPUTS_STORE_LOCK_FILE_NAME = ".lock"
+"""File in the inputs store locked while files are added to or removed from it, to sync the server processes."""
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def get_inputs_store_dir() -> str:
+    r = os.path.join(options.INPUT_DIR, INPUTS_STORE_DIR_NAME)
+    os.makedirs(r, exist_ok=True)
+    return r
+
+
+def store_input_bytes(data: bytes, suffix: str, result_path: str) -> str:
+    """Writes the content to the inputs store, if it is not there yet, and links it as `result_path`.
+
+    Returns the name of the file in the store, that should be passed to `release_inputs_files` when the task
+    is removed, or an empty string if the file system does not support hard links and the file was copied.
+    """
+    with tempfile.NamedTemporaryFile(dir=get_inputs_store_dir(), suffix=".tmp", delete=False) as fp:
+        fp.write(data)
+    return __store_and_link(fp.name, hashlib.sha256(data).hexdigest() + suffix, result_path)
+
+
+def store_input_upload(upload_file: StarletteUploadFile, suffix: str, result_path: str) -> str:
+    """Same as `store_input_bytes`, but for the uploaded file which content can also be a base64 `data:` URL."""
+    upload_file.file.seek(0)
+    start_of_file = upload_file.file.read(30)
+    base64_index = start_of_file.find(b"base64,")
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=get_inputs_store_dir(), suffix=".tmp", delete=False) as fp:
+        if base64_index != -1:
+            upload_file.file.seek(base64_index + len(b"base64,"))
+            data = b64decode(upload_file.file.read())
+            digest.update(data)
+            fp.write(data)
+        else:
+            upload_file.file.seek(0)
+            while chunk := upload_file.file.read(COPY_CHUNK_SIZE):
+                digest.update(chunk)
+                fp.write(chunk)
+    return __store_and_link(fp.name, digest.hexdigest() + suffix, result_path)
+
+
+def link_input_file(source_path: str, result_path: str) -> None:
+    """Creates `result_path` with the content of the `source_path` without copying it, if the file system allows."""
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(result_path)
+    try:
+        os.link(source_path, result_path)
+    except OSError:
+        shutil.copy(source_path, result_path)
+
+
+def release_inputs_files(stored_names: set[str]) -> None:
+    """Removes files from the inputs store that are no longer linked to the inputs of any task.
+
+    Should be called after the inputs of tasks are removed, with the `stored_name` of their input files.
+    """
+    if not stored_names:
+        return
+    store_dir = get_inputs_store_dir()
+    with __inputs_store_lock():
+        for stored_name in stored_names:
+            stored_path = os.path.join(store_dir, os.path.basename(stored_name))
+            try:
+                if os.stat(stored_path).st_nlink == 1:
+                    os.remove(stored_path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                LOGGER.warning("Can not remove `%s` from the inputs store: %s", stored_path, e)
+
+
+@contextlib.contextmanager
+def __inputs_store_lock():
+    """Serializes changes of the inputs store between threads and, where `fcntl` is available, between processes."""
+    with INPUTS_STORE_LOCK:
+        if fcntl is None:
+            yield
+            return
+        with builtins.open(os.path.join(get_inputs_store_dir(), INPUTS_STORE_LOCK_FILE_NAME), "ab") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def __store_and_link(temp_path: str, stored_name: str, result_path: str) -> str:
+    stored_path = os.path.join(get_inputs_store_dir(), stored_name)
+    with __inputs_store_lock():
+        try:
+            link_input_file(stored_path, result_path)
+            os.remove(temp_path)
+        except FileNotFoundError:  # not stored yet, or removed by a process that does not share the lock
+            os.replace(temp_path, stored_path)
+            link_input_file(stored_path, result_path)
+        if os.stat(stored_path).st_nlink == 1:  # file system without hard links, the file was copied
+            os.remove(stored_path)
+            return ""
+    return stored_name
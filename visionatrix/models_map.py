@@ -1,7 +1,10 @@
 import builtins
+import collections
 import json
 import logging
 import re
+import threading
+from copy import deepcopy
 from pathlib import Path
 from urllib.parse import urlparse
 
@@ -236,10 +239,72 @@ MODEL_LOAD_CLASSES = {
     },
 }
 MODELS_CATALOG: dict[str, dict] = {}
+MODELS_CATALOG_INDEX: "ModelsCatalogIndex | None" = None
+
+FLOWS_MODELS_PLANS_LIMIT = 256
+FLOWS_MODELS_PLANS: collections.OrderedDict[str, tuple[list[AIResourceModel], list[tuple[str, list, str]]]] = (
+    collections.OrderedDict()
+)
+"""Resolved models of flows and the filenames to set in their loader nodes, keyed by the loader nodes of the flow
+and the installed models, least recently used plans are removed first."""
+FLOWS_MODELS_PLANS_LOCK = threading.Lock()
 
 
 def process_flow_models(
     flow_comfy: dict[str, dict], remap_data: dict[str, ModelProgressInstall]
+) -> list[AIResourceModel]:
+    """Returns the models used by the flow, sets filenames of the installed models in the loader nodes if
+    `remap_data` is provided. Models are resolved only once for each set of loader nodes and installed models."""
+    plan_key = get_flow_models_plan_key(flow_comfy, remap_data)
+    with FLOWS_MODELS_PLANS_LOCK:
+        plan = FLOWS_MODELS_PLANS.get(plan_key)
+        if plan is not None:
+            FLOWS_MODELS_PLANS.move_to_end(plan_key)
+    if plan is None:
+        plan = __build_flow_models_plan(flow_comfy, remap_data)
+        with FLOWS_MODELS_PLANS_LOCK:
+            FLOWS_MODELS_PLANS[plan_key] = plan
+            while len(FLOWS_MODELS_PLANS) > FLOWS_MODELS_PLANS_LIMIT:
+                FLOWS_MODELS_PLANS.popitem(last=False)
+    models_info, substitutions = plan
+    for node_id, path, model_filename in substitutions:
+        set_node_value(flow_comfy[node_id], path, model_filename)
+    return [i.model_copy() for i in models_info]
+
+
+def get_flow_models_plan_key(flow_comfy: dict[str, dict], remap_data: dict[str, ModelProgressInstall]) -> str:
+    """Key of everything that models resolution depends on: classes of nodes, values of model inputs,
+    embedded models catalog and filenames of the installed models."""
+    nodes = []
+    for node_id, node_details in flow_comfy.items():
+        class_type = node_details.get("class_type")
+        if node_details.get("_meta", {}).get("title", "") == "WF_MODELS":
+            nodes.append((node_id, class_type, [node_details["inputs"]["text"]]))
+        elif load_class := MODEL_LOAD_CLASSES.get(class_type):
+            nodes.append((node_id, class_type, [get_node_value(node_details, i["path"]) for i in load_class.values()]))
+        else:
+            nodes.append((node_id, class_type, []))
+    installed_models = sorted((k, v.filename) for k, v in remap_data.items())
+    return json.dumps([nodes, installed_models], default=str)
+
+
+def __build_flow_models_plan(
+    flow_comfy: dict[str, dict], remap_data: dict[str, ModelProgressInstall]
+) -> tuple[list[AIResourceModel], list[tuple[str, list, str]]]:
+    loaders_nodes = {k for k, v in flow_comfy.items() if v.get("class_type") in MODEL_LOAD_CLASSES}
+    flow_comfy_copy = {k: deepcopy(v) if k in loaders_nodes else v for k, v in flow_comfy.items()}
+    models_info = __resolve_flow_models(flow_comfy_copy, remap_data)
+    substitutions = []
+    for node_id in loaders_nodes:
+        for node_model_load_info in MODEL_LOAD_CLASSES[flow_comfy[node_id]["class_type"]].values():
+            model_filename = get_node_value(flow_comfy_copy[node_id], node_model_load_info["path"])
+            if model_filename != get_node_value(flow_comfy[node_id], node_model_load_info["path"]):
+                substitutions.append((node_id, node_model_load_info["path"], model_filename))
+    return models_info, substitutions
+
+
+def __resolve_flow_models(
+    flow_comfy: dict[str, dict], remap_data: dict[str, ModelProgressInstall]
 ) -> list[AIResourceModel]:
     nodes_with_models = {}
     for key, value in BASIC_NODE_LIST.items():
@@ -248,8 +313,7 @@ def process_flow_models(
             nodes_with_models[key] = value["models"]
     nodes_class_mappings = get_node_class_mappings()
 
-    models_catalog = get_united_model_catalog(flow_comfy)
-    simple_model_load_classes = get_simple_model_load_classes(models_catalog)
+    catalog_index = get_models_catalog_index(flow_comfy)
     models_info: list[AIResourceModel] = []
     for node_details in flow_comfy.values():
         class_type = node_details.get("class_type")
@@ -261,19 +325,16 @@ def process_flow_models(
                 if node_model_info.name not in [i.name for i in models_info]:
                     models_info.append(node_model_info)
 
-        simple_loader = False
-        for i, v in simple_model_load_classes.items():
-            if re.match(i, class_type) is not None:
-                simple_loader_class_model_name = v
-                if simple_loader_class_model_name not in [i.name for i in models_info]:
-                    models_info.append(
-                        AIResourceModel(
-                            **models_catalog[simple_loader_class_model_name],
-                            name=simple_loader_class_model_name,
-                        )
+        simple_loader_models = catalog_index.get_simple_loader_models(class_type)
+        for simple_loader_class_model_name in simple_loader_models:
+            if simple_loader_class_model_name not in [i.name for i in models_info]:
+                models_info.append(
+                    AIResourceModel(
+                        **catalog_index.get_model_details(simple_loader_class_model_name),
+                        name=simple_loader_class_model_name,
                     )
-                simple_loader = True
-        if simple_loader:
+                )
+        if simple_loader_models:
             continue
 
         if (load_class := MODEL_LOAD_CLASSES.get(class_type)) is None:
@@ -283,19 +344,11 @@ def process_flow_models(
             if node_input_model_name in (None, "None"):
                 continue
             not_found = True
-            for model, model_details in models_catalog.items():
-                model_types = model_details.get("types")
-                node_model_type = node_model_load_info.get("type")
-                if model_types and node_model_type:
-                    if isinstance(node_model_type, str):
-                        if node_model_type not in model_types:
-                            continue
-                    elif isinstance(node_model_type, list) and not any(
-                        ntype in model_types for ntype in node_model_type
-                    ):
-                        continue
+            for model, model_details, regexes in catalog_index.get_candidates(
+                node_input_model_name, node_model_load_info.get("type")
+            ):
                 if match_replace_model(
-                    model, model_details, node_input_model_name, node_details, node_model_load_info, remap_data
+                    model, model_details, regexes, node_input_model_name, node_details, node_model_load_info, remap_data
                 ):
                     if model not in [i.name for i in models_info]:
                         models_info.append(AIResourceModel(**model_details, name=model))
@@ -316,16 +369,17 @@ def get_united_model_catalog(flow_comfy: dict[str, dict]) -> dict[str, dict]:
 def match_replace_model(
     model: str,
     model_details: dict,
+    regexes: list[dict[str, re.Pattern]],
     node_input_model_name: str,
     node_details: dict,
     node_model_load_info: dict[str, str | list[str] | bool],
     remap_data: dict[str, ModelProgressInstall],
 ) -> bool:
-    for regex in model_details["regexes"]:
+    for regex in regexes:
         node_model_load_path = node_model_load_info["path"]
-        _input_value = "input_value" not in regex or re.match(regex["input_value"], node_input_model_name) is not None
-        _input_name = "input_name" not in regex or re.match(regex["input_name"], node_model_load_path[-1]) is not None
-        _class_name = "class_name" not in regex or re.match(regex["class_name"], node_details["class_type"]) is not None
+        _input_value = "input_value" not in regex or regex["input_value"].match(node_input_model_name) is not None
+        _input_name = "input_name" not in regex or regex["input_name"].match(node_model_load_path[-1]) is not None
+        _class_name = "class_name" not in regex or regex["class_name"].match(node_details["class_type"]) is not None
         if _input_value and _input_name and _class_name:
             if node_model_load_info.get("preset"):
                 return True
@@ -382,6 +436,128 @@ def get_models_catalog() -> dict[str, dict]:
     return MODELS_CATALOG
 
 
+def get_models_catalog_index(flow_comfy: dict[str, dict]) -> "ModelsCatalogIndex":
+    """Returns the index of the models catalog united with the catalog embedded in the flow."""
+    global MODELS_CATALOG_INDEX
+
+    models_catalog = get_models_catalog()
+    if MODELS_CATALOG_INDEX is None or len(MODELS_CATALOG_INDEX.records) != len(models_catalog):
+        MODELS_CATALOG_INDEX = ModelsCatalogIndex(models_catalog)
+    if embedded_models_catalog := get_embedded_models_catalog(flow_comfy):
+        return ModelsCatalogIndex(embedded_models_catalog, MODELS_CATALOG_INDEX)
+    return MODELS_CATALOG_INDEX
+
+
+class ModelsCatalogIndex:
+    """Compiled regexes of the models catalog records, grouped to check only the records that can match the input.
+
+    Records whose regexes all match the input value literally (like `^model\\.safetensors$`) are found by the exact
+    value, other records are grouped by the model types. The `base` index is used for the records that are not
+    overridden by this one, as the catalog embedded into the flow overrides records of the main catalog.
+    """
+
+    def __init__(self, models_catalog: dict[str, dict], base: "ModelsCatalogIndex | None" = None):
+        self.base = base
+        self.records: dict[str, tuple[int, dict, list[dict[str, re.Pattern]]]] = {}
+        """Model name => (position in the catalog, model details, compiled regexes)"""
+        self.exact_values: dict[str, list[str]] = {}
+        self.patterns_by_type: dict[str | None, list[str]] = {}
+        """Model type => names of models matched by patterns, `None` for the models without types."""
+        self.simple_loaders: list[tuple[int, re.Pattern, str]] = []
+        self.simple_loaders_by_class: dict[str, list[str]] = {}
+        next_position = len(base.records) if base else 0
+        for model_name, model_details in models_catalog.items():
+            if base and model_name in base.records:
+                position = base.records[model_name][0]
+            else:
+                position = next_position
+                next_position += 1
+            regexes = [{k: re.compile(v) for k, v in i.items()} for i in model_details.get("regexes", [])]
+            self.records[model_name] = (position, model_details, regexes)
+            if regexes and all(len(i) == 1 and "class_name" in i for i in regexes):
+                self.simple_loaders.extend((position, i["class_name"], model_name) for i in regexes)
+            exact_values = [
+                get_literal_value(i["input_value"].pattern) if "input_value" in i else None for i in regexes
+            ]
+            if regexes and None not in exact_values:
+                for value in set(exact_values):
+                    self.exact_values.setdefault(value, []).append(model_name)
+            else:
+                for model_type in model_details.get("types") or [None]:
+                    self.patterns_by_type.setdefault(model_type, []).append(model_name)
+        if base:
+            self.simple_loaders += [i for i in base.simple_loaders if i[2] not in self.records]
+            self.simple_loaders.sort(key=lambda x: x[0])
+
+    def get_model_details(self, model_name: str) -> dict:
+        if model_name in self.records:
+            return self.records[model_name][1]
+        return self.base.get_model_details(model_name)
+
+    def get_simple_loader_models(self, class_type: str) -> list[str]:
+        """There are classes of nodes that are tightly tied to models, without the ability to change or select them.
+        In the model catalog such records only have a "class_name" without an "input_value" or "input_name".
+
+        Returns the models of the node if it is such a simple loader.
+        """
+        if class_type not in self.simple_loaders_by_class:
+            simple_load_classes = {i[1]: i[2] for i in self.simple_loaders}  # later records override earlier ones
+            self.simple_loaders_by_class[class_type] = [
+                v for k, v in simple_load_classes.items() if k.match(class_type) is not None
+            ]
+        return self.simple_loaders_by_class[class_type]
+
+    def get_candidates(
+        self, input_value: str, node_model_type: str | list[str] | None
+    ) -> list[tuple[str, dict, list[dict[str, re.Pattern]]]]:
+        """Returns records in the catalog order that can match the value of the loader input of the given types."""
+        r = self.find_records(input_value, node_model_type)
+        if self.base:
+            r += [i for i in self.base.find_records(input_value, node_model_type) if i[1] not in self.records]
+        r.sort(key=lambda x: x[0])
+        return [(i[1], i[2], i[3]) for i in r]
+
+    def find_records(self, input_value: str, node_model_type: str | list[str] | None) -> list[tuple]:
+        """Same as `get_candidates`, but only for the records of this index, unsorted and with positions."""
+        node_model_types = [node_model_type] if isinstance(node_model_type, str) else node_model_type
+        models_names = set(self.exact_values.get(input_value, [])) if isinstance(input_value, str) else set()
+        if node_model_types:
+            for model_type in [None, *node_model_types]:
+                models_names.update(self.patterns_by_type.get(model_type, []))
+        else:
+            for i in self.patterns_by_type.values():
+                models_names.update(i)
+        r = []
+        for model_name in models_names:
+            position, model_details, regexes = self.records[model_name]
+            model_types = model_details.get("types")
+            if model_types and node_model_types and not any(i in model_types for i in node_model_types):
+                continue
+            r.append((position, model_name, model_details, regexes))
+        return r
+
+
+def get_literal_value(pattern: str) -> str | None:
+    """Returns the string matched by `re.match` with the pattern if it matches only this string, otherwise None."""
+    if not pattern.endswith("$") or pattern.endswith("\\$"):
+        return None
+    r = []
+    escaped = False
+    for char in pattern[1:-1] if pattern.startswith("^") else pattern[:-1]:
+        if escaped:
+            if char.isalnum():
+                return None  # `\d`, `\w`, etc.
+            r.append(char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char in ".^$*+?{}[]|()":
+            return None
+        else:
+            r.append(char)
+    return None if escaped else "".join(r)
+
+
 def get_formatted_models_catalog() -> list[AIResourceModel]:
     r = []
     for model, model_details in get_models_catalog().items():
@@ -439,28 +615,6 @@ def get_possible_final_paths_for_model(
     return [x.joinpath(y) for x, y in get_possible_paths_for_model(model)]
 
 
-def get_simple_model_load_classes(models_catalog: dict[str, dict]) -> dict[str, str]:
-    """
-    There are classes of nodes that are tightly tied to models, without the ability to change or select them.
-    In the model catalog such records only have a "class_name" without an "input_value" or "input_name".
-
-    Returns a dictionary with regular expressions to determine by "class_type" whether the node is a simple loader.
-    """
-    simple_load_classes = {}
-    for model_name, model_details in models_catalog.items():
-        if "regexes" in model_details:
-            simple_loader = True
-            for i in model_details["regexes"]:
-                if len(i.keys()) != 1 or "class_name" not in i:
-                    simple_loader = False
-                    break
-            if not simple_loader:
-                continue
-            for i in model_details["regexes"]:
-                simple_load_classes[i["class_name"]] = model_name
-    return simple_load_classes
-
-
 def get_embedded_models_catalog(flow_comfy: dict[str, dict]) -> dict[str, dict]:
     for node_details in flow_comfy.values():
         if node_details.get("_meta", {}).get("title", "") == "WF_MODELS":  # Text Multiline
@@ -58,6 +58,16 @@ WORKER_AUTH = environ.get("WORKER_AUTH", "admin:admin")
 """Only for WORKER in the `Worker to Server` mode."""
 WORKER_NET_TIMEOUT = float(environ.get("WORKER_NET_TIMEOUT", "15.0"))
 """Only for WORKER in the `Worker to Server` mode."""
+MAX_WORKER_TASK_WAIT = 60.0
+"""Maximum value of the `wait` parameter accepted by the Server in the requests for the next tasks."""
+WORKER_TASK_WAIT = min(float(environ.get("WORKER_TASK_WAIT", "20.0")), MAX_WORKER_TASK_WAIT)
+"""Only for WORKER in the `Worker to Server` mode. How long (in seconds) the Server can hold the request for the next
+task when there are no tasks for the Worker. Set to `0` to disable long polling, values above 60 are reduced to 60."""
+VIX_WORKER_DEVICES = environ.get("VIX_WORKER_DEVICES", "")
+"""Only for WORKER mode. Comma-separated list of device indexes, for example `0,1,2,3`, to run a worker on each of them.
+
+ComfyUI keeps the active device and the loaded models in process-wide state, so each worker runs in its own process
+with `CUDA_VISIBLE_DEVICES` set to its device. They are started and restarted by the process that was launched."""
 VIX_SERVER_WORKERS = int(environ.get("VIX_SERVER_WORKERS", "1"))
 """Only for SERVER mode. How many Server instances should be spawned(using uvicorn)."""
 VIX_SERVER_FULL_MODELS = environ.get("VIX_SERVER_FULL_MODELS", "0")
@@ -101,6 +111,63 @@ MIN_PAUSE_INTERVAL = float(environ.get("MIN_PAUSE_INTERVAL", "0.1"))
 MAX_PAUSE_INTERVAL = float(environ.get("MAX_PAUSE_INTERVAL", "1.0"))
 """Maximum wait time (in seconds) between polling for the next task. Increased in steps when no tasks are available."""
 
+TASKS_POLL_FALLBACK_INTERVAL = float(environ.get("TASKS_POLL_FALLBACK_INTERVAL", "5.0"))
+"""Wait time (in seconds) between fallback polls for the next task when the executor is woken up by notifications.
+
+Used in `DEFAULT` mode and in `WORKER` mode connected directly to PostgreSQL (LISTEN/NOTIFY),
+the polling then only covers tasks added by processes that could not deliver a notification.
+"""
+
+TASK_WAIT_POLL_INTERVAL = float(environ.get("TASK_WAIT_POLL_INTERVAL", "2.0"))
+"""Wait time (in seconds) between fallback polls of the task state for requests waiting for the task to finish.
+
+Such requests are woken up on updates of the task, the polling only covers updates from processes that could not
+deliver a notification, e.g. workers connected directly to the SQLite database.
+"""
+
+TASK_LEASE_TTL = float(environ.get("TASK_LEASE_TTL", "180.0"))
+"""Time (in seconds) for which the task lock is valid without renewal.
+
+Workers renew locks of their tasks while executing them, tasks with expired locks are returned to the queue.
+"""
+TASK_LEASE_MAX_EXPIRATIONS = int(environ.get("TASK_LEASE_MAX_EXPIRATIONS", "3"))
+"""How many times a task lock can expire before the task is marked as failed instead of being returned to the queue."""
+
+TASK_PROGRESS_MIN_INTERVAL = float(environ.get("TASK_PROGRESS_MIN_INTERVAL", "1.0"))
+"""Minimum time (in seconds) between two reports of the task progress, intermediate changes are coalesced."""
+TASK_PROGRESS_MIN_DELTA = float(environ.get("TASK_PROGRESS_MIN_DELTA", "0.5"))
+"""Minimum change of the task progress (in percent) worth reporting.
+
+Finish, error and interruption of the task are always reported immediately.
+"""
+
+FLOW_DEFAULT_PEAK_MEMORY = float(environ.get("FLOW_DEFAULT_PEAK_MEMORY", "0"))
+"""Peak GPU memory usage (in MB) assumed for flows without recorded execution profiles.
+
+Workers with less VRAM than the peak memory usage of a flow do not receive its tasks,
+unless none of the active workers has enough VRAM for it.
+`0` disables the check for flows that were never profiled.
+"""
+
+TASKS_PRIORITY_AGING_SLOPE = float(environ.get("TASKS_PRIORITY_AGING_SLOPE", "0"))
+"""How much the effective priority of a waiting task grows per hour of waiting. `0` disables priority aging."""
+TASKS_PRIORITY_AGING_MAX = float(environ.get("TASKS_PRIORITY_AGING_MAX", "8"))
+"""Maximum increase of the effective priority by aging, values above `15` also let tasks overtake other group scopes."""
+
+TASKS_FAIR_SHARE = int(environ.get("TASKS_FAIR_SHARE", "0"))
+"""Set to `1` to share workers fairly between users instead of giving tasks strictly by their priority.
+
+Each user gets a share of the execution time proportional to the weight from the `fair_share_weights` global setting
+(JSON object `{"user_id": weight}`, default weight is `1`), priorities are then respected only between tasks of a user.
+"""
+
+TASKS_PREFETCH_DEPTH = int(environ.get("TASKS_PREFETCH_DEPTH", "0"))
+"""Number of tasks to claim in advance while the current task is executing. `0` disables prefetching.
+
+Prefetched tasks are locked, have their input files downloaded and their flows prepared, so the next task
+can be started right after the current one is finished.
+"""
+
 GC_COLLECT_INTERVAL = float(environ.get("GC_COLLECT_INTERVAL", "10.0"))
 """Internal variable. Interval in seconds (float) that determines how long
 after the task is executed the GPU memory release and garbage collection procedure will be called.
@@ -272,6 +272,9 @@ class TaskDetailsShort(BaseModel):
     hidden: bool = Field(
         ..., description="Flag showing is this the internal task that should not be displayed by default."
     )
+    eta: float | None = Field(
+        None, description="Estimated time in seconds until the task is finished, `None` if it can not be estimated."
+    )
 
     @model_validator(mode="after")
     def adjust_priority(self) -> Self:
@@ -307,6 +310,48 @@ class TaskDetails(TaskDetailsShort):
     )
 
 
+class TasksPage(BaseModel):
+    """Page of the user tasks ordered by the time of their last update."""
+
+    tasks: list[dict[str, Any]] = Field(
+        ..., description="Tasks with the requested fields, `task_id` and `updated_at` are always present."
+    )
+    next_cursor: str | None = Field(
+        None,
+        description="Cursor after the last returned task, to get the next page or later the tasks updated since then. "
+        "On the last page it points a minute before the last task, to not miss updates committed late. "
+        "Equal to the requested cursor if there are no tasks on the page.",
+    )
+    has_more: bool = Field(..., description="Whether there are more tasks after this page.")
+
+
+class TaskEta(BaseModel):
+    """Estimated waiting time for the task, based on the queue and execution times of the finished tasks."""
+
+    task_id: int = Field(..., description="Unique identifier of the task.")
+    eta: float | None = Field(
+        None, description="Estimated time in seconds until the task is finished, `None` if it can not be estimated."
+    )
+    queue_position: int | None = Field(
+        None, description="Number of not started tasks before this one including itself, `0` if task is executing."
+    )
+    estimated_duration: float | None = Field(None, description="Expected execution time of the task in seconds.")
+    estimated_duration_p90: float | None = Field(
+        None, description="90th percentile of the recent execution times of the task flow in seconds."
+    )
+
+
+class TasksWaitTimeStats(BaseModel):
+    """Percentiles of the time that recently started tasks of the same priority were waiting in the queue."""
+
+    priority: int = Field(..., description="Local task priority, from 0 to 15.")
+    count: int = Field(..., description="Number of recently started tasks used for the statistics.")
+    p50: float = Field(..., description="Median wait time in seconds.")
+    p90: float = Field(..., description="90th percentile of the wait time in seconds.")
+    p99: float = Field(..., description="99th percentile of the wait time in seconds.")
+    max: float = Field(..., description="Maximum wait time in seconds.")
+
+
 class NodeProfiling(BaseModel):
     """Represents profiling information for a single node in the workflow."""
 
@@ -388,6 +433,7 @@ class WorkerDetailsRequest(BaseModel):
     ram_free: int = Field(0, description="Free RAM on the worker in bytes")
     last_seen: datetime = Field(datetime.now(timezone.utc), description="Last seen time")
     engine_details: ComfyEngineDetails = Field(...)
+    resident_models: list[str] = Field([], description="Models used by the recently executed tasks")
 
 
 class WorkerSettingsRequest(BaseModel):
@@ -1,14 +1,17 @@
 import asyncio
 import builtins
+import json
 import logging
 import os
 import shutil
+from datetime import datetime
 from pathlib import Path
 from typing import Annotated
 
 from fastapi import APIRouter, BackgroundTasks, Body, Form, HTTPException
 from fastapi import Path as FastApiPath
 from fastapi import Query, Request, UploadFile, responses, status
+from starlette.background import BackgroundTask
 
 from .. import options
 from ..pydantic_models import (
@@ -16,36 +19,54 @@ from ..pydantic_models import (
     TaskCreationWithFullParams,
     TaskDetails,
     TaskDetailsShort,
+    TaskEta,
     TaskRunResults,
+    TasksPage,
+    TasksWaitTimeStats,
     TaskUpdateRequest,
     WorkerDetailsRequest,
 )
 from ..tasks_engine import (
     collect_child_task_ids,
-    get_incomplete_task_without_error_database,
     get_task_files,
     remove_task_by_id_database,
-    remove_task_lock_database,
     remove_unfinished_task_by_id,
     remove_unfinished_tasks_by_name_and_group,
     update_task_progress_database,
 )
 from ..tasks_engine_async import (
+    get_descendant_tasks_ids_async,
     get_task_async,
+    get_task_state_async,
     get_tasks_async,
+    get_tasks_page_async,
     get_tasks_short_async,
     task_restart_database_async,
     update_task_info_database_async,
     update_task_outputs_async,
 )
+from ..tasks_engine_etc import (
+    TASKS_PAGE_DEFAULT_FIELDS,
+    TASKS_PAGE_FIELDS,
+    TASKS_PAGE_RESUME_OVERLAP,
+    decode_tasks_page_cursor,
+    encode_tasks_page_cursor,
+)
+from ..tasks_engine_locks import remove_task_lock_database, renew_task_lock_database
+from ..tasks_eta import fill_tasks_eta, get_tasks_eta, get_tasks_wait_time_percentiles
+from ..tasks_files import get_task_dir
+from ..tasks_notify import TaskEventsSubscriber, TaskWaiter
 from ..webhooks import webhook_task_progress
+from .helpers import require_admin
 from .tasks_internal import (
     create_task_logic,
     get_files_for_node,
+    wait_for_next_tasks,
     zip_files_as_response,
 )
 
 LOGGER = logging.getLogger("visionatrix")
+PROGRESS_STREAM_KEEPALIVE_INTERVAL = 15.0
 ROUTER = APIRouter(prefix="/tasks", tags=["tasks"])  # if you change the prefix, also change it in custom_openapi.py
 
 
@@ -151,22 +172,23 @@ async def create_task_sync(
     task = None
 
     try:
-        # Polling for task completion
-        while loop.time() < end_time:
-            task = await get_task_async(task_id, request.scope["user_info"].user_id)
-            if not task:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Task disappeared during execution."
-                )
-            if task["error"]:
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Task failed: {task['error']}"
-                )
-            if task["progress"] == 100.0:
-                break
-            await asyncio.sleep(0.2)
-        else:  # Loop finished without break, indicating a timeout
-            raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail="Task execution timed out.")
+        with TaskWaiter(task_id) as waiter:
+            # Woken up on updates of the task, the state is polled only as a fallback
+            while loop.time() < end_time:
+                task_state = await get_task_state_async(task_id, request.scope["user_info"].user_id)
+                if not task_state:
+                    raise HTTPException(
+                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Task disappeared during execution."
+                    )
+                if task_state[1]:
+                    raise HTTPException(
+                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Task failed: {task_state[1]}"
+                    )
+                if task_state[0] == 100.0:
+                    break
+                await waiter.wait(min(options.TASK_WAIT_POLL_INTERVAL, max(end_time - loop.time(), 0)))
+            else:  # Loop finished without break, indicating a timeout
+                raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail="Task execution timed out.")
 
         # Fetch final task details and prepare results
         task = await get_task_async(task_id, request.scope["user_info"].user_id, fetch_child=True)
@@ -183,7 +205,14 @@ async def create_task_sync(
                 status.HTTP_404_NOT_FOUND,
                 detail=f"No result files found for task=`{task_id}`.",
             )
-        return zip_files_as_response(files_to_zip, f"results_{task_id}.zip")
+        response = zip_files_as_response(files_to_zip, f"results_{task_id}.zip")
+        if cleanup:
+            # the archive is created while it is sent, so the files are removed only after that
+            task_ids_to_remove = [task_id]
+            collect_child_task_ids(task, task_ids_to_remove)
+            response.background = BackgroundTask(remove_task_by_id_database, task_ids_to_remove)
+            cleanup = False
+        return response
     finally:
         if cleanup:
             task_ids_to_remove = [task_id]
@@ -203,13 +232,15 @@ async def get_tasks_progress(
     Retrieves the full tasks details information for a specific user.
     Optionally filter tasks by their name or a group number.
     """
-    return await get_tasks_async(
+    r = await get_tasks_async(
         name=name,
         group_scope=group_scope,
         user_id=request.scope["user_info"].user_id,
         fetch_child=True,
         only_parent=only_parent,
     )
+    await fill_tasks_eta(list(r.values()))
+    return r
 
 
 @ROUTER.get("/progress-summary")
@@ -223,13 +254,101 @@ async def get_tasks_progress_summary(
     Retrieves summary of the tasks progress details for a specific user.
     Optionally filter tasks by their name or a group number.
     """
-    return await get_tasks_short_async(
+    r = await get_tasks_short_async(
         name=name,
         group_scope=group_scope,
         user_id=request.scope["user_info"].user_id,
         fetch_child=True,
         only_parent=only_parent,
     )
+    await fill_tasks_eta(list(r.values()))
+    return r
+
+
+@ROUTER.get("/page")
+async def get_tasks_page(
+    request: Request,
+    name: str = Query(None, description="Optional name to filter tasks by their name"),
+    group_scope: int = Query(1, description="Optional parameter to filter tasks by their group number"),
+    only_parent: bool = Query(False, description="Fetch only parent tasks"),
+    finished: bool | None = Query(None, description="Optional filter by finished(`true`) or unfinished tasks"),
+    fields: list[str] = Query([], description="Fields of tasks to return, by default the fields of `TaskDetailsShort`"),
+    updated_since: datetime | None = Query(None, description="Return only tasks updated since this time"),
+    cursor: str | None = Query(None, description="The `next_cursor` value from the previous page"),
+    limit: int = Query(100, ge=1, le=1000, description="Maximum number of tasks on the page"),
+) -> TasksPage:
+    """
+    Retrieves the user tasks page by page, in the order of their last update (`updated_at`, then `task_id`).
+
+    Unlike `/progress`, only the requested `fields` are returned, so heavy fields like `flow_comfy` can be skipped.
+    A task that is updated moves to the end of the order, so clients can keep the last `next_cursor` and request
+    pages with it later to receive only the changed tasks. `updated_since` can be used to start from a point in time.
+
+    Resuming from the `next_cursor` of the last page (`has_more` is `false`) also returns again the tasks updated
+    during the minute before it, as updates committed late could otherwise be missed, so clients should merge
+    the tasks by `task_id`. Removed tasks are not reported, their absence can be detected only by a full listing.
+    """
+    if unknown_fields := [i for i in fields if i not in TASKS_PAGE_FIELDS and i != "child_tasks"]:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown fields: {unknown_fields}")
+    try:
+        cursor_values = decode_tasks_page_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)) from None
+    tasks, has_more = await get_tasks_page_async(
+        request.scope["user_info"].user_id,
+        fields or TASKS_PAGE_DEFAULT_FIELDS,
+        name=name,
+        group_scope=group_scope,
+        finished=finished,
+        only_parent=only_parent,
+        updated_since=updated_since,
+        cursor=cursor_values,
+        limit=limit,
+    )
+    if tasks and has_more:
+        cursor = encode_tasks_page_cursor(tasks[-1]["updated_at"], tasks[-1]["task_id"])
+    elif tasks:
+        cursor = encode_tasks_page_cursor(tasks[-1]["updated_at"] - TASKS_PAGE_RESUME_OVERLAP, 0)
+    return TasksPage(tasks=tasks, next_cursor=cursor, has_more=has_more)
+
+
+@ROUTER.get("/progress-stream", response_class=responses.StreamingResponse)
+async def get_tasks_progress_stream(
+    request: Request,
+    name: str = Query(None, description="Optional name to filter tasks by their name"),
+    group_scope: int = Query(1, description="Optional parameter to filter tasks by their group number"),
+    task_ids: list[int] = Query([], description="Optional list of tasks IDs, other filters are ignored if specified"),
+):
+    """
+    Streams updates of the user tasks progress as Server-Sent Events, instead of polling the `/progress` endpoints.
+
+    Each `progress` event has JSON data with `task_id`, `user_id`, `name`, `group_scope`, `parent_task_id`,
+    `progress`, `error`, `execution_time` and `finished` fields. When `task_ids` are specified, events are sent
+    for these tasks and their child tasks, including the child tasks of child tasks.
+
+    The stream starts with the `: connected` comment, the current state of the tasks should be requested after it
+    to not miss updates. If there are no updates, the `: keep-alive` comment is sent every 15 seconds.
+    """
+    user_id = request.scope["user_info"].user_id
+    subscriber = TaskEventsSubscriber(
+        user_id, name, group_scope, task_ids + await get_descendant_tasks_ids_async(task_ids, user_id)
+    )
+
+    async def events_stream():
+        with subscriber:
+            yield ": connected\n\n"
+            while True:
+                if not await subscriber.wait(PROGRESS_STREAM_KEEPALIVE_INTERVAL):
+                    yield ": keep-alive\n\n"
+                    continue
+                for event in subscriber.pop_events():
+                    yield f"event: progress\ndata: {json.dumps(event)}\n\n"
+
+    return responses.StreamingResponse(
+        events_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @ROUTER.get("/progress/{task_id}")
@@ -242,9 +361,45 @@ async def get_task_progress(request: Request, task_id: int) -> TaskDetails:
     if r is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Task `{task_id}` was not found.")
     try:
-        return TaskDetails.model_validate(r)
+        task = TaskDetails.model_validate(r)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Data validation error: {e}") from None
+    await fill_tasks_eta([task])
+    return task
+
+
+@ROUTER.get("/eta")
+async def get_task_eta(
+    request: Request, task_id: int = Query(..., description="The ID of the task to estimate")
+) -> TaskEta:
+    """
+    Estimates how long it will take for the task to finish. The estimate is based on the tasks ahead of it in the
+    queue, the number of active workers that can process them, and the average execution times of finished tasks.
+    `eta` is `null` when there is no active worker for the task or no finished tasks to base the estimate on.
+    """
+    r = await get_task_async(task_id, request.scope["user_info"].user_id)
+    if r is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Task `{task_id}` was not found.")
+    if r["progress"] == 100.0:
+        return TaskEta(
+            task_id=task_id,
+            eta=0.0,
+            estimated_duration=r["execution_time"],
+            estimated_duration_p90=r["execution_time"],
+        )
+    if r["error"]:
+        return TaskEta(task_id=task_id)
+    return TaskEta(task_id=task_id, **(await get_tasks_eta([task_id])).get(task_id, {}))
+
+
+@ROUTER.get("/wait-stats")
+async def get_tasks_wait_stats(request: Request) -> dict[int, TasksWaitTimeStats]:
+    """
+    Returns percentiles of the time tasks were waiting in the queue before being taken by a worker, for each local
+    priority. Only tasks recently taken through this server process are counted. Requires administrator privileges.
+    """
+    require_admin(request)
+    return get_tasks_wait_time_percentiles()
 
 
 @ROUTER.post(
@@ -394,9 +549,9 @@ async def get_task_inputs(
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Task `{task_id}` was not found.")
     if r["user_id"] != request.scope["user_info"].user_id and not request.scope["user_info"].is_admin:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Task `{task_id}` was not found.")
-    for filename in os.listdir(options.INPUT_DIR):
-        if filename == r["input_files"][input_index]["file_name"]:
-            return responses.FileResponse(os.path.join(options.INPUT_DIR, filename))
+    input_file = os.path.join(options.INPUT_DIR, r["input_files"][input_index]["file_name"])
+    if os.path.isfile(input_file):
+        return responses.FileResponse(input_file)
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
         detail=f"Task({r['task_id']}): input file `{r['input_files'][input_index]['file_name']}` was not found.",
@@ -539,20 +694,64 @@ async def get_next_task(
     worker_details: WorkerDetailsRequest = Body(...),
     tasks_names: list[str] = Body(..., description="List of task names the worker can handle"),
     last_task_name: str = Body("", description="Optional name of the last task the worker was working on"),
+    wait: float = Body(
+        0.0,
+        ge=0.0,
+        le=options.MAX_WORKER_TASK_WAIT,
+        description="Maximum time in seconds to wait for a task if there are none available",
+    ),
 ):
     """
     Retrieves an incomplete task for a `worker` to process. Workers provide a list of tasks names they can handle
     and optionally the name of the last task they were working on to prioritize similar types of tasks. If a
     worker is associated with an admin account, it can retrieve tasks regardless of user assignment; otherwise,
     it retrieves only those assigned to the user.
+
+    When `wait` is specified and there are no tasks, the request is held open until a task that the worker can
+    process is queued or until the `wait` time expires.
+
+    Paths of the task files are in the flat layout: input files in the root of the input directory and results
+    in the `visionatrix` output directory, regardless of how the files are stored on the server.
     """
-    user_id = None if request.scope["user_info"].is_admin else request.scope["user_info"].user_id
-    task = await get_incomplete_task_without_error_database(
-        request.scope["user_info"].user_id, worker_details, tasks_names, last_task_name, user_id
-    )
-    if not task:
+    tasks = await wait_for_next_tasks(request, worker_details, tasks_names, last_task_name, wait, 1)
+    if not tasks:
         return responses.Response(status_code=status.HTTP_204_NO_CONTENT)
-    return task
+    return tasks[0]
+
+
+@ROUTER.post(
+    "/next-batch",
+    responses={
+        200: {
+            "description": "Successfully retrieved the tasks for the worker",
+        },
+        204: {
+            "description": "No incomplete tasks available for the worker",
+        },
+    },
+)
+async def get_next_tasks(
+    request: Request,
+    worker_details: WorkerDetailsRequest = Body(...),
+    tasks_names: list[str] = Body(..., description="List of task names the worker can handle"),
+    last_task_name: str = Body("", description="Optional name of the last task the worker was working on"),
+    count: int = Body(..., ge=1, le=100, description="Maximum number of tasks to retrieve"),
+    wait: float = Body(
+        0.0,
+        ge=0.0,
+        le=options.MAX_WORKER_TASK_WAIT,
+        description="Maximum time in seconds to wait for a task if there are none available",
+    ),
+) -> list[dict]:
+    """
+    Retrieves up to `count` incomplete tasks for a `worker` to process, all of them are locked in a single database
+    query. Parameters are the same as for the `/next` endpoint, the tasks are returned in the order of their
+    priority.
+    """
+    tasks = await wait_for_next_tasks(request, worker_details, tasks_names, last_task_name, wait, count)
+    if not tasks:
+        return responses.Response(status_code=status.HTTP_204_NO_CONTENT)
+    return tasks
 
 
 @ROUTER.put(
@@ -581,12 +780,17 @@ async def update_task_progress(
     progress: float = Body(..., description="Progress percentage of the task"),
     execution_time: float = Body(..., description="Execution time of the task in seconds"),
     error: str = Body("", description="Error message if any"),
+    lease_token: str | None = Body(None, description="Lease token received with the task when it was claimed"),
     execution_details: ExecutionDetails | None = Body(None),
 ):
     """
     Updates the progress of a specific task identified by `task_id`. This endpoint checks if the task exists
     and if the requester is authorized to update its progress. If the task is not found or unauthorized,
     a 404 HTTP error is raised, and `worker` should stop and consider the task canceled.
+
+    The update is rejected with a 400 HTTP error when the task is no longer locked with the `lease_token`,
+    for example when the lease expired and the task was returned to the queue. Without `lease_token`, sent by
+    workers of previous versions, the lock is not checked.
     """
     r = await get_task_async(task_id)
     if r is None:
@@ -595,7 +799,7 @@ async def update_task_progress(
     if r["user_id"] != user_info.user_id and not user_info.is_admin:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Task `{task_id}` was not found.")
     if not await update_task_progress_database(
-        task_id, progress, error, execution_time, user_info.user_id, worker_details, execution_details
+        task_id, progress, error, execution_time, user_info.user_id, worker_details, lease_token, execution_details
     ):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Failed to update task progress.")
     if r["webhook_url"]:
@@ -635,6 +839,8 @@ async def set_task_results(
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Task `{task_id}` was not found.")
     if task_details["user_id"] != request.scope["user_info"].user_id and not request.scope["user_info"].is_admin:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Task `{task_id}` was not found.")
+    task_output_dir = get_task_dir(task_id, "output")
+    os.makedirs(task_output_dir, exist_ok=True)
     for task_output in task_details["outputs"]:
         task_file_prefix = f"{task_id}_{task_output['comfy_node_id']}_"
         relevant_files = [file_info for file_info in files if file_info.filename.startswith(task_file_prefix)]
@@ -649,7 +855,7 @@ async def set_task_results(
             file_size += i.size
             batch_size += 1
             try:
-                file_path = Path(options.OUTPUT_DIR).joinpath("visionatrix").joinpath(i.filename)
+                file_path = Path(task_output_dir).joinpath(i.filename)
                 with builtins.open(file_path, mode="wb") as out_file:
                     shutil.copyfileobj(i.file, out_file)
             finally:
@@ -672,19 +878,54 @@ async def set_task_results(
     },
 )
 async def remove_task_lock(
-    request: Request, task_id: int = Query(..., description="The ID of the task to remove the lock from")
+    request: Request,
+    task_id: int = Query(..., description="The ID of the task to remove the lock from"),
+    lease_token: str | None = Query(None, description="Lease token received with the task when it was claimed"),
 ):
     """
     Unlocks a task specified by the `task_id`. This endpoint checks if the task exists
     and if the `worker` making the request has the authorization to unlock it.
     If the task is not found or unauthorized, a 404 HTTP error is raised.
+    When `lease_token` is specified, locks of other leases of the task are not removed.
     """
     r = await get_task_async(task_id)
     if r is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Task `{task_id}` was not found.")
     if r["user_id"] != request.scope["user_info"].user_id and not request.scope["user_info"].is_admin:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Task `{task_id}` was not found.")
-    await remove_task_lock_database(task_id)
+    await remove_task_lock_database(task_id, lease_token)
+
+
+@ROUTER.put(
+    "/lock",
+    response_class=responses.Response,
+    status_code=status.HTTP_204_NO_CONTENT,
+    responses={
+        204: {"description": "Successfully renewed task lock"},
+        404: {
+            "description": "Task or its lock not found",
+            "content": {"application/json": {"example": {"detail": "Task `{task_id}` was not found."}}},
+        },
+    },
+)
+async def renew_task_lock(
+    request: Request,
+    task_id: int = Query(..., description="The ID of the task to renew the lock for"),
+    lease_token: str | None = Query(None, description="Lease token received with the task when it was claimed"),
+):
+    """
+    Extends the lease of a task lock specified by the `task_id`. Workers call this endpoint periodically while
+    executing the task, otherwise the task is returned to the queue after the lock expires. If the task was not found,
+    the `worker` has no access to it or the task is no longer locked (with the `lease_token`, if specified),
+    a 404 HTTP error is raised.
+    """
+    r = await get_task_async(task_id)
+    if r is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Task `{task_id}` was not found.")
+    if r["user_id"] != request.scope["user_info"].user_id and not request.scope["user_info"].is_admin:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Task `{task_id}` was not found.")
+    if not await renew_task_lock_database(task_id, lease_token):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Task `{task_id}` is not locked.")
 
 
 @ROUTER.put(
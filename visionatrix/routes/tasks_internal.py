@@ -1,16 +1,17 @@
 import builtins
 import json
 import logging
+import time
 import typing
 from datetime import datetime, timedelta, timezone
-from io import BytesIO
-from zipfile import ZipFile
+from pathlib import Path
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
 
 import httpx
 from fastapi import HTTPException, Request, responses, status
 from starlette.datastructures import UploadFile as StarletteUploadFile
 
-from .. import etc, models_map
+from .. import etc, models_map, options
 from ..db_queries import (
     get_all_global_settings_for_task_execution,
     get_installed_models,
@@ -35,23 +36,56 @@ from ..pydantic_models import (
     TaskCreationWithFullParams,
     TranslatePromptRequest,
     UserInfo,
+    WorkerDetailsRequest,
 )
 from ..surprise_me import surprise_me
-from ..tasks_engine import remove_task_files
+from ..tasks_engine import (
+    get_incomplete_tasks_without_error_database,
+    remove_tasks_files,
+)
 from ..tasks_engine_async import (
-    create_new_task_async,
+    create_new_tasks_async,
     get_task_async,
-    put_task_in_queue_async,
+    put_tasks_in_queue_async,
 )
+from ..tasks_engine_etc import prepare_worker_info_update
+from ..tasks_files import flatten_task_paths
+from ..tasks_notify import TasksWaiter, is_postgresql
 
 LOGGER = logging.getLogger("visionatrix")
 VALIDATE_PROMPT: typing.Callable[[str, dict], typing.Awaitable[tuple[bool, dict, list, list]]] | None = None
-
-
-async def task_run(
+ZIP_STREAM_CHUNK_SIZE = 1024 * 1024
+COMPRESSED_FILES_EXTENSIONS = {
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".webp",
+    ".gif",
+    ".avif",
+    ".heic",
+    ".heif",
+    ".mp4",
+    ".webm",
+    ".mov",
+    ".mkv",
+    ".avi",
+    ".mp3",
+    ".ogg",
+    ".opus",
+    ".flac",
+    ".m4a",
+    ".aac",
+    ".glb",
+    ".zip",
+    ".gz",
+}
+"""Files that are already compressed are stored in archives as is, compressing them again only costs CPU time."""
+
+
+async def tasks_run(
     name: str,
-    input_params: dict,
-    translated_input_params: dict,
+    input_params_list: list[dict],
+    translated_input_params_list: list[dict],
     in_files: dict[str, StarletteUploadFile | dict],
     flow: Flow,
     flow_comfy: dict,
@@ -63,26 +97,12 @@ async def task_run(
     priority: int,
     extra_flags: dict,
     custom_worker: str | None,
-):
-    task_details = await create_new_task_async(name, input_params, user_info)
-    models_map.process_flow_models(flow_comfy, await get_installed_models())
-    input_params_copy = input_params.copy()
-    for i, v in translated_input_params.items():
-        input_params_copy[i] = v
-    try:
-        flow_comfy = prepare_flow_comfy(flow, flow_comfy, input_params_copy, in_files, task_details)
-    except RuntimeError as e:
-        remove_task_files(task_details["task_id"], ["input"])
-        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=str(e)) from None
+) -> list[dict]:
+    """Creates tasks that differ only in the text input parameters.
 
-    flow_validation: [bool, dict, list, list] = await VALIDATE_PROMPT("vix-" + str(task_details["task_id"]), flow_comfy)
-    if not flow_validation[0]:
-        remove_task_files(task_details["task_id"], ["input"])
-        LOGGER.error("Flow validation error: %s\n%s", flow_validation[1], flow_validation[3])
-        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=f"Bad Flow: `{flow_validation[1]}`") from None
-    task_details["flow_comfy"] = flow_comfy
-    task_details["webhook_url"] = webhook_url
-    task_details["webhook_headers"] = webhook_headers
+    The graph of each task is validated by ComfyUI, as the values of the inputs can differ between the tasks,
+    and all tasks are created with a constant number of queries to the database.
+    """
     if child_task:
         if not in_files:
             raise HTTPException(
@@ -95,21 +115,59 @@ async def task_run(
                 status.HTTP_400_BAD_REQUEST,
                 detail="Invalid input file. Use the parent task's node ID.",
             ) from None
-        task_details["parent_task_id"] = in_file["task_id"]
-        task_details["parent_task_node_id"] = in_file["node_id"]
-    task_details["group_scope"] = group_scope
-    task_details["priority"] = ((group_scope - 1) << 4) + priority
-    if translated_input_params:
-        task_details["translated_input_params"] = translated_input_params
-    if extra_flags:
-        task_details["extra_flags"] = extra_flags
-    if custom_worker:
-        task_details["custom_worker"] = custom_worker
-    if flow.hidden or extra_flags.get("federated_task"):
-        task_details["hidden"] = True
-    flow_prepare_output_params(flow_validation[2], task_details["task_id"], task_details, flow_comfy)
-    await put_task_in_queue_async(task_details)
-    return task_details
+
+    tasks_details = await create_new_tasks_async(name, input_params_list, user_info)
+    tasks_ids = [i["task_id"] for i in tasks_details]
+    models_map.process_flow_models(flow_comfy, await get_installed_models())
+    tasks_flow_comfy = []
+    stored_files = {}
+    try:
+        for task_details, input_params, translated_input_params in zip(
+            tasks_details, input_params_list, translated_input_params_list, strict=True
+        ):
+            input_params_copy = input_params.copy()
+            for i, v in translated_input_params.items():
+                input_params_copy[i] = v
+            tasks_flow_comfy.append(
+                prepare_flow_comfy(flow, flow_comfy, input_params_copy, in_files, task_details, stored_files)
+            )
+    except RuntimeError as e:
+        remove_tasks_files(tasks_ids, ["input"], [i["input_files"] for i in tasks_details])
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=str(e)) from None
+
+    flows_validation = []
+    for task_details, task_flow_comfy in zip(tasks_details, tasks_flow_comfy, strict=True):
+        flow_validation: [bool, dict, list, list] = await VALIDATE_PROMPT(
+            "vix-" + str(task_details["task_id"]), task_flow_comfy
+        )
+        if not flow_validation[0]:
+            remove_tasks_files(tasks_ids, ["input"], [i["input_files"] for i in tasks_details])
+            LOGGER.error("Flow validation error: %s\n%s", flow_validation[1], flow_validation[3])
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=f"Bad Flow: `{flow_validation[1]}`") from None
+        flows_validation.append(flow_validation)
+
+    for task_details, task_flow_comfy, flow_validation, translated_input_params in zip(
+        tasks_details, tasks_flow_comfy, flows_validation, translated_input_params_list, strict=True
+    ):
+        task_details["flow_comfy"] = task_flow_comfy
+        task_details["webhook_url"] = webhook_url
+        task_details["webhook_headers"] = webhook_headers
+        if child_task:
+            task_details["parent_task_id"] = in_file["task_id"]
+            task_details["parent_task_node_id"] = in_file["node_id"]
+        task_details["group_scope"] = group_scope
+        task_details["priority"] = ((group_scope - 1) << 4) + priority
+        if translated_input_params:
+            task_details["translated_input_params"] = translated_input_params
+        if extra_flags:
+            task_details["extra_flags"] = extra_flags
+        if custom_worker:
+            task_details["custom_worker"] = custom_worker
+        if flow.hidden or extra_flags.get("federated_task"):
+            task_details["hidden"] = True
+        flow_prepare_output_params(flow_validation[2], task_details["task_id"], task_details, task_flow_comfy)
+    await put_tasks_in_queue_async(tasks_details)
+    return tasks_details
 
 
 async def get_translated_input_params(
@@ -294,28 +352,23 @@ async def create_task_logic(
             for i in range(data.count):
                 in_text_params_list[i]["prompt"] = ai_generated_prompts[i]
 
-    created_tasks = []
     webhook_headers_dict = json.loads(data.webhook_headers) if data.webhook_headers else None
-    for i in range(data.count):
-        task_details = await task_run(
-            name,
-            in_text_params_list[i],
-            translated_in_text_params_list[i],
-            in_files_params,
-            flow,
-            flow_comfy,
-            request.scope["user_info"],
-            data.webhook_url if data.webhook_url else None,
-            webhook_headers_dict,
-            bool(data.child_task),
-            data.group_scope,
-            data.priority,
-            extra_flags,
-            custom_worker,
-        )
-        created_tasks.append(task_details)
-
-    return created_tasks
+    return await tasks_run(
+        name,
+        in_text_params_list,
+        translated_in_text_params_list,
+        in_files_params,
+        flow,
+        flow_comfy,
+        request.scope["user_info"],
+        data.webhook_url if data.webhook_url else None,
+        webhook_headers_dict,
+        bool(data.child_task),
+        data.group_scope,
+        data.priority,
+        extra_flags,
+        custom_worker,
+    )
 
 
 def get_files_for_node(
@@ -339,18 +392,76 @@ def get_files_for_node(
     return relevant_files
 
 
-def zip_files_as_response(files_to_zip: list[tuple[str, str]], archive_name: str) -> responses.Response:
-    """Zips a list of files into a FastAPI response."""
-    zip_buffer = BytesIO()
-    with ZipFile(zip_buffer, "w") as zip_file:
-        for file_name, file_path in files_to_zip:
-            with builtins.open(file_path, "rb") as f:
-                zip_file.writestr(file_name, f.read())
-
-    zip_buffer.seek(0)
-
-    return responses.Response(
-        content=zip_buffer.read(),
+def zip_files_as_response(files_to_zip: list[tuple[str, str]], archive_name: str) -> responses.StreamingResponse:
+    """Zips a list of files into a FastAPI response, the archive is created while it is sent to the client."""
+    return responses.StreamingResponse(
+        __zip_files_stream(files_to_zip),
         media_type="application/zip",
         headers={"Content-Disposition": f"attachment; filename={archive_name}"},
     )
+
+
+class ZipStreamBuffer:
+    """Write-only file object for `ZipFile`, the written data is taken out of it after each chunk of a file."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def pop(self) -> bytes:
+        r = b"".join(self.chunks)
+        self.chunks.clear()
+        return r
+
+
+def __zip_files_stream(files_to_zip: list[tuple[str, str]]) -> typing.Iterator[bytes]:
+    buffer = ZipStreamBuffer()
+    with ZipFile(buffer, "w") as zip_file:
+        for file_name, file_path in files_to_zip:
+            zip_info = ZipInfo.from_file(file_path, file_name)
+            if Path(file_name).suffix.lower() in COMPRESSED_FILES_EXTENSIONS:
+                zip_info.compress_type = ZIP_STORED
+            else:
+                zip_info.compress_type = ZIP_DEFLATED
+            with builtins.open(file_path, "rb") as f, zip_file.open(zip_info, "w") as zip_entry:
+                while chunk := f.read(ZIP_STREAM_CHUNK_SIZE):
+                    zip_entry.write(chunk)
+                    yield buffer.pop()
+            yield buffer.pop()
+    yield buffer.pop()
+
+
+async def wait_for_next_tasks(
+    request: Request,
+    worker_details: WorkerDetailsRequest,
+    tasks_names: list[str],
+    last_task_name: str,
+    wait: float,
+    count: int,
+) -> list[dict]:
+    worker_user_id = request.scope["user_info"].user_id
+    user_id = None if request.scope["user_info"].is_admin else worker_user_id
+    worker_id = prepare_worker_info_update(worker_user_id, worker_details)[0]
+    with TasksWaiter(tasks_names, worker_id) as waiter:
+        tasks = await get_incomplete_tasks_without_error_database(
+            worker_user_id, worker_details, tasks_names, last_task_name, user_id, count
+        )
+        # without PostgreSQL notifications, tasks queued by other processes do not wake the waiter
+        poll_interval = None if is_postgresql() else options.TASKS_POLL_FALLBACK_INTERVAL
+        deadline = time.monotonic() + wait
+        while not tasks and (time_left := deadline - time.monotonic()) > 0:
+            woken = await waiter.wait(min(time_left, poll_interval or time_left))
+            if (not woken and poll_interval is None) or await request.is_disconnected():
+                break
+            tasks = await get_incomplete_tasks_without_error_database(
+                worker_user_id, worker_details, tasks_names, last_task_name, user_id, count
+            )
+    for task in tasks:
+        flatten_task_paths(task)
+    return tasks
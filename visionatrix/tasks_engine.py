@@ -1,19 +1,18 @@
 import asyncio
 import builtins
+import collections
 import contextlib
 import json
 import logging
 import os
 import threading
 import time
-import typing
 from datetime import datetime, timezone
 
 import httpx
-from sqlalchemy import and_, delete, or_, select, update
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import and_, delete, or_, select, true, update
 
-from . import comfyui_wrapper, database, models_map, options
+from . import comfyui_wrapper, database, models_map, options, tasks_engine_loop
 from .db_queries import (
     get_global_setting,
     get_installed_models,
@@ -22,6 +21,7 @@ from .db_queries import (
     worker_reset_empty_task_requests_count,
 )
 from .flows import (
+    get_flows_models_affinity,
     get_google_nodes,
     get_insightface_nodes,
     get_installed_flows,
@@ -36,16 +36,51 @@ from .pydantic_models import (
 from .tasks_engine_etc import (
     TASK_DETAILS_COLUMNS,
     TASK_DETAILS_COLUMNS_SHORT,
+    get_flows_not_fitting_worker,
+    get_flows_peak_memory,
     get_incomplete_task_without_error_query,
     initialize_comfyui_engine_settings,
     nodes_execution_profiler,
     prepare_worker_info_update,
 )
+from .tasks_engine_locks import (
+    claim_tasks,
+    remove_task_lock,
+    renew_task_lock,
+    task_lease_expires_at,
+)
+from .tasks_engine_loop import (
+    run_in_engine_loop,
+    spawn_in_engine_loop,
+    worker_http_client,
+)
+from .tasks_engine_progress import TaskProgressReporter
+from .tasks_eta import record_task_duration
+from .tasks_fair_share import charge_users_for_tasks, get_users_virtual_time
+from .tasks_files import (
+    get_task_dir,
+    get_task_files,
+    remove_task_files,
+    remove_tasks_files,
+    update_legacy_task_paths,
+)
+from .tasks_notify import (
+    TASK_EVENT_FIELDS,
+    TASKS_WAKEUP_EVENT,
+    get_task_event,
+    notify_task_updated,
+    publish_task_event,
+    tasks_notifications_available,
+    wake_task_waiters,
+    wake_tasks_executor,
+)
 from .webhooks import webhook_task_progress
 
 LOGGER = logging.getLogger("visionatrix")
 
 ACTIVE_TASK: dict = {}
+PREFETCHED_TASKS: collections.deque[dict] = collections.deque()
+"""Tasks that are claimed and prepared in advance, while the `ACTIVE_TASK` is executing."""
 
 
 def __get_task_query(task_id: int, user_id: str | None):
@@ -70,10 +105,11 @@ def collect_child_task_ids(task: dict | TaskDetailsShort, output_ids: list) -> N
             collect_child_task_ids(child, output_ids)
 
 
-async def get_incomplete_task_without_error(last_task_name: str) -> dict:
+async def get_incomplete_task_without_error(last_task_name: str, long_poll: bool = True) -> dict:
     tasks_to_ask = list(await get_installed_flows())
     if options.VIX_MODE == "WORKER" and options.VIX_SERVER:
-        if not (task_to_exec := await get_incomplete_task_without_error_server(tasks_to_ask, last_task_name)):
+        wait = options.WORKER_TASK_WAIT if long_poll else 0.0
+        if not (task_to_exec := await get_incomplete_task_without_error_server(tasks_to_ask, last_task_name, wait)):
             return {}
     else:
         task_to_exec = await get_incomplete_task_without_error_database(
@@ -85,7 +121,7 @@ async def get_incomplete_task_without_error(last_task_name: str) -> dict:
         if not task_to_exec:
             return {}
 
-    await task_preprocess_extra_flags(task_to_exec["extra_flags"])
+    update_legacy_task_paths(task_to_exec)
     ollama_nodes = get_ollama_nodes(task_to_exec["flow_comfy"])
     if ollama_nodes:
         ollama_vision_model = ""
@@ -144,7 +180,9 @@ async def get_incomplete_task_without_error(last_task_name: str) -> dict:
 
     await task_preprocess_insightface_nodes(task_to_exec["flow_comfy"], task_to_exec["user_id"])
 
-    models_map.process_flow_models(task_to_exec["flow_comfy"], await get_installed_models())
+    task_to_exec["flow_models"] = [
+        i.name for i in models_map.process_flow_models(task_to_exec["flow_comfy"], await get_installed_models())
+    ]
 
     return task_to_exec
 
@@ -182,7 +220,7 @@ async def get_worker_value(key_name: str, user_id: str = "") -> str:
     if key_value:
         return key_value
     if options.VIX_MODE == "WORKER" and options.VIX_SERVER:
-        async with httpx.AsyncClient(timeout=options.WORKER_NET_TIMEOUT) as client:
+        async with worker_http_client() as client:
             r = await client.get(
                 options.VIX_SERVER.rstrip("/") + "/vapi/settings/get",
                 params={"key": key_name.lower()},
@@ -199,17 +237,19 @@ async def get_worker_value(key_name: str, user_id: str = "") -> str:
     return key_value
 
 
-async def get_incomplete_task_without_error_server(tasks_to_ask: list[str], last_task_name: str) -> dict:
+async def get_incomplete_task_without_error_server(tasks_to_ask: list[str], last_task_name: str, wait: float) -> dict:
     try:
-        async with httpx.AsyncClient(timeout=options.WORKER_NET_TIMEOUT) as client:
+        async with worker_http_client() as client:
             r = await client.post(
                 options.VIX_SERVER.rstrip("/") + "/vapi/tasks/next",
                 json={
                     "worker_details": comfyui_wrapper.get_worker_details(),
                     "tasks_names": tasks_to_ask,
                     "last_task_name": last_task_name,
+                    "wait": wait,
                 },
                 auth=options.worker_auth(),
+                timeout=options.WORKER_NET_TIMEOUT + wait,
             )
         if r.status_code == httpx.codes.NO_CONTENT:
             return {}
@@ -225,20 +265,22 @@ async def get_incomplete_task_without_error_server(tasks_to_ask: list[str], last
 
 async def get_task_for_federated_worker(
     tasks_to_ask: list[str],
-) -> dict:
+    count: int = 1,
+) -> list[dict]:
     if not tasks_to_ask:
-        return {}
+        return []
     async with database.SESSION() as session:
         try:
-            query = get_incomplete_task_without_error_query(tasks_to_ask, [], "", "non-existing", None)
-            task = (await session.execute(query)).scalar()
-            if not task:
-                return {}
-            return await lock_task_and_return_details(session, task)
+            query = get_incomplete_task_without_error_query(
+                tasks_to_ask, [], "", "non-existing", None, users_virtual_time=get_users_virtual_time()
+            )
+            tasks_details = await claim_tasks(session, query, count)
+            await charge_users_for_tasks(tasks_details)
+            return tasks_details
         except Exception as e:
             await session.rollback()
             LOGGER.exception("Failed to retrieve task for processing: %s", e)
-            return {}
+            return []
 
 
 async def get_incomplete_task_without_error_database(
@@ -248,6 +290,20 @@ async def get_incomplete_task_without_error_database(
     last_task_name: str,
     user_id: str | None = None,
 ) -> dict:
+    tasks = await get_incomplete_tasks_without_error_database(
+        worker_user_id, worker_details, tasks_to_ask, last_task_name, user_id, 1
+    )
+    return tasks[0] if tasks else {}
+
+
+async def get_incomplete_tasks_without_error_database(
+    worker_user_id: str,
+    worker_details: WorkerDetailsRequest,
+    tasks_to_ask: list[str],
+    last_task_name: str,
+    user_id: str | None = None,
+    count: int = 1,
+) -> list[dict]:
     async with database.SESSION() as session:
         try:
             worker_id, worker_device_name, worker_info_values = prepare_worker_info_update(
@@ -269,7 +325,7 @@ async def get_incomplete_task_without_error_database(
                 )
             await session.commit()
             if not tasks_to_ask:
-                return {}
+                return []
 
             worker_record = None
             if not new_worker:
@@ -278,60 +334,38 @@ async def get_incomplete_task_without_error_database(
                 worker_record = (await session.execute(query)).scalar()
 
             query = get_incomplete_task_without_error_query(
-                tasks_to_ask, worker_record.tasks_to_give if worker_record else [], last_task_name, worker_id, user_id
+                tasks_to_ask,
+                worker_record.tasks_to_give if worker_record else [],
+                last_task_name,
+                worker_id,
+                user_id,
+                await get_flows_models_affinity(tasks_to_ask, worker_details.resident_models),
+                get_flows_not_fitting_worker(tasks_to_ask, worker_details, await get_flows_peak_memory()),
+                get_users_virtual_time(),
             )
-            task = (await session.execute(query)).scalar()
-            if not task:
+            tasks_details = await claim_tasks(session, query, count)
+            await charge_users_for_tasks(tasks_details)
+            if not tasks_details:
                 await worker_increment_empty_task_requests_count(worker_id)
-                return {}
-            task_details = await lock_task_and_return_details(session, task)
-            if task_details:
-                await worker_reset_empty_task_requests_count(worker_id)
-                if worker_record:
-                    worker_specific_settings_map = {
-                        "smart_memory": worker_record.smart_memory,
-                        "cache_type": worker_record.cache_type,
-                        "cache_size": worker_record.cache_size,
-                        "vae_cpu": worker_record.vae_cpu,
-                        "reserve_vram": worker_record.reserve_vram,
-                    }
+                return []
+            await worker_reset_empty_task_requests_count(worker_id)
+            if worker_record:
+                worker_specific_settings_map = {
+                    "smart_memory": worker_record.smart_memory,
+                    "cache_type": worker_record.cache_type,
+                    "cache_size": worker_record.cache_size,
+                    "vae_cpu": worker_record.vae_cpu,
+                    "reserve_vram": worker_record.reserve_vram,
+                }
+                for task_details in tasks_details:
                     for setting_name, worker_value in worker_specific_settings_map.items():
                         if worker_value is not None:
                             task_details["extra_flags"][setting_name] = worker_value
-            return task_details
+            return tasks_details
         except Exception as e:
             await session.rollback()
             LOGGER.exception("Failed to retrieve task for processing: %s", e)
-            return {}
-
-
-def __lock_task_and_return_details(task: type[database.TaskDetails] | database.TaskDetails):
-    return {
-        "task_id": task.task_id,
-        "progress": 0.0,
-        "error": task.error,
-        "name": task.name,
-        "input_params": task.input_params,
-        "outputs": task.outputs,
-        "input_files": task.input_files,
-        "flow_comfy": task.flow_comfy,
-        "user_id": task.user_id,
-        "execution_time": 0.0,
-        "webhook_url": task.webhook_url,
-        "webhook_headers": task.webhook_headers,
-        "extra_flags": task.extra_flags,
-        "translated_input_params": task.translated_input_params,
-    }
-
-
-async def lock_task_and_return_details(session, task: type[database.TaskDetails] | database.TaskDetails) -> dict:
-    try:
-        session.add(database.TaskLock(task_id=task.task_id, locked_at=datetime.utcnow()))
-        await session.commit()
-        return __lock_task_and_return_details(task)
-    except IntegrityError:
-        await session.rollback()
-        return {}
+            return []
 
 
 def __get_tasks_query(
@@ -367,12 +401,21 @@ def __get_tasks_query(
 
 async def remove_task_by_id_database(task_ids: list[int]) -> bool:
     session = database.SESSION()
+    tasks_input_files = []
     try:
         lock_result = await session.execute(delete(database.TaskLock).where(database.TaskLock.task_id.in_(task_ids)))
-        details_result = await session.execute(
-            delete(database.TaskDetails).where(database.TaskDetails.task_id.in_(task_ids))
+        tasks_input_files = (
+            (
+                await session.execute(
+                    delete(database.TaskDetails)
+                    .where(database.TaskDetails.task_id.in_(task_ids))
+                    .returning(database.TaskDetails.input_files)
+                )
+            )
+            .scalars()
+            .all()
         )
-        if lock_result.rowcount + details_result.rowcount > 0:
+        if lock_result.rowcount + len(tasks_input_files) > 0:
             await session.commit()
             return True
     except Exception:
@@ -381,8 +424,7 @@ async def remove_task_by_id_database(task_ids: list[int]) -> bool:
         raise
     finally:
         await session.close()
-        for i in task_ids:
-            remove_task_files(i, ["output", "input"])
+        remove_tasks_files(task_ids, ["output", "input"], tasks_input_files)
     return False
 
 
@@ -391,13 +433,13 @@ async def remove_unfinished_task_by_id(task_id: int) -> bool:
     try:
         await session.execute(delete(database.TaskLock).where(database.TaskLock.task_id == task_id))
         details_result = await session.execute(
-            delete(database.TaskDetails).where(
-                and_(database.TaskDetails.progress != 100.0, database.TaskDetails.task_id == task_id)
-            )
+            delete(database.TaskDetails)
+            .where(and_(database.TaskDetails.progress != 100.0, database.TaskDetails.task_id == task_id))
+            .returning(database.TaskDetails.input_files)
         )
-        if details_result.rowcount > 0:
+        if (input_files := details_result.one_or_none()) is not None:
             await session.commit()
-            remove_task_files(task_id, ["output", "input"])
+            remove_task_files(task_id, ["output", "input"], input_files[0])
             return True
     except Exception:
         await session.rollback()
@@ -434,70 +476,18 @@ async def remove_unfinished_tasks_by_name_and_group(name: str, user_id: str, gro
         return False
 
 
-def get_task_files(task_id: int, directory: typing.Literal["input", "output"]) -> list[tuple[str, str]]:
-    result_prefix = str(task_id) + "_"
-    target_directory = options.INPUT_DIR if directory == "input" else os.path.join(options.OUTPUT_DIR, "visionatrix")
-    r = []
-    for filename in sorted(os.listdir(target_directory)):
-        if filename.startswith(result_prefix):
-            r.append((filename, os.path.join(target_directory, filename)))
-    return r
-
-
-def remove_task_files(task_id: int, directories: list[str]) -> None:
-    for directory in directories:
-        result_prefix = f"{task_id}_"
-        if directory == "input":
-            target_directory = options.INPUT_DIR
-        elif directory == "output":
-            target_directory = os.path.join(options.OUTPUT_DIR, "visionatrix")
-        else:
-            raise ValueError(f"Invalid input value: {directory}")
-        for filename in os.listdir(target_directory):
-            if filename.startswith(result_prefix):
-                with contextlib.suppress(FileNotFoundError):
-                    os.remove(os.path.join(target_directory, filename))
-
-
-async def remove_task_lock(task_id: int) -> None:
-    if options.VIX_MODE == "WORKER" and options.VIX_SERVER:
-        return await remove_task_lock_server(task_id)
-    return await remove_task_lock_database(task_id)
-
-
-async def remove_task_lock_database(task_id: int) -> None:
-    async with database.SESSION() as session:
-        try:
-            result = await session.execute(delete(database.TaskLock).where(database.TaskLock.task_id == task_id))
-            if result.rowcount > 0:
-                await session.commit()
-        except Exception as e:
-            await session.rollback()
-            LOGGER.exception("Task %s: failed to remove task lock: %s", task_id, e)
-
-
-async def remove_task_lock_server(task_id: int) -> None:
-    try:
-        async with httpx.AsyncClient(timeout=options.WORKER_NET_TIMEOUT) as client:
-            r = await client.delete(
-                options.VIX_SERVER.rstrip("/") + "/vapi/tasks/lock",
-                params={"task_id": task_id},
-                auth=options.worker_auth(),
-            )
-        if httpx.codes.is_error(r.status_code):
-            LOGGER.warning("Task %s: server return status: %s", task_id, r.status_code)
-    except Exception as e:
-        LOGGER.exception("Exception occurred: %s", e)
-
-
 async def update_task_outputs(task_id: int, outputs: list[dict]) -> bool:
     async with database.SESSION() as session:
         try:
             result = await session.execute(
-                update(database.TaskDetails).where(database.TaskDetails.task_id == task_id).values(outputs=outputs)
+                update(database.TaskDetails)
+                .where(database.TaskDetails.task_id == task_id)
+                .values(outputs=outputs, updated_at=datetime.now(timezone.utc))
             )
             if result.rowcount == 1:
+                await notify_task_updated(session, task_id)
                 await session.commit()
+                wake_task_waiters(task_id)
                 return True
         except Exception as e:
             comfyui_wrapper.interrupt_processing()
@@ -518,6 +508,7 @@ async def update_task_progress(task_details: dict) -> bool:
         task_details["execution_time"],
         database.DEFAULT_USER.user_id,
         WorkerDetailsRequest.model_validate(comfyui_wrapper.get_worker_details()),
+        task_details["lease_token"],
         ExecutionDetails.model_validate(execution_details) if execution_details else None,
     )
     if r and task_details["webhook_url"]:
@@ -539,8 +530,20 @@ async def update_task_progress_database(
     execution_time: float,
     worker_user_or_id: str,
     worker_details: WorkerDetailsRequest | None,
+    lease_token: str | None,
     execution_details: ExecutionDetails | None = None,
 ) -> bool:
+    """Updates the task only while it is locked with `lease_token`, returns False if the lease was lost.
+
+    Without `lease_token` (workers of previous versions) the task is updated regardless of its lock.
+    """
+    task_locked_condition = true()
+    lock_condition = database.TaskLock.task_id == task_id
+    if lease_token is not None:
+        lock_condition &= database.TaskLock.lease_token == lease_token
+        task_locked_condition = database.TaskDetails.task_id.in_(
+            select(database.TaskLock.task_id).where(lock_condition)
+        )
     async with database.SESSION() as session:
         try:
             if worker_details:
@@ -559,15 +562,31 @@ async def update_task_progress_database(
                 update_values["finished_at"] = datetime.now(timezone.utc)
                 if execution_details is not None:
                     update_values["execution_details"] = execution_details.model_dump(mode="json", exclude_none=True)
-            result = await session.execute(
-                update(database.TaskDetails).where(database.TaskDetails.task_id == task_id).values(**update_values)
-            )
+            task_row = (
+                await session.execute(
+                    update(database.TaskDetails)
+                    .where(database.TaskDetails.task_id == task_id, task_locked_condition)
+                    .values(**update_values)
+                    .returning(*[getattr(database.TaskDetails, i) for i in TASK_EVENT_FIELDS])
+                )
+            ).one_or_none()
+            task_event = get_task_event(task_row) if task_row else None
+            if task_row is not None and progress != 100.0 and not error:
+                await session.execute(
+                    update(database.TaskLock).where(lock_condition).values(expires_at=task_lease_expires_at())
+                )
+            await notify_task_updated(session, task_id, task_event)
             await session.commit()
-            if (task_updated := result.rowcount == 1) is True and worker_info_values:
+            wake_task_waiters(task_id)
+            if task_event:
+                publish_task_event(task_event)
+            if (task_updated := task_row is not None) is True and worker_info_values:
                 await session.execute(
                     update(database.Worker).where(database.Worker.worker_id == worker_id).values(**worker_info_values)
                 )
                 await session.commit()
+            if task_updated and progress == 100.0 and not error:
+                await record_task_duration(session, task_id, worker_id, execution_time)
             return task_updated
         except Exception as e:
             comfyui_wrapper.interrupt_processing()
@@ -584,12 +603,13 @@ async def update_task_progress_server(task_details: dict, execution_details: dic
         "progress": task_details["progress"],
         "execution_time": task_details["execution_time"],
         "error": task_details["error"],
+        "lease_token": task_details["lease_token"],
     }
     if execution_details is not None:
         request_data["execution_details"] = execution_details
     for i in range(3):
         try:
-            async with httpx.AsyncClient(timeout=options.WORKER_NET_TIMEOUT) as client:
+            async with worker_http_client() as client:
                 r = await client.put(
                     options.VIX_SERVER.rstrip("/") + "/vapi/tasks/progress",
                     json=request_data,
@@ -619,19 +639,35 @@ def __update_temporary_execution_time(task_details: dict) -> None:
 
 async def remove_active_task_lock():
     if ACTIVE_TASK:
-        await remove_task_lock(ACTIVE_TASK["task_id"])
+        await remove_task_lock(ACTIVE_TASK["task_id"], ACTIVE_TASK["lease_token"])
+    while PREFETCHED_TASKS:
+        await release_prefetched_task(PREFETCHED_TASKS.popleft())
+
 
+async def is_task_cancelled(task_details: dict) -> bool:
+    """Checks that the task claimed in advance was not removed and its lock did not expire while waiting."""
+    return not await renew_task_lock(task_details["task_id"], task_details["lease_token"])
 
-async def init_active_task_inputs_from_server() -> bool:
+
+async def release_prefetched_task(task_details: dict) -> None:
+    if options.VIX_MODE == "WORKER" and options.VIX_SERVER:
+        remove_task_files(task_details["task_id"], ["output", "input"])
+    await remove_task_lock(task_details["task_id"], task_details["lease_token"])
+
+
+async def init_task_inputs_from_server(task_details: dict) -> bool:
+    task_id = task_details["task_id"]
     if not (options.VIX_MODE == "WORKER" and options.VIX_SERVER):
+        os.makedirs(get_task_dir(task_id, "output"), exist_ok=True)
         return True
-    task_id = ACTIVE_TASK["task_id"]
     remove_task_files(task_id, ["output", "input"])
+    os.makedirs(get_task_dir(task_id, "output"), exist_ok=True)
+    os.makedirs(get_task_dir(task_id, "input"), exist_ok=True)
     try:
-        for i, _ in enumerate(ACTIVE_TASK["input_files"]):
+        for i, _ in enumerate(task_details["input_files"]):
             for k in range(3):
                 try:
-                    async with httpx.AsyncClient(timeout=options.WORKER_NET_TIMEOUT) as client:
+                    async with worker_http_client() as client:
                         r = await client.get(
                             options.VIX_SERVER.rstrip("/") + "/vapi/tasks/inputs",
                             params={"task_id": task_id, "input_index": i},
@@ -642,7 +678,7 @@ async def init_active_task_inputs_from_server() -> bool:
                         if httpx.codes.is_error(r.status_code):
                             raise RuntimeError(f"Task {task_id}: can not get input file, status={r.status_code}")
                         with builtins.open(
-                            os.path.join(options.INPUT_DIR, ACTIVE_TASK["input_files"][i]["file_name"]), mode="wb"
+                            os.path.join(options.INPUT_DIR, task_details["input_files"][i]["file_name"]), mode="wb"
                         ) as input_file:
                             input_file.write(r.content)
                         break
@@ -654,10 +690,10 @@ async def init_active_task_inputs_from_server() -> bool:
         return True
     except Exception as e:
         LOGGER.exception("Can not work on task")
-        ACTIVE_TASK["error"] = str(e)
-        await update_task_progress(ACTIVE_TASK)
+        task_details["error"] = str(e)
+        await update_task_progress(task_details)
         remove_task_files(task_id, ["output", "input"])
-        await remove_task_lock(task_id)
+        await remove_task_lock(task_id, task_details["lease_token"])
         return False
 
 
@@ -687,7 +723,7 @@ async def upload_results_to_server(task_details: dict) -> bool:
             try:
                 for i in range(3):
                     try:
-                        async with httpx.AsyncClient(timeout=options.WORKER_NET_TIMEOUT) as client:
+                        async with worker_http_client() as client:
                             r = await client.put(
                                 options.VIX_SERVER.rstrip("/") + "/vapi/tasks/results",
                                 params={
@@ -736,7 +772,8 @@ def task_progress_callback(event: str, data: dict | tuple, broadcast: bool = Fal
 
     if event == "execution_start":
         ACTIVE_TASK["execution_start_time"] = time.perf_counter()
-        threading.Thread(target=update_task_progress_thread, args=(ACTIVE_TASK,), daemon=True).start()
+        comfyui_wrapper.add_resident_models(ACTIVE_TASK["flow_models"])
+        spawn_in_engine_loop(update_task_progress_action(ACTIVE_TASK, ACTIVE_TASK.copy()))
 
     node_percent = 99 / ACTIVE_TASK["nodes_count"]
 
@@ -744,6 +781,7 @@ def task_progress_callback(event: str, data: dict | tuple, broadcast: bool = Fal
     if event == "executing":
         if data["node"] is None:
             ACTIVE_TASK = {}
+            wake_tasks_executor()
             return
         if not ACTIVE_TASK["current_node"]:
             ACTIVE_TASK["current_node"] = data["node"]
@@ -784,27 +822,44 @@ def background_prompt_executor(prompt_executor_args: tuple | list, exit_event: t
     q = prompt_executor_args[0]
     prompt_server = prompt_executor_args[1]
 
+    notifications = tasks_notifications_available()
     while True:
-        if exit_event.wait(
-            min(
+        # executor is woken up when the current task finishes and, if notifications are available,
+        # when tasks are added/restarted/unlocked, so polling is only a fallback.
+        if notifications:
+            pause_interval = options.TASKS_POLL_FALLBACK_INTERVAL if reply_count_no_tasks or ACTIVE_TASK else 0.0
+        else:
+            pause_interval = min(
                 options.MIN_PAUSE_INTERVAL + reply_count_no_tasks * options.MAX_PAUSE_INTERVAL / 10,
                 options.MAX_PAUSE_INTERVAL,
-            ),
-        ):
+            )
+        TASKS_WAKEUP_EVENT.wait(max(pause_interval, options.MIN_PAUSE_INTERVAL))
+        TASKS_WAKEUP_EVENT.clear()
+        if exit_event.is_set():
             break
 
         if not ACTIVE_TASK and not q.queue:
             # ComfyUI queue is empty, can ask for a task from Visionatrix DB/Server
-            ACTIVE_TASK = asyncio.run(get_incomplete_task_without_error(last_task_name))
-            if not ACTIVE_TASK:
-                reply_count_no_tasks = min(reply_count_no_tasks + 1, 10)
-                continue
-
-            if asyncio.run(init_active_task_inputs_from_server()) is False:
-                ACTIVE_TASK = {}
-                continue
-
-            last_task_name = ACTIVE_TASK["name"]
+            if PREFETCHED_TASKS:
+                ACTIVE_TASK = PREFETCHED_TASKS.popleft()
+                if run_in_engine_loop(is_task_cancelled(ACTIVE_TASK)):
+                    LOGGER.info("Task %s: was cancelled while waiting for execution.", ACTIVE_TASK["task_id"])
+                    run_in_engine_loop(release_prefetched_task(ACTIVE_TASK))
+                    ACTIVE_TASK = {}
+                    continue
+            else:
+                ACTIVE_TASK = run_in_engine_loop(get_incomplete_task_without_error(last_task_name))
+                if not ACTIVE_TASK:
+                    reply_count_no_tasks = min(reply_count_no_tasks + 1, 10)
+                    continue
+                reply_count_no_tasks = 0
+
+                if run_in_engine_loop(init_task_inputs_from_server(ACTIVE_TASK)) is False:
+                    ACTIVE_TASK = {}
+                    continue
+                last_task_name = ACTIVE_TASK["name"]
+
+            run_in_engine_loop(task_preprocess_extra_flags(ACTIVE_TASK["extra_flags"]))
             ACTIVE_TASK["execution_details"] = comfyui_wrapper.get_engine_details()
             ACTIVE_TASK["nodes_count"] = len(list(ACTIVE_TASK["flow_comfy"].keys()))
             ACTIVE_TASK["current_node"] = ""
@@ -836,30 +891,75 @@ def background_prompt_executor(prompt_executor_args: tuple | list, exit_event: t
                     [str(i["comfy_node_id"]) for i in ACTIVE_TASK["outputs"]],
                 )
             )
+        elif len(PREFETCHED_TASKS) < options.TASKS_PREFETCH_DEPTH:
+            # ComfyUI is busy, claim and prepare the next task in advance
+            prefetched_task = run_in_engine_loop(get_incomplete_task_without_error(last_task_name, long_poll=False))
+            if not prefetched_task:
+                reply_count_no_tasks = min(reply_count_no_tasks + 1, 10)
+                continue
+            if run_in_engine_loop(init_task_inputs_from_server(prefetched_task)) is False:
+                continue
+            LOGGER.debug("Task %s: prefetched.", prefetched_task["task_id"])
+            reply_count_no_tasks = 0
+            last_task_name = prefetched_task["name"]
+            PREFETCHED_TASKS.append(prefetched_task)
 
 
-def update_task_progress_thread(active_task: dict) -> None:
-    last_info = active_task.copy()
-    asyncio.run(__update_task_progress_action(active_task, last_info))
-
-
-async def __update_task_progress_action(active_task: dict, last_info: dict) -> None:
+async def update_task_progress_action(active_task: dict, last_info: dict) -> None:
+    lease_renewed_at = prefetched_leases_renewed_at = time.monotonic()
+    lock_lost = False
+    http_connections_opened = tasks_engine_loop.HTTP_CONNECTIONS_OPENED
+    reporter = TaskProgressReporter(last_info)
     try:
         while True:
             if last_info != active_task:
                 last_info = active_task.copy()
+            if time.monotonic() - prefetched_leases_renewed_at > options.TASK_LEASE_TTL / 3:
+                # progress updates renew only the lock of the active task
+                prefetched_leases_renewed_at = time.monotonic()
+                await renew_prefetched_tasks_locks()
+            if reporter.should_report(last_info):
                 if last_info["progress"] == 100.0:
                     if await upload_results_to_server(last_info):
                         await update_task_progress(last_info)
+                        reporter.reported(last_info)
                     break
                 if not await update_task_progress(last_info):
                     active_task["interrupted"] = True
                     comfyui_wrapper.interrupt_processing()
                     break
+                reporter.reported(last_info)
+                lease_renewed_at = time.monotonic()  # progress update also renews the lock
                 if last_info["error"]:
                     break
                 active_task["execution_time"] = last_info["execution_time"]
             else:
+                if time.monotonic() - lease_renewed_at > options.TASK_LEASE_TTL / 3:
+                    lease_renewed_at = time.monotonic()
+                    if not await renew_task_lock(last_info["task_id"], last_info["lease_token"]):
+                        LOGGER.warning("Task %s: lock was lost, interrupting.", last_info["task_id"])
+                        lock_lost = True
+                        active_task["interrupted"] = True
+                        comfyui_wrapper.interrupt_processing()
+                        break
                 await asyncio.sleep(0.1)
     finally:
-        await remove_task_lock(last_info["task_id"])
+        if not lock_lost:  # the task could already be locked by another worker
+            await remove_task_lock(last_info["task_id"], last_info["lease_token"])
+        reporter.log_counters()
+        if options.VIX_MODE == "WORKER" and options.VIX_SERVER:
+            LOGGER.debug(
+                "Task %s: %s new connections to the Server were opened during execution.",
+                last_info["task_id"],
+                tasks_engine_loop.HTTP_CONNECTIONS_OPENED - http_connections_opened,
+            )
+
+
+async def renew_prefetched_tasks_locks() -> None:
+    for prefetched_task in list(PREFETCHED_TASKS):
+        if not await renew_task_lock(prefetched_task["task_id"], prefetched_task["lease_token"]):
+            LOGGER.info("Task %s: lock was lost, dropping prefetched task.", prefetched_task["task_id"])
+            with contextlib.suppress(ValueError):
+                PREFETCHED_TASKS.remove(prefetched_task)
+                if options.VIX_MODE == "WORKER" and options.VIX_SERVER:
+                    remove_task_files(prefetched_task["task_id"], ["output", "input"])
@@ -3,7 +3,7 @@ import logging
 import threading
 from datetime import datetime, timezone
 
-from sqlalchemy import select, update
+from sqlalchemy import select, text, tuple_, update
 
 from . import database
 from .comfyui_wrapper import interrupt_processing
@@ -16,69 +16,128 @@ from .tasks_engine import (
     __get_task_query,
     __get_tasks_query,
     background_prompt_executor,
-    remove_task_files,
+    remove_tasks_files,
 )
 from .tasks_engine_etc import (
     TASK_DETAILS_COLUMNS_SHORT,
+    TASKS_PAGE_FIELDS,
     init_new_task_details,
     task_details_from_dict,
     task_details_short_to_dict,
     task_details_to_dict,
 )
+from .tasks_notify import (
+    is_postgresql,
+    notify_task_updated,
+    notify_tasks_changed,
+    tasks_notifications_listener,
+    wake_task_waiters,
+)
 
 LOGGER = logging.getLogger("visionatrix")
 BG_THREAD = []
 
 
-async def create_new_task_async(name: str, input_params: dict, user_info: UserInfo) -> dict:
+async def create_new_tasks_async(name: str, input_params_list: list[dict], user_info: UserInfo) -> list[dict]:
+    """Allocates IDs for all the tasks with one statement and returns their initial details."""
+    if is_postgresql():
+        query = text(
+            "INSERT INTO tasks_queue (id) "
+            "SELECT nextval(pg_get_serial_sequence('tasks_queue', 'id')) FROM generate_series(1, :count) "
+            "RETURNING id"
+        )
+    else:
+        query = text(
+            "WITH RECURSIVE seq(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM seq WHERE i < :count) "
+            "INSERT INTO tasks_queue (id) SELECT NULL FROM seq RETURNING id"
+        )
     async with database.SESSION() as session:
         try:
-            new_task_queue = database.TaskQueue()
-            session.add(new_task_queue)
+            tasks_ids = sorted((await session.execute(query, {"count": len(input_params_list)})).scalars().all())
             await session.commit()
         except Exception:
             await session.rollback()
-            LOGGER.exception("Failed to add `%s` to TaskQueue(%s)", name, user_info.user_id)
+            LOGGER.exception(
+                "Failed to add %s `%s` tasks to TaskQueue(%s)", len(input_params_list), name, user_info.user_id
+            )
             raise
-    remove_task_files(new_task_queue.id, ["output", "input"])
-    return init_new_task_details(new_task_queue.id, name, input_params, user_info)
+    remove_tasks_files(tasks_ids, ["output", "input"])
+    return [init_new_task_details(i, name, v, user_info) for i, v in zip(tasks_ids, input_params_list, strict=True)]
 
 
-async def put_task_in_queue_async(task_details: dict) -> None:
-    LOGGER.debug("Put flow in queue: %s", task_details)
+async def put_tasks_in_queue_async(tasks_details: list[dict]) -> None:
+    """Inserts all the tasks in one transaction."""
+    LOGGER.debug("Put %s flows in queue: %s", len(tasks_details), [i["task_id"] for i in tasks_details])
     async with database.SESSION() as session:
         try:
-            session.add(task_details_from_dict(task_details))
+            session.add_all([task_details_from_dict(i) for i in tasks_details])
             await session.commit()
+            for name, custom_worker in {(i["name"], i.get("custom_worker")) for i in tasks_details}:
+                await notify_tasks_changed(session, name, custom_worker)
         except Exception:
             await session.rollback()
-            LOGGER.exception("Failed to put task in queue: %s", task_details["task_id"])
-            remove_task_files(task_details["task_id"], ["input"])
+            LOGGER.exception("Failed to put tasks in queue: %s", [i["task_id"] for i in tasks_details])
+            remove_tasks_files(
+                [i["task_id"] for i in tasks_details], ["input"], [i["input_files"] for i in tasks_details]
+            )
             raise
 
 
 async def fetch_child_tasks_async(session, parent_task_ids: list[int]) -> dict[int, list[TaskDetailsShort]]:
+    """Fetches all descendants of the tasks with one recursive query and returns the trees of them by parent ID."""
     if not parent_task_ids:
         return {}
 
+    descendants = __get_descendants_cte(parent_task_ids)
     query = (
         select(*TASK_DETAILS_COLUMNS_SHORT)
+        .join(descendants, descendants.c.task_id == database.TaskDetails.task_id)
         .outerjoin(database.TaskLock, database.TaskLock.task_id == database.TaskDetails.task_id)
-        .filter(database.TaskDetails.parent_task_id.in_(parent_task_ids))
     )
-    child_tasks = (await session.execute(query)).all()
-
     parent_to_children = {}
-    for task in child_tasks:
+    for task in (await session.execute(query)).all():
         task_details = task_details_short_to_dict(task)
+        task_details["child_tasks"] = parent_to_children.setdefault(task.task_id, [])
         parent_to_children.setdefault(task.parent_task_id, []).append(task_details)
+    return {i: parent_to_children[i] for i in parent_task_ids if parent_to_children.get(i)}
+
+
+async def get_descendant_tasks_ids_async(parent_task_ids: list[int], user_id: str) -> list[int]:
+    """Returns IDs of the child tasks of the user tasks, of their child tasks and so on."""
+    if not parent_task_ids:
+        return []
+    descendants = __get_descendants_cte(parent_task_ids)
+    query = (
+        select(database.TaskDetails.task_id)
+        .join(descendants, descendants.c.task_id == database.TaskDetails.task_id)
+        .filter(database.TaskDetails.user_id == user_id)
+    )
+    async with database.SESSION() as session:
+        try:
+            return list((await session.execute(query)).scalars().all())
+        except Exception:
+            LOGGER.exception("Failed to retrieve child tasks of: %s", parent_task_ids)
+            raise
+
 
-    next_level_parent_ids = [task.task_id for task in child_tasks]
-    next_level_children = await fetch_child_tasks_async(session, next_level_parent_ids)
-    for children in parent_to_children.values():
-        for child in children:
-            child["child_tasks"] = next_level_children.get(child["task_id"], [])
-    return parent_to_children
+def __get_descendants_cte(parent_task_ids: list[int]):
+    # the IDs are bound only once, as SQLite limits the number of parameters of a statement
+    children = (
+        select(database.TaskDetails.task_id, database.TaskDetails.parent_task_id)
+        .filter(database.TaskDetails.parent_task_id.in_(parent_task_ids))
+        .cte("children")
+    )
+    descendants = select(children.c.task_id).cte("descendants", recursive=True)
+    return descendants.union_all(
+        select(database.TaskDetails.task_id).join(
+            descendants,
+            # child tasks are created after the parent ones, the condition protects from cycles in broken data
+            (database.TaskDetails.parent_task_id == descendants.c.task_id)
+            & (database.TaskDetails.task_id > descendants.c.task_id),
+        )
+        # children of the requested tasks are already selected, when the tasks are descendants of each other
+        .filter(database.TaskDetails.parent_task_id.not_in(select(children.c.parent_task_id)))
+    )
 
 
 async def get_task_async(task_id: int, user_id: str | None = None, fetch_child: bool = False) -> dict | None:
@@ -98,6 +157,22 @@ async def get_task_async(task_id: int, user_id: str | None = None, fetch_child:
             raise
 
 
+async def get_task_state_async(task_id: int, user_id: str | None = None) -> tuple[float, str] | None:
+    """Returns only `(progress, error)` of the task, for requests that wait for the task to finish."""
+    async with database.SESSION() as session:
+        try:
+            query = select(database.TaskDetails.progress, database.TaskDetails.error).filter(
+                database.TaskDetails.task_id == task_id
+            )
+            if user_id is not None:
+                query = query.filter(database.TaskDetails.user_id == user_id)
+            task = (await session.execute(query)).one_or_none()
+            return (task.progress, task.error) if task else None
+        except Exception:
+            LOGGER.exception("Failed to retrieve task: %s", task_id)
+            raise
+
+
 async def get_tasks_async(
     name: str | None = None,
     group_scope: int = 1,
@@ -148,14 +223,63 @@ async def get_tasks_short_async(
             raise
 
 
+async def get_tasks_page_async(
+    user_id: str,
+    fields: list[str],
+    name: str | None = None,
+    group_scope: int = 1,
+    finished: bool | None = None,
+    only_parent: bool = False,
+    updated_since: datetime | None = None,
+    cursor: tuple[datetime, int] | None = None,
+    limit: int = 100,
+) -> tuple[list[dict], bool]:
+    """Returns tasks ordered by `(updated_at, task_id)` that follow the `cursor`, and whether there are more of them.
+
+    Only the requested `fields` are fetched, `task_id` and `updated_at` are always present as they form the cursor.
+    """
+    columns = [TASKS_PAGE_FIELDS[i] for i in dict.fromkeys(["task_id", "updated_at", *fields]) if i != "child_tasks"]
+    query = (
+        __get_tasks_query(name, group_scope, finished, user_id, full_info=False, only_parent=only_parent)
+        .with_only_columns(*columns)
+        .order_by(database.TaskDetails.updated_at, database.TaskDetails.task_id)
+        .limit(limit + 1)
+    )
+    if updated_since is not None:
+        query = query.filter(database.TaskDetails.updated_at >= updated_since)
+    if cursor is not None:
+        query = query.filter(tuple_(database.TaskDetails.updated_at, database.TaskDetails.task_id) > tuple_(*cursor))
+    async with database.SESSION() as session:
+        try:
+            results = (await session.execute(query)).all()
+            tasks = [row._asdict() for row in results[:limit]]
+            for task in tasks:
+                if "priority" in task:
+                    task["priority"] &= 0b1111
+                if "hidden" in task:
+                    task["hidden"] = bool(task["hidden"])
+            if "child_tasks" in fields:
+                child_tasks = await fetch_child_tasks_async(session, [i["task_id"] for i in tasks])
+                for task in tasks:
+                    task["child_tasks"] = child_tasks.get(task["task_id"], [])
+            return tasks, len(results) > limit
+        except Exception:
+            LOGGER.exception("Failed to retrieve page of tasks: `%s`, cursor=%s", name, cursor)
+            raise
+
+
 async def update_task_outputs_async(task_id: int, outputs: list[dict]) -> bool:
     async with database.SESSION() as session:
         try:
             result = await session.execute(
-                update(database.TaskDetails).where(database.TaskDetails.task_id == task_id).values(outputs=outputs)
+                update(database.TaskDetails)
+                .where(database.TaskDetails.task_id == task_id)
+                .values(outputs=outputs, updated_at=datetime.now(timezone.utc))
             )
             if result.rowcount == 1:
+                await notify_task_updated(session, task_id)
                 await session.commit()
+                wake_task_waiters(task_id)
                 return True
         except Exception as e:
             interrupt_processing()
@@ -173,12 +297,24 @@ async def task_restart_database_async(task_id: int) -> bool:
                 "execution_time": 0.0,
                 "updated_at": datetime.now(timezone.utc),
                 "worker_id": None,
+                "lease_expirations": 0,
             }
             result = await session.execute(
                 update(database.TaskDetails).where(database.TaskDetails.task_id == task_id).values(**update_values)
             )
             await session.commit()
-            return result.rowcount == 1
+            if result.rowcount == 1:
+                task = (
+                    await session.execute(
+                        select(database.TaskDetails.name, database.TaskDetails.custom_worker).where(
+                            database.TaskDetails.task_id == task_id
+                        )
+                    )
+                ).one_or_none()
+                if task:
+                    await notify_tasks_changed(session, task.name, task.custom_worker)
+                return True
+            return False
         except Exception as e:
             interrupt_processing()
             await session.rollback()
@@ -191,6 +327,8 @@ async def start_tasks_engine(prompt_executor_args: tuple | list, exit_event: thr
         await asyncio.to_thread(background_prompt_executor, prompt_executor, exit_event)
 
     BG_THREAD.append(asyncio.create_task(start_background_tasks_engine(prompt_executor_args)))
+    if is_postgresql():
+        BG_THREAD.append(asyncio.create_task(tasks_notifications_listener(exit_event)))
 
 
 async def update_task_info_database_async(task_id: int, update_fields: dict) -> bool:
@@ -199,7 +337,7 @@ async def update_task_info_database_async(task_id: int, update_fields: dict) ->
             result = await session.execute(
                 update(database.TaskDetails)
                 .where(database.TaskDetails.task_id == task_id, database.TaskDetails.progress == 0.0)
-                .values(**update_fields)
+                .values(**{"updated_at": datetime.now(timezone.utc), **update_fields})
             )
             await session.commit()
             return result.rowcount == 1
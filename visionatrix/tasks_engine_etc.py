@@ -1,13 +1,17 @@
+import base64
+import binascii
+import collections
 import json
 import logging
 import time
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
 import httpx
-from sqlalchemy import Row, desc, or_, select
+from sqlalchemy import Row, case, desc, func, or_, select
 
 from . import comfyui_wrapper, database, db_queries, options
 from .pydantic_models import UserInfo, WorkerDetailsRequest
+from .tasks_notify import is_postgresql
 
 TASK_DETAILS_COLUMNS_SHORT = [
     database.TaskDetails.task_id,
@@ -42,8 +46,29 @@ TASK_DETAILS_COLUMNS = [
     database.TaskDetails.custom_worker,
 ]
 
+TASKS_PAGE_FIELDS = {i.key: i for i in TASK_DETAILS_COLUMNS}
+"""Fields that can be requested for the page of tasks, except `child_tasks` that are fetched separately."""
+TASKS_PAGE_DEFAULT_FIELDS = [i.key for i in TASK_DETAILS_COLUMNS_SHORT] + ["updated_at"]
+TASKS_PAGE_RESUME_OVERLAP = timedelta(seconds=60)
+"""`updated_at` is set before the update is committed, so a task can appear before the cursor of the last page later.
+The cursor of the last page is moved back by this interval, to return such tasks when the listing is resumed."""
+
 LOGGER = logging.getLogger("visionatrix")
 
+SECONDS_TO_CACHE_FLOWS_PEAK_MEMORY = 60
+FLOW_PEAK_MEMORY_SAMPLES = 50
+"""Number of the most recent profiled executions of a flow used to estimate its peak memory usage."""
+FLOW_PEAK_MEMORY_PERCENTILE = 0.9
+FLOWS_PEAK_MEMORY_SEED_TASKS = 2000
+FLOWS_PEAK_MEMORY = {
+    "update_time": 0.0,
+    "updated_since": None,  # only tasks updated after this time are fetched on the next update
+    "samples": {},  # flow name => `max_memory_usage` in MB of the recent executions, as `(task_id, value)`
+    "flows": {},  # flow name => estimated peak memory usage in MB
+    "workers_memory": 0.0,  # the largest memory available for tasks among the active workers, in MB
+}
+WORKERS_ACTIVE_INTERVAL = timedelta(minutes=5)
+
 
 def init_new_task_details(task_id: int, name: str, input_params: dict, user_info: UserInfo) -> dict:
     return {
@@ -107,6 +132,19 @@ def task_details_to_dict(task_details: Row) -> dict:
     return r
 
 
+def encode_tasks_page_cursor(updated_at: datetime, task_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{updated_at.isoformat()}|{task_id}".encode()).decode()
+
+
+def decode_tasks_page_cursor(cursor: str) -> tuple[datetime, int]:
+    """Raises `ValueError` if the cursor is not the one returned by `encode_tasks_page_cursor`."""
+    try:
+        updated_at, task_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    return datetime.fromisoformat(updated_at), int(task_id)
+
+
 def task_details_short_to_dict(task_details: Row) -> dict:
     return {
         "task_id": task_details.task_id,
@@ -160,6 +198,9 @@ def get_incomplete_task_without_error_query(
     last_task_name: str,
     worker_id: str,
     user_id: str | None,
+    flows_affinity: dict[str, int] | None = None,
+    skip_flows: list[str] | None = None,
+    users_virtual_time: tuple[dict[str, float], float] | None = None,
 ):
     query = select(database.TaskDetails).outerjoin(
         database.TaskLock, database.TaskDetails.task_id == database.TaskLock.task_id
@@ -178,15 +219,119 @@ def get_incomplete_task_without_error_query(
     )
     if tasks_to_give:
         query = query.filter(database.TaskDetails.name.in_(tasks_to_give))
+    if skip_flows:
+        query = query.filter(database.TaskDetails.name.not_in(skip_flows))
     if user_id is not None:
         query = query.filter(database.TaskDetails.user_id == user_id)
+    if users_virtual_time and users_virtual_time[0]:
+        # fair-share: users who received less execution time, relative to their weight, go first
+        users_time, others_time = users_virtual_time
+        query = query.order_by(case(users_time, value=database.TaskDetails.user_id, else_=others_time))
+    query = query.order_by(desc(get_task_effective_priority()))
+    if flows_affinity:
+        # prefer tasks of flows that use more models already loaded by the worker
+        query = query.order_by(desc(case(flows_affinity, value=database.TaskDetails.name, else_=0)))
     if last_task_name and last_task_name in tasks_to_ask:
-        query = query.order_by(desc(database.TaskDetails.priority), desc(database.TaskDetails.name == last_task_name))
-    else:
-        query = query.order_by(desc(database.TaskDetails.priority))
+        query = query.order_by(desc(database.TaskDetails.name == last_task_name))
     return query
 
 
+def get_task_effective_priority():
+    """Returns the priority increased with the time the task is waiting, if the priority aging is enabled."""
+    if not options.TASKS_PRIORITY_AGING_SLOPE:
+        return database.TaskDetails.priority
+    slope = options.TASKS_PRIORITY_AGING_SLOPE / 3600
+    if is_postgresql():
+        wait_time = func.extract("epoch", func.timezone("utc", func.now()) - database.TaskDetails.created_at)
+        return database.TaskDetails.priority + func.least(wait_time * slope, options.TASKS_PRIORITY_AGING_MAX)
+    wait_time = (func.julianday("now") - func.julianday(database.TaskDetails.created_at)) * 86400
+    return database.TaskDetails.priority + func.min(wait_time * slope, options.TASKS_PRIORITY_AGING_MAX)
+
+
+async def get_flows_peak_memory() -> dict[str, float]:
+    """Returns the estimated peak memory usage of each flow, in MB.
+
+    The estimate is a percentile of `max_memory_usage` recorded by the profiler in the recent executions of the flow,
+    so it follows changes of the flow or of the models instead of keeping the highest value ever recorded.
+    """
+    current_time = time.time()
+    if current_time < FLOWS_PEAK_MEMORY["update_time"] + SECONDS_TO_CACHE_FLOWS_PEAK_MEMORY:
+        return FLOWS_PEAK_MEMORY["flows"]
+    FLOWS_PEAK_MEMORY["update_time"] = current_time
+    updated_since = FLOWS_PEAK_MEMORY["updated_since"]
+    # tasks committed a bit later than their `updated_at` are fetched twice and skipped by their ID
+    FLOWS_PEAK_MEMORY["updated_since"] = datetime.now(timezone.utc) - timedelta(
+        seconds=SECONDS_TO_CACHE_FLOWS_PEAK_MEMORY
+    )
+    max_memory_usage = database.TaskDetails.execution_details["max_memory_usage"].as_float()
+    query = (
+        select(database.TaskDetails.task_id, database.TaskDetails.name, max_memory_usage)
+        .filter(
+            database.TaskDetails.progress == 100.0,
+            database.TaskDetails.error == "",
+            max_memory_usage > 0,
+        )
+        .order_by(desc(database.TaskDetails.updated_at))
+        .limit(FLOWS_PEAK_MEMORY_SEED_TASKS)
+    )
+    if updated_since is not None:
+        query = query.filter(database.TaskDetails.updated_at >= updated_since)
+    workers_query = select(database.Worker.vram_total, database.Worker.engine_details).filter(
+        database.Worker.last_seen >= datetime.now(timezone.utc) - WORKERS_ACTIVE_INTERVAL,
+        database.Worker.device_type != "cpu",
+        database.Worker.vram_total > 0,
+    )
+    async with database.SESSION() as session:
+        try:
+            tasks = (await session.execute(query)).all()
+            workers = (await session.execute(workers_query)).all()
+        except Exception as e:
+            FLOWS_PEAK_MEMORY["updated_since"] = updated_since
+            LOGGER.exception("Failed to update peak memory usage of flows: %s", e)
+            return FLOWS_PEAK_MEMORY["flows"]
+    samples = FLOWS_PEAK_MEMORY["samples"]
+    for task_id, flow_name, peak_memory in reversed(tasks):
+        flow_samples = samples.setdefault(flow_name, collections.deque(maxlen=FLOW_PEAK_MEMORY_SAMPLES))
+        if all(i[0] != task_id for i in flow_samples):
+            flow_samples.append((task_id, peak_memory))
+    flows_peak_memory = {}
+    for flow_name, flow_samples in samples.items():
+        values = sorted(i[1] for i in flow_samples)
+        flows_peak_memory[flow_name] = values[int(FLOW_PEAK_MEMORY_PERCENTILE * (len(values) - 1))]
+    FLOWS_PEAK_MEMORY["flows"] = flows_peak_memory
+    FLOWS_PEAK_MEMORY["workers_memory"] = max(
+        (__get_worker_memory(i.vram_total, (i.engine_details or {}).get("reserve_vram") or 0.0) for i in workers),
+        default=0.0,
+    )
+    return flows_peak_memory
+
+
+def get_flows_not_fitting_worker(
+    flows_names: list[str], worker_details: WorkerDetailsRequest, flows_peak_memory: dict[str, float]
+) -> list[str]:
+    """Returns the flows whose estimated peak memory usage exceeds the VRAM of the worker.
+
+    Flows that do not fit any of the active workers are not filtered out, so their tasks are still executed
+    by the largest workers instead of waiting in the queue forever.
+    """
+    worker_device = worker_details.devices[0]
+    if not worker_device.vram_total or worker_device.type == "cpu":
+        return []
+    worker_memory = __get_worker_memory(worker_device.vram_total, worker_details.engine_details.reserve_vram)
+    workers_memory = max(FLOWS_PEAK_MEMORY["workers_memory"], worker_memory)
+    r = []
+    for flow_name in flows_names:
+        peak_memory = flows_peak_memory.get(flow_name, options.FLOW_DEFAULT_PEAK_MEMORY)
+        if worker_memory < peak_memory <= workers_memory:
+            r.append(flow_name)
+    return r
+
+
+def __get_worker_memory(vram_total: int, reserve_vram: float) -> float:
+    """Returns the VRAM in MB available for tasks, `reserve_vram` is in GB."""
+    return vram_total / 1024**2 - reserve_vram * 1024
+
+
 def nodes_execution_profiler(active_task: dict, event: str, data: dict):
     try:
         __nodes_execution_profiler(active_task, event, data)
@@ -0,0 +1,272 @@
+import logging
+import secrets
+from datetime import datetime, timedelta, timezone
+
+import httpx
+from sqlalchemy import DateTime, String, delete, literal, select, true, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from . import database, options
+from .tasks_engine_loop import worker_http_client
+from .tasks_eta import record_tasks_wait_time
+from .tasks_notify import is_postgresql, notify_tasks_changed
+
+LOGGER = logging.getLogger("visionatrix")
+
+
+def __lock_task_and_return_details(task: type[database.TaskDetails] | database.TaskDetails, lease_token: str):
+    return {
+        "task_id": task.task_id,
+        "lease_token": lease_token,
+        "progress": 0.0,
+        "error": task.error,
+        "name": task.name,
+        "input_params": task.input_params,
+        "outputs": task.outputs,
+        "input_files": task.input_files,
+        "flow_comfy": task.flow_comfy,
+        "user_id": task.user_id,
+        "execution_time": 0.0,
+        "webhook_url": task.webhook_url,
+        "webhook_headers": task.webhook_headers,
+        "extra_flags": task.extra_flags,
+        "translated_input_params": task.translated_input_params,
+    }
+
+
+async def claim_tasks(session, query, count: int) -> list[dict]:
+    """Atomically locks up to `count` tasks from the `get_incomplete_task_without_error_query` query.
+
+    PostgreSQL uses `SELECT ... FOR UPDATE SKIP LOCKED`, so concurrent claimers do not compete for the same rows,
+    SQLite serializes writers, so a single `INSERT ... SELECT` into `task_locks` is enough.
+
+    Each claim gets a new lease token, which the worker must present to renew or remove the lock and to update
+    the progress, so a worker whose lease expired can not affect the task claimed again by another worker.
+    """
+    locked_at = datetime.utcnow()
+    expires_at = task_lease_expires_at()
+    lease_token = secrets.token_hex(16)
+    if is_postgresql():
+        tasks = (
+            (await session.execute(query.limit(count).with_for_update(skip_locked=True, of=database.TaskDetails)))
+            .scalars()
+            .all()
+        )
+        if not tasks:
+            await session.rollback()
+            return []
+        stmt = (
+            postgresql.insert(database.TaskLock)
+            .values(
+                [
+                    {
+                        "task_id": task.task_id,
+                        "locked_at": locked_at,
+                        "expires_at": expires_at,
+                        "lease_token": lease_token,
+                    }
+                    for task in tasks
+                ]
+            )
+            .on_conflict_do_nothing(index_elements=[database.TaskLock.task_id])
+            .returning(database.TaskLock.task_id)
+        )
+        locked_tasks_ids = set((await session.execute(stmt)).scalars().all())
+        await session.commit()
+        tasks = [task for task in tasks if task.task_id in locked_tasks_ids]
+        record_tasks_wait_time(tasks, locked_at)
+        return [__lock_task_and_return_details(task, lease_token) for task in tasks]
+
+    stmt = (
+        sqlite.insert(database.TaskLock)
+        .from_select(
+            [
+                database.TaskLock.task_id,
+                database.TaskLock.locked_at,
+                database.TaskLock.expires_at,
+                database.TaskLock.lease_token,
+            ],
+            query.with_only_columns(
+                database.TaskDetails.task_id,
+                literal(locked_at, DateTime),
+                literal(expires_at, DateTime),
+                literal(lease_token, String),
+            ).limit(count),
+        )
+        .on_conflict_do_nothing()
+        .returning(database.TaskLock.task_id)
+    )
+    locked_tasks_ids = (await session.execute(stmt)).scalars().all()
+    await session.commit()
+    if not locked_tasks_ids:
+        return []
+    tasks = (
+        (await session.execute(select(database.TaskDetails).where(database.TaskDetails.task_id.in_(locked_tasks_ids))))
+        .scalars()
+        .all()
+    )
+    # rows are inserted and returned in the order of the claim query, which can not be re-applied to locked tasks
+    positions = {task_id: i for i, task_id in enumerate(locked_tasks_ids)}
+    tasks = sorted(tasks, key=lambda x: positions[x.task_id])
+    record_tasks_wait_time(tasks, locked_at)
+    return [__lock_task_and_return_details(task, lease_token) for task in tasks]
+
+
+async def remove_task_lock(task_id: int, lease_token: str) -> None:
+    if options.VIX_MODE == "WORKER" and options.VIX_SERVER:
+        return await remove_task_lock_server(task_id, lease_token)
+    return await remove_task_lock_database(task_id, lease_token)
+
+
+async def remove_task_lock_database(task_id: int, lease_token: str | None = None) -> None:
+    """Removes the task lock, only the lock of the given lease when `lease_token` is specified."""
+    async with database.SESSION() as session:
+        try:
+            query = delete(database.TaskLock).where(database.TaskLock.task_id == task_id)
+            if lease_token is not None:
+                query = query.where(database.TaskLock.lease_token == lease_token)
+            result = await session.execute(query)
+            if result.rowcount > 0:
+                await session.commit()
+                task = (
+                    await session.execute(
+                        select(database.TaskDetails.name, database.TaskDetails.custom_worker).where(
+                            database.TaskDetails.task_id == task_id,
+                            database.TaskDetails.progress != 100.0,
+                            database.TaskDetails.error == "",
+                        )
+                    )
+                ).one_or_none()
+                if task:  # the task was unlocked without being finished, so it can be picked up again
+                    await notify_tasks_changed(session, task.name, task.custom_worker)
+        except Exception as e:
+            await session.rollback()
+            LOGGER.exception("Task %s: failed to remove task lock: %s", task_id, e)
+
+
+async def remove_task_lock_server(task_id: int, lease_token: str) -> None:
+    try:
+        async with worker_http_client() as client:
+            r = await client.delete(
+                options.VIX_SERVER.rstrip("/") + "/vapi/tasks/lock",
+                params={"task_id": task_id, "lease_token": lease_token},
+                auth=options.worker_auth(),
+            )
+        if httpx.codes.is_error(r.status_code):
+            LOGGER.warning("Task %s: server return status: %s", task_id, r.status_code)
+    except Exception as e:
+        LOGGER.exception("Exception occurred: %s", e)
+
+
+def task_lease_expires_at() -> datetime:
+    return datetime.utcnow() + timedelta(seconds=options.TASK_LEASE_TTL)
+
+
+async def renew_task_lock(task_id: int, lease_token: str) -> bool:
+    """Extends the task lease. Returns False only when the task or its lock of this lease no longer exists."""
+    if options.VIX_MODE == "WORKER" and options.VIX_SERVER:
+        return await renew_task_lock_server(task_id, lease_token)
+    return await renew_task_lock_database(task_id, lease_token)
+
+
+async def renew_task_lock_database(task_id: int, lease_token: str | None) -> bool:
+    """Without `lease_token` (workers of previous versions) the lock is matched only by the task ID."""
+    async with database.SESSION() as session:
+        try:
+            result = await session.execute(
+                update(database.TaskLock)
+                .where(
+                    database.TaskLock.task_id == task_id,
+                    database.TaskLock.lease_token == lease_token if lease_token is not None else true(),
+                    database.TaskLock.task_id.in_(
+                        select(database.TaskDetails.task_id).where(
+                            database.TaskDetails.task_id == task_id,
+                            database.TaskDetails.progress != 100.0,
+                            database.TaskDetails.error == "",
+                        )
+                    ),
+                )
+                .values(expires_at=task_lease_expires_at())
+            )
+            await session.commit()
+            return result.rowcount == 1
+        except Exception as e:
+            await session.rollback()
+            LOGGER.exception("Task %s: failed to renew task lock: %s", task_id, e)
+    return True
+
+
+async def renew_task_lock_server(task_id: int, lease_token: str) -> bool:
+    try:
+        async with worker_http_client() as client:
+            r = await client.put(
+                options.VIX_SERVER.rstrip("/") + "/vapi/tasks/lock",
+                params={"task_id": task_id, "lease_token": lease_token},
+                auth=options.worker_auth(),
+            )
+        if r.status_code == httpx.codes.NOT_FOUND:
+            return False
+        if httpx.codes.is_error(r.status_code):
+            LOGGER.warning("Task %s: server return status: %s", task_id, r.status_code)
+    except Exception as e:
+        LOGGER.exception("Exception occurred: %s", e)
+    return True
+
+
+async def reclaim_expired_task_leases() -> None:
+    """Returns tasks whose locks have expired to the queue, or marks them failed when they expired too many times."""
+    now = datetime.utcnow()
+    async with database.SESSION() as session:
+        try:
+            query = (
+                select(
+                    database.TaskLock.task_id,
+                    database.TaskDetails.name,
+                    database.TaskDetails.custom_worker,
+                    database.TaskDetails.lease_expirations,
+                    database.TaskDetails.progress,
+                    database.TaskDetails.error,
+                )
+                .outerjoin(database.TaskDetails, database.TaskDetails.task_id == database.TaskLock.task_id)
+                .where(database.TaskLock.expires_at < now)
+            )
+            expired_locks = (await session.execute(query)).all()
+            requeued_tasks = []
+            for task in expired_locks:
+                result = await session.execute(
+                    delete(database.TaskLock).where(
+                        database.TaskLock.task_id == task.task_id, database.TaskLock.expires_at < now
+                    )
+                )
+                if result.rowcount == 0 or task.name is None or task.progress == 100.0 or task.error:
+                    continue  # lock was renewed or the task was already finished
+                if task.lease_expirations + 1 >= options.TASK_LEASE_MAX_EXPIRATIONS:
+                    LOGGER.warning(
+                        "Task %s: lock expired %s times, marking as failed.", task.task_id, task.lease_expirations + 1
+                    )
+                    update_values = {
+                        "error": "The worker executing the task was lost.",
+                        "lease_expirations": task.lease_expirations + 1,
+                        "updated_at": datetime.now(timezone.utc),
+                    }
+                else:
+                    LOGGER.warning("Task %s: lock expired, returning task to the queue.", task.task_id)
+                    update_values = {
+                        "progress": 0.0,
+                        "execution_time": 0.0,
+                        "worker_id": None,
+                        "lease_expirations": task.lease_expirations + 1,
+                        "updated_at": datetime.now(timezone.utc),
+                    }
+                    requeued_tasks.append(task)
+                await session.execute(
+                    update(database.TaskDetails)
+                    .where(database.TaskDetails.task_id == task.task_id)
+                    .values(**update_values)
+                )
+            await session.commit()
+            for task in requeued_tasks:
+                await notify_tasks_changed(session, task.name, task.custom_worker)
+        except Exception as e:
+            await session.rollback()
+            LOGGER.exception("Failed to reclaim expired task locks: %s", e)
@@ -0,0 +1,71 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import importlib.util
+import logging
+import threading
+import typing
+
+import httpx
+
+from . import options
+
+LOGGER = logging.getLogger("visionatrix")
+
+ENGINE_LOOP: asyncio.AbstractEventLoop | None = None
+"""Long-living event loop of the tasks engine, runs in a separate thread."""
+ENGINE_LOOP_LOCK = threading.Lock()
+
+HTTP_CLIENT: httpx.AsyncClient | None = None
+"""Keep-alive HTTP client of the Worker, shared by all requests to the Server made from the `ENGINE_LOOP`."""
+HTTP_CONNECTIONS_OPENED = 0
+"""Number of connections to the Server opened by the Worker, should grow only slightly with the number of tasks."""
+
+T = typing.TypeVar("T")
+
+
+def get_engine_loop() -> asyncio.AbstractEventLoop:
+    global ENGINE_LOOP
+    with ENGINE_LOOP_LOCK:
+        if ENGINE_LOOP is None:
+            ENGINE_LOOP = asyncio.new_event_loop()
+            threading.Thread(target=ENGINE_LOOP.run_forever, name="vix-engine-loop", daemon=True).start()
+    return ENGINE_LOOP
+
+
+def run_in_engine_loop(coro: typing.Coroutine[typing.Any, typing.Any, T]) -> T:
+    """Runs the coroutine in the engine loop and waits for its result, a replacement for `asyncio.run`."""
+    return asyncio.run_coroutine_threadsafe(coro, get_engine_loop()).result()
+
+
+def spawn_in_engine_loop(coro: typing.Coroutine) -> concurrent.futures.Future:
+    return asyncio.run_coroutine_threadsafe(coro, get_engine_loop())
+
+
+async def __trace_connections(event_name: str, _info: dict) -> None:
+    global HTTP_CONNECTIONS_OPENED
+    if event_name == "connection.connect_tcp.complete":
+        HTTP_CONNECTIONS_OPENED += 1
+
+
+async def __set_request_trace(request: httpx.Request) -> None:
+    request.extensions["trace"] = __trace_connections
+
+
+@contextlib.asynccontextmanager
+async def worker_http_client() -> typing.AsyncIterator[httpx.AsyncClient]:
+    """Returns the shared HTTP client when called from the engine loop, otherwise a temporary one."""
+    global HTTP_CLIENT
+    if asyncio.get_running_loop() is not ENGINE_LOOP:
+        async with httpx.AsyncClient(timeout=options.WORKER_NET_TIMEOUT) as client:
+            yield client
+        return
+    if HTTP_CLIENT is None:
+        http2 = importlib.util.find_spec("h2") is not None
+        LOGGER.debug("Creating HTTP client for the Server connections, http2=%s", http2)
+        HTTP_CLIENT = httpx.AsyncClient(
+            timeout=options.WORKER_NET_TIMEOUT,
+            http2=http2,
+            event_hooks={"request": [__set_request_trace]},
+        )
+    yield HTTP_CLIENT
@@ -0,0 +1,65 @@
+import logging
+import time
+
+from . import options
+
+LOGGER = logging.getLogger("visionatrix")
+
+PROGRESS_UPDATES_SENT = 0
+"""Total number of task progress reports sent by this process."""
+PROGRESS_UPDATES_SUPPRESSED = 0
+"""Total number of task progress changes that were coalesced into later reports and not sent separately."""
+
+
+def is_task_progress_final(task_details: dict) -> bool:
+    return task_details["progress"] == 100.0 or bool(task_details["error"]) or task_details.get("interrupted", False)
+
+
+class TaskProgressReporter:
+    """Rate-limits progress reports of the task: reports at most once per `TASK_PROGRESS_MIN_INTERVAL` and only
+    when the progress has changed by at least `TASK_PROGRESS_MIN_DELTA`. Final states are reported immediately."""
+
+    def __init__(self, task_details: dict):
+        self.task_id = task_details["task_id"]
+        self.sent = 0
+        self.suppressed = 0
+        self._reported_at = 0.0
+        self._reported_state = self._observed_state = self.__state(task_details)
+
+    @staticmethod
+    def __state(task_details: dict) -> tuple:
+        return task_details["progress"], task_details["error"], task_details.get("interrupted", False)
+
+    def should_report(self, task_details: dict) -> bool:
+        """Should be called for each observed change of the task, counts changes that are not reported yet."""
+        global PROGRESS_UPDATES_SUPPRESSED
+        state = self.__state(task_details)
+        if state == self._reported_state:
+            return False
+        if is_task_progress_final(task_details) or (
+            abs(task_details["progress"] - self._reported_state[0]) >= options.TASK_PROGRESS_MIN_DELTA
+            and time.monotonic() - self._reported_at >= options.TASK_PROGRESS_MIN_INTERVAL
+        ):
+            return True
+        if state != self._observed_state:
+            self._observed_state = state
+            self.suppressed += 1
+            PROGRESS_UPDATES_SUPPRESSED += 1
+        return False
+
+    def reported(self, task_details: dict) -> None:
+        global PROGRESS_UPDATES_SENT
+        self._reported_at = time.monotonic()
+        self._reported_state = self._observed_state = self.__state(task_details)
+        self.sent += 1
+        PROGRESS_UPDATES_SENT += 1
+
+    def log_counters(self) -> None:
+        LOGGER.debug(
+            "Task %s: %s progress updates sent, %s suppressed (process total: %s sent, %s suppressed).",
+            self.task_id,
+            self.sent,
+            self.suppressed,
+            PROGRESS_UPDATES_SENT,
+            PROGRESS_UPDATES_SUPPRESSED,
+        )
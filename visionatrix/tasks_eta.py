@@ -0,0 +1,271 @@
+import asyncio
+import collections
+import logging
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import desc, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import database
+from .pydantic_models import TaskDetailsShort
+
+LOGGER = logging.getLogger("visionatrix")
+
+DURATION_EWMA_ALPHA = 0.1
+"""Weight of the newest execution time in the exponentially weighted duration estimate."""
+DURATION_SAMPLES = 50
+"""Number of the most recent execution times kept for the duration percentiles."""
+DURATIONS_SEED_TASKS = 2000
+"""Number of the most recently finished tasks used to build initial duration estimates."""
+WORKERS_ACTIVE_INTERVAL = timedelta(minutes=5)
+
+TASKS_DURATIONS: dict[tuple[str, str], "DurationEstimate"] = {}
+"""Execution time estimates keyed by `(flow name, worker device name)`."""
+TASKS_DURATIONS_LOCK = threading.Lock()
+TASKS_DURATIONS_SEEDED = False
+
+SECONDS_TO_CACHE_TASKS_ETA = 5
+TASKS_ETA_CACHE = {
+    "update_time": 0.0,
+    "tasks": {},  # task_id => ETA of all unfinished tasks, as returned by `get_tasks_eta`
+}
+TASKS_ETA_CACHE_LOCK = asyncio.Lock()
+
+WAIT_TIMES_SAMPLES = 1000
+TASKS_WAIT_TIMES: dict[int, collections.deque[float]] = {}
+"""Queue wait times of the recently claimed tasks, in seconds, keyed by the local priority of the tasks."""
+
+
+class DurationEstimate:
+    """Streaming estimate of the execution time: exponentially weighted mean that follows recent changes
+    and the most recent samples for the percentiles."""
+
+    __slots__ = ("count", "mean", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.samples: collections.deque[float] = collections.deque(maxlen=DURATION_SAMPLES)
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        alpha = max(DURATION_EWMA_ALPHA, 1 / self.count)  # plain average while there are only a few samples
+        self.mean += alpha * (value - self.mean)
+        self.samples.append(value)
+
+
+def worker_class_from_id(worker_id: str | None) -> str:
+    """Extracts the device name from the `worker_id` (user_id:hostname:[device_name]:device_index)."""
+    if worker_id and (m := re.search(r":\[(.*)]:\d+$", worker_id)):
+        return m.group(1)
+    return ""
+
+
+async def record_task_duration(session: AsyncSession, task_id: int, worker_id: str, execution_time: float) -> None:
+    """Should be called when the task is successfully finished, updates the estimate of its flow."""
+    if not TASKS_DURATIONS_SEEDED or execution_time <= 0:
+        return  # until estimates are seeded, finished tasks are taken from the database
+    query = select(database.TaskDetails.name).filter(database.TaskDetails.task_id == task_id)
+    if (flow_name := (await session.execute(query)).scalar()) is None:
+        return
+    with TASKS_DURATIONS_LOCK:
+        TASKS_DURATIONS.setdefault((flow_name, worker_class_from_id(worker_id)), DurationEstimate()).add(execution_time)
+
+
+async def seed_tasks_durations() -> None:
+    global TASKS_DURATIONS_SEEDED
+
+    if TASKS_DURATIONS_SEEDED:
+        return
+    async with database.SESSION() as session:
+        try:
+            query = (
+                select(database.TaskDetails.name, database.TaskDetails.execution_time, database.Worker.device_name)
+                .outerjoin(database.Worker, database.Worker.worker_id == database.TaskDetails.worker_id)
+                .filter(
+                    database.TaskDetails.progress == 100.0,
+                    database.TaskDetails.error == "",
+                    database.TaskDetails.execution_time > 0,
+                )
+                .order_by(desc(database.TaskDetails.task_id))
+                .limit(DURATIONS_SEED_TASKS)
+            )
+            rows = (await session.execute(query)).all()
+        except Exception as e:
+            LOGGER.exception("Failed to load execution times of finished tasks: %s", e)
+            return
+    with TASKS_DURATIONS_LOCK:
+        if TASKS_DURATIONS_SEEDED:
+            return
+        for name, execution_time, device_name in reversed(rows):
+            TASKS_DURATIONS.setdefault((name, device_name or ""), DurationEstimate()).add(execution_time)
+        TASKS_DURATIONS_SEEDED = True
+
+
+def get_flow_duration_estimate(flow_name: str, worker_class: str | None = None) -> float | None:
+    """Returns expected execution time of the flow, for the specific class of workers if known."""
+    with TASKS_DURATIONS_LOCK:
+        estimates = __get_flow_duration_estimates(flow_name, worker_class)
+        if not estimates:
+            return None
+        return sum(i.mean * i.count for i in estimates) / sum(i.count for i in estimates)
+
+
+def get_flow_duration_p90(flow_name: str, worker_class: str | None = None) -> float | None:
+    """Returns the 90th percentile of the recent execution times of the flow, like `get_flow_duration_estimate`."""
+    with TASKS_DURATIONS_LOCK:
+        values = sorted(v for i in __get_flow_duration_estimates(flow_name, worker_class) for v in i.samples)
+    if not values:
+        return None
+    return values[int(0.9 * (len(values) - 1))]
+
+
+def __get_flow_duration_estimates(flow_name: str, worker_class: str | None) -> list[DurationEstimate]:
+    if worker_class is not None and (estimate := TASKS_DURATIONS.get((flow_name, worker_class))):
+        return [estimate]
+    estimates = [v for k, v in TASKS_DURATIONS.items() if k[0] == flow_name]
+    if not estimates:
+        estimates = list(TASKS_DURATIONS.values())
+    return estimates
+
+
+async def get_tasks_eta(tasks_ids: list[int] | None) -> dict[int, dict]:
+    """Estimates the time (in seconds) until the tasks are finished, based on the queue and active workers.
+
+    The queue is processed in the same order as by workers: by priority and then by task ID.
+    Tasks that no active worker can process get `None` as their ETA. With `None` instead of the list of IDs
+    estimates all unfinished tasks. Besides the expected execution time of the task, its 90th percentile
+    is returned, as an upper bound for flows with widely varying execution times.
+    """
+    await seed_tasks_durations()
+    async with database.SESSION() as session:
+        try:
+            queue = (
+                await session.execute(
+                    select(
+                        database.TaskDetails.task_id,
+                        database.TaskDetails.name,
+                        database.TaskDetails.progress,
+                        database.TaskDetails.worker_id,
+                        database.TaskLock.id.is_not(None).label("locked"),
+                    )
+                    .outerjoin(database.TaskLock, database.TaskLock.task_id == database.TaskDetails.task_id)
+                    .filter(database.TaskDetails.progress != 100.0, database.TaskDetails.error == "")
+                    .order_by(desc(database.TaskDetails.priority), database.TaskDetails.task_id)
+                )
+            ).all()
+            workers = (
+                await session.execute(
+                    select(database.Worker.worker_id, database.Worker.last_asked_tasks).filter(
+                        database.Worker.last_seen >= datetime.now(timezone.utc) - WORKERS_ACTIVE_INTERVAL
+                    )
+                )
+            ).all()
+        except Exception as e:
+            LOGGER.exception("Failed to retrieve the tasks queue: %s", e)
+            return {}
+
+    tasks_ids = set(tasks_ids) if tasks_ids is not None else None
+    flows_workers: dict[str, set[str]] = {}
+    for worker in workers:
+        for flow_name in worker.last_asked_tasks or []:
+            flows_workers.setdefault(flow_name, set()).add(worker.worker_id)
+
+    flows_durations = {}  # flow name => (expected duration, 90th percentile of duration)
+    r = {}
+    running_left: dict[str, float] = {}  # worker_id => expected time to finish its current task
+    queued_by_flow: dict[str, float] = {}  # flow name => expected duration of its not started tasks
+    queue_position = 0
+    for task in queue:
+        if task.locked:
+            worker_class = worker_class_from_id(task.worker_id)
+            duration = get_flow_duration_estimate(task.name, worker_class)
+            left = duration * (100.0 - task.progress) / 100.0 if duration is not None else None
+            if task.worker_id and left is not None:
+                running_left[task.worker_id] = left
+            if tasks_ids is None or task.task_id in tasks_ids:
+                r[task.task_id] = {
+                    "eta": left,
+                    "queue_position": 0,
+                    "estimated_duration": duration,
+                    "estimated_duration_p90": get_flow_duration_p90(task.name, worker_class),
+                }
+            continue
+        queue_position += 1
+        if task.name not in flows_durations:
+            flows_durations[task.name] = (get_flow_duration_estimate(task.name), get_flow_duration_p90(task.name))
+        duration, duration_p90 = flows_durations[task.name]
+        if tasks_ids is None or task.task_id in tasks_ids:
+            task_workers = flows_workers.get(task.name, set())
+            eta = None
+            if task_workers and duration is not None:
+                # work ahead that can be taken by the same workers is split evenly between them
+                ahead = sum(running_left.get(i, 0.0) for i in task_workers)
+                ahead += sum(v for k, v in queued_by_flow.items() if flows_workers.get(k, set()) & task_workers)
+                eta = ahead / len(task_workers) + duration
+            r[task.task_id] = {
+                "eta": eta,
+                "queue_position": queue_position,
+                "estimated_duration": duration,
+                "estimated_duration_p90": duration_p90,
+            }
+        if duration is not None:
+            queued_by_flow[task.name] = queued_by_flow.get(task.name, 0.0) + duration
+    return r
+
+
+async def get_cached_tasks_eta() -> dict[int, dict]:
+    """Returns ETA of all unfinished tasks, estimated at most once per `SECONDS_TO_CACHE_TASKS_ETA` seconds."""
+    if time.time() < TASKS_ETA_CACHE["update_time"] + SECONDS_TO_CACHE_TASKS_ETA:
+        return TASKS_ETA_CACHE["tasks"]
+    async with TASKS_ETA_CACHE_LOCK:  # concurrent requests wait for the single scan of the queue
+        if time.time() >= TASKS_ETA_CACHE["update_time"] + SECONDS_TO_CACHE_TASKS_ETA:
+            TASKS_ETA_CACHE["tasks"] = await get_tasks_eta(None)
+            TASKS_ETA_CACHE["update_time"] = time.time()
+    return TASKS_ETA_CACHE["tasks"]
+
+
+async def fill_tasks_eta(tasks: list[TaskDetailsShort]) -> None:
+    """Sets the `eta` field of the tasks, `0` for finished ones.
+
+    Used by the progress endpoints that are polled frequently, so ETA of unfinished tasks is taken from the cache
+    and tasks created after it was updated have no ETA yet.
+    """
+    tasks_eta = None
+    for task in tasks:
+        if task.progress == 100.0:
+            task.eta = 0.0
+        elif not task.error:
+            if tasks_eta is None:
+                tasks_eta = await get_cached_tasks_eta()
+            if task.task_id in tasks_eta:
+                task.eta = tasks_eta[task.task_id]["eta"]
+
+
+def record_tasks_wait_time(tasks: list[database.TaskDetails], claimed_at: datetime) -> None:
+    with TASKS_DURATIONS_LOCK:
+        for task in tasks:
+            wait_times = TASKS_WAIT_TIMES.setdefault(
+                task.priority & 0b1111, collections.deque(maxlen=WAIT_TIMES_SAMPLES)
+            )
+            wait_times.append(max((claimed_at - task.created_at.replace(tzinfo=None)).total_seconds(), 0.0))
+
+
+def get_tasks_wait_time_percentiles() -> dict[int, dict]:
+    """Returns percentiles of the queue wait time of the recently claimed tasks for each local priority."""
+    with TASKS_DURATIONS_LOCK:
+        wait_times = {k: sorted(v) for k, v in TASKS_WAIT_TIMES.items()}
+    r = {}
+    for priority, values in sorted(wait_times.items()):
+        r[priority] = {
+            "priority": priority,
+            "count": len(values),
+            "p50": values[int(0.5 * (len(values) - 1))],
+            "p90": values[int(0.9 * (len(values) - 1))],
+            "p99": values[int(0.99 * (len(values) - 1))],
+            "max": values[-1],
+        }
+    return r
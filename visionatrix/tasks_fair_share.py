@@ -0,0 +1,68 @@
+import json
+import logging
+import threading
+import time
+
+from . import options
+from .db_queries import get_global_setting
+from .tasks_eta import get_flow_duration_estimate
+
+LOGGER = logging.getLogger("visionatrix")
+
+SECONDS_TO_CACHE_USERS_WEIGHTS = 30
+USERS_WEIGHTS = {
+    "update_time": 0.0,
+    "weights": {},  # user_id => weight, from the `fair_share_weights` global setting
+}
+
+USERS_VIRTUAL_TIME: dict[str, float] = {}
+"""Virtual finish time of the last task given to the user, only for users that are ahead of `SYSTEM_VIRTUAL_TIME`."""
+SYSTEM_VIRTUAL_TIME = 0.0
+"""Virtual start time of the last given task, users without their own virtual time are considered to be at it."""
+FAIR_SHARE_LOCK = threading.Lock()
+
+
+async def get_users_weights() -> dict[str, float]:
+    """Returns weights of users from the `fair_share_weights` setting: JSON object like `{"user_id": 2.0}`.
+
+    Users not listed there have weight `1`.
+    """
+    current_time = time.time()
+    if current_time < USERS_WEIGHTS["update_time"] + SECONDS_TO_CACHE_USERS_WEIGHTS:
+        return USERS_WEIGHTS["weights"]
+    USERS_WEIGHTS["update_time"] = current_time
+    try:
+        weights = json.loads(await get_global_setting("fair_share_weights", True) or "{}")
+        USERS_WEIGHTS["weights"] = {str(k): float(v) for k, v in weights.items() if float(v) > 0}
+    except Exception as e:
+        LOGGER.warning("Invalid `fair_share_weights` setting: %s", e)
+    return USERS_WEIGHTS["weights"]
+
+
+def get_users_virtual_time() -> tuple[dict[str, float], float]:
+    """Returns virtual time of the users that are ahead of others, and the virtual time of all the other users.
+
+    Tasks of users with a lower virtual time should be given first.
+    """
+    if not options.TASKS_FAIR_SHARE:
+        return {}, 0.0
+    with FAIR_SHARE_LOCK:
+        return USERS_VIRTUAL_TIME.copy(), SYSTEM_VIRTUAL_TIME
+
+
+async def charge_users_for_tasks(tasks: list[dict]) -> None:
+    """Advances the virtual time of task owners by the expected task duration divided by the owner's weight."""
+    global SYSTEM_VIRTUAL_TIME
+
+    if not options.TASKS_FAIR_SHARE or not tasks:
+        return
+    weights = await get_users_weights()
+    with FAIR_SHARE_LOCK:
+        for task in tasks:
+            user_id = task["user_id"]
+            start_time = max(USERS_VIRTUAL_TIME.get(user_id, 0.0), SYSTEM_VIRTUAL_TIME)
+            cost = get_flow_duration_estimate(task["name"]) or 1.0
+            USERS_VIRTUAL_TIME[user_id] = start_time + cost / weights.get(user_id, 1.0)
+            SYSTEM_VIRTUAL_TIME = start_time
+        for user_id in [k for k, v in USERS_VIRTUAL_TIME.items() if v <= SYSTEM_VIRTUAL_TIME]:
+            del USERS_VIRTUAL_TIME[user_id]
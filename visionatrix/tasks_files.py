@@ -0,0 +1,180 @@
+import contextlib
+import logging
+import os
+import re
+import shutil
+import typing
+
+from sqlalchemy import select
+
+from . import database, options
+from .inputs_store import release_inputs_files
+
+LOGGER = logging.getLogger("visionatrix")
+
+TASKS_PER_SHARD = 1000
+"""Number of tasks with consecutive IDs which directories are stored in the same shard directory."""
+TASK_FILE_RE = re.compile(r"^(\d+)_")
+MIGRATION_CHUNK_SIZE = 500
+
+
+def get_task_subdir(task_id: int) -> str:
+    """Path of the task directory relative to the input directory and to the `visionatrix` output directory."""
+    return f"{task_id // TASKS_PER_SHARD}/{task_id}"
+
+
+def get_task_dir(task_id: int, directory: typing.Literal["input", "output"]) -> str:
+    if directory == "input":
+        target_directory = options.INPUT_DIR
+    elif directory == "output":
+        target_directory = os.path.join(options.OUTPUT_DIR, "visionatrix")
+    else:
+        raise ValueError(f"Invalid input value: {directory}")
+    return os.path.join(target_directory, str(task_id // TASKS_PER_SHARD), str(task_id))
+
+
+def get_task_files(task_id: int, directory: typing.Literal["input", "output"]) -> list[tuple[str, str]]:
+    task_directory = get_task_dir(task_id, directory)
+    try:
+        return [(i, os.path.join(task_directory, i)) for i in sorted(os.listdir(task_directory))]
+    except FileNotFoundError:
+        return []
+
+
+def remove_task_files(task_id: int, directories: list[str], input_files: list[dict] | None = None) -> None:
+    remove_tasks_files([task_id], directories, [input_files])
+
+
+def remove_tasks_files(
+    tasks_ids: list[int], directories: list[str], tasks_input_files: list[list[dict] | None] | None = None
+) -> None:
+    """Removes the directories of the tasks.
+
+    When the input directories are removed, files of the inputs store referenced by `tasks_input_files`
+    (`input_files` of the tasks) are released.
+    """
+    for directory in directories:
+        for task_id in tasks_ids:
+            shutil.rmtree(get_task_dir(task_id, directory), ignore_errors=True)
+    if "input" in directories and tasks_input_files:
+        release_inputs_files(
+            {i["stored_name"] for input_files in tasks_input_files for i in input_files or [] if i.get("stored_name")}
+        )
+
+
+def update_legacy_task_paths(task_details: dict) -> None:
+    """Tasks created before the per-task directories were introduced, and tasks received by remote workers, refer to
+    the input files in the root of the input directory and save results directly to `visionatrix`."""
+    task_subdir = get_task_subdir(task_details["task_id"])
+    new_inputs_names = {}
+    for input_file in task_details.get("input_files") or []:
+        if "/" not in input_file["file_name"]:
+            new_inputs_names[input_file["file_name"]] = f"{task_subdir}/{input_file['file_name']}"
+            input_file["file_name"] = new_inputs_names[input_file["file_name"]]
+    legacy_prefix = f"visionatrix/{task_details['task_id']}_"
+    for node_details in task_details["flow_comfy"].values():
+        for input_name, input_value in node_details.get("inputs", {}).items():
+            if not isinstance(input_value, str):
+                continue
+            if input_value in new_inputs_names:
+                node_details["inputs"][input_name] = new_inputs_names[input_value]
+            elif input_value.startswith(legacy_prefix):
+                node_details["inputs"][input_name] = f"visionatrix/{task_subdir}/" + input_value.removeprefix(
+                    "visionatrix/"
+                )
+
+
+def flatten_task_paths(task_details: dict) -> None:
+    """Converts paths of the task files to the layout without per-task directories before sending the task to
+    a remote worker. The layout of the files is local to each instance, and workers of previous versions
+    do not create the per-task directories; `update_legacy_task_paths` converts the paths back."""
+    task_subdir = get_task_subdir(task_details["task_id"])
+    flat_inputs_names = {}
+    for input_file in task_details.get("input_files") or []:
+        if input_file["file_name"].startswith(f"{task_subdir}/"):
+            flat_inputs_names[input_file["file_name"]] = input_file["file_name"].removeprefix(f"{task_subdir}/")
+            input_file["file_name"] = flat_inputs_names[input_file["file_name"]]
+    output_prefix = f"visionatrix/{task_subdir}/{task_details['task_id']}_"
+    for node_details in task_details["flow_comfy"].values():
+        for input_name, input_value in node_details.get("inputs", {}).items():
+            if not isinstance(input_value, str):
+                continue
+            if input_value in flat_inputs_names:
+                node_details["inputs"][input_name] = flat_inputs_names[input_value]
+            elif input_value.startswith(output_prefix):
+                node_details["inputs"][input_name] = "visionatrix/" + input_value.removeprefix(
+                    f"visionatrix/{task_subdir}/"
+                )
+
+
+async def migrate_tasks_files_layout() -> None:
+    """Moves files of tasks from the root of the input and the `visionatrix` output directories to the directories
+    of the tasks. References to the moved input files in the database are updated before the files are moved,
+    so an interrupted migration continues on the next start."""
+    moved_outputs = 0
+    for filename in __list_directory(os.path.join(options.OUTPUT_DIR, "visionatrix")):
+        if m := TASK_FILE_RE.match(filename):
+            __move_file(
+                os.path.join(options.OUTPUT_DIR, "visionatrix"), get_task_dir(int(m.group(1)), "output"), filename
+            )
+            moved_outputs += 1
+
+    tasks_inputs: dict[int, list[str]] = {}
+    for filename in __list_directory(options.INPUT_DIR):
+        if m := TASK_FILE_RE.match(filename):
+            tasks_inputs.setdefault(int(m.group(1)), []).append(filename)
+    tasks_ids = list(tasks_inputs)
+    for i in range(0, len(tasks_ids), MIGRATION_CHUNK_SIZE):
+        chunk = {k: tasks_inputs[k] for k in tasks_ids[i : i + MIGRATION_CHUNK_SIZE]}
+        await __update_tasks_inputs_references(chunk)
+        for task_id, filenames in chunk.items():
+            for filename in filenames:
+                __move_file(options.INPUT_DIR, get_task_dir(task_id, "input"), filename)
+    if moved_outputs or tasks_inputs:
+        LOGGER.warning(
+            "Migration of tasks files to per-task directories done: %s output files, %s input files.",
+            moved_outputs,
+            sum(len(i) for i in tasks_inputs.values()),
+        )
+
+
+def __list_directory(directory: str) -> list[str]:
+    """Returns names of the files in the directory, nothing if it does not exist yet."""
+    try:
+        with os.scandir(directory) as entries:
+            return [i.name for i in entries if i.is_file()]
+    except FileNotFoundError:
+        return []
+
+
+def __move_file(source_directory: str, destination_directory: str, filename: str) -> None:
+    os.makedirs(destination_directory, exist_ok=True)
+    with contextlib.suppress(FileNotFoundError):  # can be moved at the same time by another process of the server
+        os.replace(os.path.join(source_directory, filename), os.path.join(destination_directory, filename))
+
+
+async def __update_tasks_inputs_references(tasks_inputs: dict[int, list[str]]) -> None:
+    async with database.SESSION() as session:
+        try:
+            query = select(database.TaskDetails).filter(database.TaskDetails.task_id.in_(list(tasks_inputs)))
+            for task in (await session.execute(query)).scalars().all():
+                new_names = {i: f"{get_task_subdir(task.task_id)}/{i}" for i in tasks_inputs[task.task_id]}
+                task.input_files = [
+                    {**i, "file_name": new_names.get(i["file_name"], i["file_name"])} for i in task.input_files or []
+                ]
+                flow_comfy = task.flow_comfy or {}
+                task.flow_comfy = {
+                    node_id: {
+                        **node_details,
+                        "inputs": {
+                            k: new_names.get(v, v) if isinstance(v, str) else v
+                            for k, v in node_details.get("inputs", {}).items()
+                        },
+                    }
+                    for node_id, node_details in flow_comfy.items()
+                }
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            LOGGER.exception("Failed to update references to the input files of tasks: %s", list(tasks_inputs))
+            raise
@@ -0,0 +1,270 @@
+import asyncio
+import contextlib
+import json
+import logging
+import threading
+import uuid
+
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import options
+
+LOGGER = logging.getLogger("visionatrix")
+
+TASKS_CHANNEL = "vix_tasks"
+TASKS_WAKEUP_EVENT = threading.Event()
+
+TASKS_WAITERS: dict[tuple[str, str | None], set["TasksWaiter"]] = {}
+"""Requests waiting for the next task, keyed by `(flow name, custom worker)`."""
+TASKS_WAITERS_LOCK = threading.Lock()
+
+TASK_UPDATES_CHANNEL = "vix_task_updates"
+TASK_WAITERS: dict[int, set["TaskWaiter"]] = {}
+"""Requests waiting for updates of the task (progress, error or outputs), keyed by the task ID."""
+TASK_EVENTS_SUBSCRIBERS: dict[str, set["TaskEventsSubscriber"]] = {}
+"""Clients of the tasks progress stream, keyed by the user ID."""
+TASK_EVENT_FIELDS = (
+    "task_id",
+    "user_id",
+    "name",
+    "group_scope",
+    "parent_task_id",
+    "progress",
+    "error",
+    "execution_time",
+)
+MAX_NOTIFICATION_PAYLOAD_SIZE = 7999
+"""Payload of PostgreSQL notifications must be shorter than 8000 bytes."""
+MAX_NOTIFICATION_ERROR_LENGTH = 1000
+"""Long errors are truncated in the notifications, to fit in the payload even with multibyte characters."""
+PROCESS_ID = uuid.uuid4().hex
+"""Notifications sent by this process are received by it too, the events from them should not be published twice."""
+
+
+class BaseWaiter:
+    """Request registered in one of the waiters dictionaries under the `keys`, woken from any thread."""
+
+    def __init__(self, registry: dict, keys: list):
+        self.registry = registry
+        self.keys = keys
+        self._event = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+
+    def __enter__(self):
+        with TASKS_WAITERS_LOCK:
+            for key in self.keys:
+                self.registry.setdefault(key, set()).add(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with TASKS_WAITERS_LOCK:
+            for key in self.keys:
+                if waiters := self.registry.get(key):
+                    waiters.discard(self)
+                    if not waiters:
+                        del self.registry[key]
+
+    def wake(self) -> None:
+        with contextlib.suppress(RuntimeError):  # loop is already closed
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._event.clear()
+        return True
+
+
+class TasksWaiter(BaseWaiter):
+    """Registers a request in `TASKS_WAITERS` to be woken when a task that it can process is queued."""
+
+    def __init__(self, flows_names: list[str], worker_id: str):
+        super().__init__(TASKS_WAITERS, [(i, None) for i in flows_names] + [(i, worker_id) for i in flows_names])
+
+
+class TaskWaiter(BaseWaiter):
+    """Registers a request in `TASK_WAITERS` to be woken when the task is updated."""
+
+    def __init__(self, task_id: int):
+        super().__init__(TASK_WAITERS, [task_id])
+
+
+class TaskEventsSubscriber(BaseWaiter):
+    """Client of the tasks progress stream, receives events only for the tasks of the user that match its filters.
+
+    Events that were not taken by the client yet are merged: only the last state of each task is kept.
+    `tasks_ids` should include the already existing descendants of the tasks, new ones are added from the events.
+    """
+
+    def __init__(self, user_id: str, name: str | None, group_scope: int, tasks_ids: list[int]):
+        super().__init__(TASK_EVENTS_SUBSCRIBERS, [user_id])
+        self.name = name
+        self.group_scope = group_scope
+        self.tasks_ids = set(tasks_ids)
+        self._pending: dict[int, dict] = {}
+        self._pending_lock = threading.Lock()
+
+    def is_matching(self, event: dict) -> bool:
+        """Called under `TASKS_WAITERS_LOCK`, which also protects the `tasks_ids`."""
+        if self.tasks_ids:
+            if event["task_id"] in self.tasks_ids:
+                return True
+            if event["parent_task_id"] in self.tasks_ids:
+                self.tasks_ids.add(event["task_id"])  # so the events of its own child tasks match too
+                return True
+            return False
+        if self.name is not None and event["name"] != self.name:
+            return False
+        return not self.group_scope or event["group_scope"] == self.group_scope
+
+    def put(self, event: dict) -> None:
+        with self._pending_lock:
+            self._pending[event["task_id"]] = event
+        self.wake()
+
+    def pop_events(self) -> list[dict]:
+        with self._pending_lock:
+            r = list(self._pending.values())
+            self._pending.clear()
+        return r
+
+
+def is_postgresql() -> bool:
+    return options.DATABASE_URI.startswith("postgresql")
+
+
+def tasks_notifications_available() -> bool:
+    """Returns True when the tasks executor is woken up on queue changes and polling is only a fallback."""
+    if options.VIX_MODE == "WORKER":
+        return not options.VIX_SERVER and is_postgresql()
+    return True
+
+
+def wake_tasks_executor() -> None:
+    TASKS_WAKEUP_EVENT.set()
+
+
+def wake_tasks_waiters(name: str | None, custom_worker: str | None) -> None:
+    """Wakes requests waiting for a task with the specified flow name, `None` name wakes all waiters."""
+    with TASKS_WAITERS_LOCK:
+        if name is None:
+            waiters = {waiter for i in TASKS_WAITERS.values() for waiter in i}
+        else:
+            waiters = set(TASKS_WAITERS.get((name, custom_worker), ()))
+    for waiter in waiters:
+        waiter.wake()
+
+
+async def notify_tasks_changed(session: AsyncSession, name: str | None = None, custom_worker: str | None = None):
+    """Should be called after the changes are committed: wakes local executor, waiters and the other processes."""
+    wake_tasks_executor()
+    wake_tasks_waiters(name, custom_worker)
+    if not is_postgresql():
+        return
+    try:
+        await session.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": TASKS_CHANNEL, "payload": json.dumps({"name": name, "custom_worker": custom_worker})},
+        )
+        await session.commit()
+    except Exception as e:
+        await session.rollback()
+        LOGGER.warning("Failed to send `%s` notification: %s", TASKS_CHANNEL, e)
+
+
+def wake_task_waiters(task_id: int | None) -> None:
+    """Wakes requests waiting for updates of the task, `None` wakes waiters of all tasks."""
+    with TASKS_WAITERS_LOCK:
+        if task_id is None:
+            waiters = {waiter for i in TASK_WAITERS.values() for waiter in i}
+        else:
+            waiters = set(TASK_WAITERS.get(task_id, ()))
+    for waiter in waiters:
+        waiter.wake()
+
+
+def get_task_event(task_row) -> dict:
+    """Creates the event for the progress stream from the updated row of `TaskDetails`."""
+    r = {i: getattr(task_row, i) for i in TASK_EVENT_FIELDS}
+    r["finished"] = bool(r["error"]) or r["progress"] == 100.0
+    return r
+
+
+def publish_task_event(event: dict) -> None:
+    with TASKS_WAITERS_LOCK:
+        subscribers = [i for i in TASK_EVENTS_SUBSCRIBERS.get(event["user_id"], ()) if i.is_matching(event)]
+    for subscriber in subscribers:
+        subscriber.put(event)
+
+
+async def notify_task_updated(session: AsyncSession, task_id: int, event: dict | None = None) -> None:
+    """Should be called before the update of the task is committed, other processes are notified on commit.
+
+    Waiters of this process should be woken with `wake_task_waiters` and the event published with
+    `publish_task_event` after the commit.
+    """
+    if not is_postgresql():
+        return
+    try:
+        async with session.begin_nested():  # a failed notification must not roll back the update of the task
+            await session.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": TASK_UPDATES_CHANNEL, "payload": __get_task_updated_payload(task_id, event)},
+            )
+    except Exception as e:
+        LOGGER.warning("Failed to send `%s` notification: %s", TASK_UPDATES_CHANNEL, e)
+
+
+def __get_task_updated_payload(task_id: int, event: dict | None) -> str:
+    payload = {"task_id": task_id, "process": PROCESS_ID}
+    if event:
+        payload["event"] = {**event, "error": event["error"][:MAX_NOTIFICATION_ERROR_LENGTH]}
+        r = json.dumps(payload, ensure_ascii=False)
+        if len(r.encode("utf-8")) <= MAX_NOTIFICATION_PAYLOAD_SIZE:
+            return r
+        # other processes still wake the task waiters, only their progress stream clients miss this event
+        del payload["event"]
+    return json.dumps(payload)
+
+
+async def tasks_notifications_listener(exit_event: threading.Event) -> None:
+    import psycopg  # noqa # pylint: disable=import-outside-toplevel
+
+    conninfo = make_url(options.DATABASE_URI).set(drivername="postgresql").render_as_string(hide_password=False)
+    while not exit_event.is_set():
+        try:
+            async with await psycopg.AsyncConnection.connect(conninfo, autocommit=True) as connection:
+                await connection.execute(f"LISTEN {TASKS_CHANNEL}")
+                await connection.execute(f"LISTEN {TASK_UPDATES_CHANNEL}")
+                LOGGER.debug("Listening for `%s` and `%s` notifications.", TASKS_CHANNEL, TASK_UPDATES_CHANNEL)
+                wake_tasks_executor()  # notifications could be lost while we were not listening
+                wake_tasks_waiters(None, None)
+                wake_task_waiters(None)
+                while not exit_event.is_set():
+                    async for notification in connection.notifies(timeout=options.TASKS_POLL_FALLBACK_INTERVAL):
+                        if notification.channel == TASK_UPDATES_CHANNEL:
+                            __on_task_updated_notification(notification.payload)
+                            continue
+                        wake_tasks_executor()
+                        try:
+                            payload = json.loads(notification.payload)
+                        except ValueError:
+                            payload = {}
+                        wake_tasks_waiters(payload.get("name"), payload.get("custom_worker"))
+        except Exception as e:
+            LOGGER.warning("Connection for `%s` notifications lost: %s", TASKS_CHANNEL, e)
+            await asyncio.sleep(5)
+
+
+def __on_task_updated_notification(payload: str) -> None:
+    try:
+        payload = json.loads(payload)
+    except ValueError:
+        return
+    wake_task_waiters(payload["task_id"])
+    if payload.get("event") and payload.get("process") != PROCESS_ID:
+        publish_task_event(payload["event"])